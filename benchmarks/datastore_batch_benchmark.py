@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares reading and writing many statuses one at a time and in batches.
+
+Creates --count dropboxrsyncaddress entities in their own namespace, then
+times reading them all with one SyncStatus each against reading them with a
+SyncStatusBatch, and likewise for writing them.  It is meant to be run against
+the Datastore emulator started by run_tests_with_emulator.sh, after
+`$(gcloud beta emulators datastore env-init)`:
+    python benchmarks/datastore_batch_benchmark.py --count 500
+It is run by hand, not as part of the tests.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+# pylint: disable=no-name-in-module
+import google.cloud.datastore as cloud_datastore
+# pylint: enable=no-name-in-module
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import scraper  # pylint: disable=wrong-import-position
+
+
+def timed(label, count, function):
+    """Runs the function, and prints how long it took."""
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    print '%-28s %10.3f s %10.2f ms/status' % (label, elapsed,
+                                               elapsed * 1000.0 / count)
+
+
+def main(argv):
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=500,
+                        help='How many rsync urls to read and write')
+    parser.add_argument('--namespace', default='scraper-batch-benchmark')
+    args = parser.parse_args(argv[1:])
+
+    if 'DATASTORE_EMULATOR_HOST' not in os.environ:
+        sys.exit('DATASTORE_EMULATOR_HOST is not set; refusing to write to a '
+                 'real Datastore.')
+    client = cloud_datastore.Client(namespace=args.namespace)
+    urls = ['rsync://mlab%d.xxx%02d.measurement-lab.org:7999/ndt' %
+            (index % 4 + 1, index // 4) for index in range(args.count)]
+    batch = scraper.SyncStatusBatch(client, urls)
+    batch.update_all(dict((url, {scraper.SyncStatus.MTIME_KEY: 1})
+                          for url in urls))
+    statuses = [scraper.SyncStatus(client, url) for url in urls]
+
+    timed('get, one at a time', args.count,
+          lambda: [status.get_last_archived_mtime() for status in statuses])
+    timed('get_multi, batched', args.count, batch.get_all)
+    timed('put, one at a time', args.count,
+          lambda: [status.update_mtime(2) for status in statuses])
+    timed('put_multi in transactions, batched', args.count,
+          lambda: batch.update_all(dict(
+              (url, {scraper.SyncStatus.MTIME_KEY: 3}) for url in urls)))
+    client.delete_multi([client.key(scraper.SyncStatus.RSYNC_KEY, url)
+                         for url in urls])
+
+
+if __name__ == '__main__':
+    main(sys.argv)
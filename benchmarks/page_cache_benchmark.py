@@ -0,0 +1,113 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures how much page cache tarring up data leaves behind.
+
+Tars up a directory of data twice, once leaving the component files in the
+page cache and once dropping them with scraper.drop_from_page_cache() as
+create_tarfile() does, and reports how much the page cache grew per GB of
+input each time.  The page cache is measured with the cgroup's memory.stat
+where there is one (as that is what counts against a container's memory
+limit), and /proc/meminfo otherwise, so it is noisy on a busy machine.
+Without --data_dir, the synthetic dataset of tarfile_cpu_benchmark.py is used.
+
+Run it from the root of the repository:
+    python benchmarks/page_cache_benchmark.py --megabytes 500
+"""
+
+import argparse
+import datetime
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import scraper  # pylint: disable=wrong-import-position
+import tarfile_cpu_benchmark  # pylint: disable=wrong-import-position
+
+
+def page_cache_bytes():
+    """Returns the size of the page cache of this cgroup, or of the machine."""
+    for name, key in (('/sys/fs/cgroup/memory.stat', 'file'),
+                      ('/sys/fs/cgroup/memory/memory.stat', 'cache')):
+        if os.path.exists(name):
+            for line in open(name):
+                field, value = line.split()
+                if field == key:
+                    return int(value)
+    for line in open('/proc/meminfo'):
+        field, value = line.split()[:2]
+        if field == 'Cached:':
+            return int(value) * 1024
+    raise RuntimeError('Could not find the size of the page cache')
+
+
+def evict(files):
+    """Writes the files back to disk and drops them from the page cache."""
+    subprocess.check_call(['sync'])
+    for name in files:
+        scraper.drop_from_page_cache(name)
+
+
+def main(argv):
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data_dir', help='Data to tar (default: synthetic)')
+    parser.add_argument('--megabytes', type=int, default=200,
+                        help='Size of the synthetic dataset')
+    parser.add_argument('--tar_binary', default='/bin/tar')
+    args = parser.parse_args(argv[1:])
+
+    # pylint: disable=protected-access
+    posix_fadvise = scraper._POSIX_FADVISE
+    if posix_fadvise is None:
+        sys.exit('posix_fadvise() is not available here.')
+    workdir = tempfile.mkdtemp()
+    try:
+        data_dir = args.data_dir
+        if not data_dir:
+            data_dir = os.path.join(workdir, 'data')
+            tarfile_cpu_benchmark.make_dataset(data_dir, args.megabytes)
+        files = [os.path.relpath(local.filename, data_dir)
+                 for local in scraper.all_files(
+                     data_dir, datetime.datetime(1970, 1, 1),
+                     datetime.datetime(2100, 1, 1))]
+        paths = [os.path.join(data_dir, name) for name in files]
+        input_bytes = sum(os.stat(path).st_size for path in paths)
+        print '%d files, %d bytes' % (len(files), input_bytes)
+        print '%-24s %16s %12s' % ('mode', 'cache growth', 'MB/GB')
+        tarfile_name = os.path.join(workdir, 'data.tgz')
+        # Without posix_fadvise, create_tarfile() leaves the files cached.
+        for mode, fadvise in (('cached', None), ('dropped', posix_fadvise)):
+            scraper._POSIX_FADVISE = posix_fadvise
+            evict(paths)
+            before = page_cache_bytes()
+            scraper._POSIX_FADVISE = fadvise
+            scraper.create_tarfile(args.tar_binary, tarfile_name, files,
+                                   directory=data_dir)
+            growth = page_cache_bytes() - before
+            print '%-24s %16d %12.1f' % (mode, growth,
+                                         growth / 1e6 / (input_bytes / 1e9))
+            for name in (tarfile_name, tarfile_name + scraper.MANIFEST_SUFFIX):
+                os.remove(name)
+    finally:
+        scraper._POSIX_FADVISE = posix_fadvise
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,114 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures the CPU cost of creating tarfiles with each compression mode.
+
+Tars up a directory of data once for every mode in
+scraper.TAR_COMPRESSION_MODES and reports the CPU seconds (used by both this
+process and tar) per GB of input, along with the compression ratio.  Without
+--data_dir, a synthetic NDT-like dataset is generated: mostly gzipped trace
+files, with small uncompressed metadata files between them.
+
+Run it from the root of the repository:
+    python benchmarks/tarfile_cpu_benchmark.py --megabytes 500
+"""
+
+import argparse
+import datetime
+import gzip
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import scraper  # pylint: disable=wrong-import-position
+
+
+def cpu_seconds():
+    """Returns the CPU time used so far by this process and its children."""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def make_dataset(directory, megabytes):
+    """Fills the directory with about that many megabytes of NDT-like data."""
+    words = ['snaplog', 'cputime', 'meta', 'c2s', 's2c', 'ndttrace', 'rtt',
+             'cwnd', 'ack', 'seq', 'window', 'bytes'] + [
+                 str(i) for i in range(1000)]
+    # Generating random text is slow, so a few bodies are shared by all files.
+    traces = [' '.join(random.choice(words) for _ in range(40000))
+              for _ in range(20)]
+    day = os.path.join(directory, '2017', '10', '12')
+    os.makedirs(day)
+    total = 0
+    index = 0
+    while total < megabytes * 1000 * 1000:
+        index += 1
+        trace = '%d %s' % (index, random.choice(traces))
+        trace_name = os.path.join(day, 'test%06d.s2c_snaplog.gz' % index)
+        trace_file = gzip.GzipFile(trace_name, 'wb')
+        trace_file.write(trace)
+        trace_file.close()
+        meta_name = os.path.join(day, 'test%06d.meta' % index)
+        with open(meta_name, 'w') as meta_file:
+            meta_file.write(trace[:2000])
+        total += os.stat(trace_name).st_size + os.stat(meta_name).st_size
+
+
+def main(argv):
+    """Runs the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--data_dir', help='Data to tar (default: synthetic)')
+    parser.add_argument('--megabytes', type=int, default=200,
+                        help='Size of the synthetic dataset')
+    parser.add_argument('--tar_binary', default='/bin/tar')
+    args = parser.parse_args(argv[1:])
+
+    workdir = tempfile.mkdtemp()
+    try:
+        data_dir = args.data_dir
+        if not data_dir:
+            data_dir = os.path.join(workdir, 'data')
+            make_dataset(data_dir, args.megabytes)
+        with scraper.chdir(data_dir):
+            files = [local.filename for local in scraper.all_files(
+                '.', datetime.datetime(1970, 1, 1),
+                datetime.datetime(2100, 1, 1))]
+            input_bytes = sum(os.stat(name).st_size for name in files)
+            print '%d files, %d bytes' % (len(files), input_bytes)
+            print '%-24s %12s %12s %8s' % ('mode', 'CPU seconds', 'CPU s/GB',
+                                           'ratio')
+            for mode in scraper.TAR_COMPRESSION_MODES:
+                tarfile_name = os.path.join(workdir, mode + '.tgz')
+                before = cpu_seconds()
+                scraper.create_tarfile(args.tar_binary, tarfile_name, files,
+                                       mode)
+                used = cpu_seconds() - before
+                output_bytes = os.stat(tarfile_name).st_size
+                print '%-24s %12.2f %12.2f %8.3f' % (
+                    mode, used, used * 1e9 / input_bytes,
+                    float(output_bytes) / input_bytes)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lists the files in an rsync daemon's module without running rsync.
+
+Listing files with the rsync binary means running it in dry-run mode, having
+it compare every file with the local copy, and parsing its debug output.  This
+module instead speaks just enough of the rsync daemon protocol to ask the
+daemon for the file list of a module, and decodes the file list as it arrives.
+
+It speaks protocol version 29, which every rsync since 2.6.4 understands, and
+which has a simpler file list encoding than the later versions.  Once the file
+list has been read, the connection is closed, as nothing is to be transferred.
+"""
+
+import collections
+import logging
+import socket
+import struct
+
+PROTOCOL_VERSION = 29
+
+# After the handshake, everything the daemon sends is multiplexed.  Each
+# message has a 4-byte little-endian header holding the message tag plus
+# MPLEX_BASE in the top byte, and the length of the message in the other three.
+MPLEX_BASE = 7
+MSG_DATA = 0
+MSG_ERROR_XFER = 1
+MSG_INFO = 2
+MSG_ERROR = 3
+MSG_WARNING = 4
+
+# Bits of the flags that precede each entry in the file list.  The rest of
+# them are about things (owners, devices, hard links) that are never asked for.
+XMIT_SAME_MODE = 1 << 1
+XMIT_EXTENDED_FLAGS = 1 << 2
+XMIT_SAME_NAME = 1 << 5
+XMIT_LONG_NAME = 1 << 6
+XMIT_SAME_TIME = 1 << 7
+
+# An entry in the file list.  The mtime is in seconds since the epoch, and the
+# mode is as returned by os.stat(), so stat.S_ISDIR() and friends work on it.
+FileListEntry = collections.namedtuple('FileListEntry',
+                                       ['name', 'size', 'mtime', 'mode'])
+
+
+class RsyncProtocolError(Exception):
+    """The daemon refused the request, or broke the protocol."""
+
+
+class _Connection(object):
+    """Reads and writes the rsync daemon protocol on a socket."""
+
+    def __init__(self, sock):
+        self._sock = sock
+        self._input = sock.makefile('rb')
+        self._multiplexed = False
+        self._data = ''
+        self._offset = 0
+        self.errors = []
+
+    def close(self):
+        """Closes the connection.
+
+        The socket is only closed once the file made from it is closed too.
+        """
+        self._input.close()
+        self._sock.close()
+
+    def send(self, data):
+        """Sends the data to the daemon."""
+        self._sock.sendall(data)
+
+    def read_line(self):
+        """Reads a line of the handshake, without its newline."""
+        line = self._input.readline()
+        if not line.endswith('\n'):
+            raise RsyncProtocolError(
+                'Connection closed during handshake: %r' % line)
+        return line.rstrip('\n')
+
+    def _read_raw(self, size):
+        data = self._input.read(size)
+        if len(data) < size:
+            message = 'Connection closed by the rsync daemon'
+            if self.errors:
+                message += ': ' + self.errors[-1]
+            raise RsyncProtocolError(message)
+        return data
+
+    def start_multiplexing(self):
+        """Demultiplexes everything read after this."""
+        self._multiplexed = True
+
+    def _read_message(self):
+        """Reads one multiplexed message, keeping its data if it has any."""
+        header, = struct.unpack('<I', self._read_raw(4))
+        tag = (header >> 24) - MPLEX_BASE
+        payload = self._read_raw(header & 0xFFFFFF)
+        if tag == MSG_DATA:
+            self._data = self._data[self._offset:] + payload
+            self._offset = 0
+        elif tag in (MSG_ERROR, MSG_ERROR_XFER):
+            logging.error('rsync daemon error: %s', payload.rstrip())
+            self.errors.append(payload.rstrip())
+        elif tag == MSG_WARNING:
+            logging.warning('rsync daemon warning: %s', payload.rstrip())
+        else:
+            logging.info('rsync daemon message %d: %s', tag, payload.rstrip())
+
+    def read(self, size):
+        """Reads exactly size bytes of data."""
+        if not self._multiplexed:
+            return self._read_raw(size)
+        while len(self._data) - self._offset < size:
+            self._read_message()
+        data = self._data[self._offset:self._offset + size]
+        self._offset += size
+        return data
+
+    def read_byte(self):
+        """Reads an unsigned byte."""
+        return ord(self.read(1))
+
+    def read_int(self):
+        """Reads a signed 32-bit little-endian integer."""
+        return struct.unpack('<i', self.read(4))[0]
+
+    def read_longint(self):
+        """Reads a 64-bit integer, which is sent as 32 bits if it fits."""
+        value = self.read_int()
+        if value != -1:
+            return value
+        return struct.unpack('<q', self.read(8))[0]
+
+
+def _handshake(connection, module):
+    """Agrees on the protocol version, and selects the module."""
+    greeting = connection.read_line()
+    if not greeting.startswith('@RSYNCD: '):
+        raise RsyncProtocolError('Not an rsync daemon: %r' % greeting)
+    # The greeting may list digests after the version, as in
+    # "@RSYNCD: 31.0 sha512 sha256 sha1 md5 md4".
+    version = int(greeting.split()[1].split('.')[0])
+    if version < PROTOCOL_VERSION:
+        raise RsyncProtocolError(
+            'The rsync daemon speaks protocol %d, older than %d' %
+            (version, PROTOCOL_VERSION))
+    connection.send('@RSYNCD: %d.0\n' % PROTOCOL_VERSION)
+    connection.send(module + '\n')
+    while True:
+        line = connection.read_line()
+        if line == '@RSYNCD: OK':
+            return
+        if line.startswith('@RSYNCD: AUTHREQD'):
+            raise RsyncProtocolError(
+                'Module %s requires a password, which is not supported' %
+                module)
+        if line.startswith('@ERROR') or line.startswith('@RSYNCD: EXIT'):
+            raise RsyncProtocolError(line)
+        # Anything else is the daemon's message of the day.
+        logging.debug('rsync daemon says: %s', line)
+
+
+def _read_file_list(connection):
+    """Reads the file list, yielding each FileListEntry in it."""
+    name = ''
+    mtime = 0
+    mode = 0
+    while True:
+        flags = connection.read_byte()
+        if flags == 0:
+            return
+        if flags & XMIT_EXTENDED_FLAGS:
+            flags |= connection.read_byte() << 8
+        # Each name is sent as the length of the prefix it shares with the
+        # previous name, followed by the rest of it.
+        prefix_length = 0
+        if flags & XMIT_SAME_NAME:
+            prefix_length = connection.read_byte()
+        if flags & XMIT_LONG_NAME:
+            suffix_length = connection.read_int()
+        else:
+            suffix_length = connection.read_byte()
+        name = name[:prefix_length] + connection.read(suffix_length)
+        size = connection.read_longint()
+        if not flags & XMIT_SAME_TIME:
+            mtime = connection.read_int()
+        if not flags & XMIT_SAME_MODE:
+            mode = connection.read_int()
+        yield FileListEntry(name, size, mtime, mode)
+
+
+def _connect(host, port, family, connect_timeout, timeout):
+    """Connects like socket.create_connection(), to addresses of the family."""
+    error = socket.error('No address found for %s' % host)
+    for address_family, socket_type, protocol, _, address in (
+            socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)):
+        sock = socket.socket(address_family, socket_type, protocol)
+        try:
+            sock.settimeout(connect_timeout)
+            sock.connect(address)
+            sock.settimeout(timeout)
+            return sock
+        except socket.error as connect_error:
+            error = connect_error
+            sock.close()
+    raise error
+
+
+def list_files(host, port, module, path='', filters=(), timeout=300,
+               connect_timeout=None, family=socket.AF_UNSPEC):
+    """Lists the files and directories in a module of an rsync daemon.
+
+    Args:
+      host: the host the daemon runs on
+      port: the port the daemon listens on
+      module: the name of the module
+      path: optional directory within the module to list, recursively
+      filters: optional rsync filter rules, such as '- *.tmp' or '+ /2017/'
+      timeout: optional number of seconds to wait on the network
+      connect_timeout: optional number of seconds to wait for the connection,
+                       like rsync's --contimeout; default is the timeout
+      family: optional address family to connect over, such as
+              socket.AF_INET for what rsync's -4 does
+
+    Returns:
+      a list of FileListEntry objects, with names relative to the path, in
+      the order in which the daemon sent them
+
+    Raises:
+      RsyncProtocolError if the daemon refuses the request or breaks the
+      protocol, and socket.error if the network fails
+    """
+    connection = _Connection(_connect(
+        host, port, family,
+        timeout if connect_timeout is None else connect_timeout, timeout))
+    try:
+        _handshake(connection, module)
+        # The arguments are what the rsync binary sends when it receives
+        # files recursively, without preserving anything but times.
+        arguments = ['--server', '--sender', '-rt', '.', module + '/' + path]
+        connection.send(''.join(arg + '\n' for arg in arguments) + '\n')
+        # The checksum seed is only needed to transfer files.
+        connection.read_int()
+        connection.start_multiplexing()
+        for rule in filters:
+            connection.send(struct.pack('<i', len(rule)) + rule)
+        connection.send(struct.pack('<i', 0))
+        return [entry for entry in _read_file_list(connection)
+                if entry.name != '.']
+    finally:
+        connection.close()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# No docstrings required for tests, and tests need to be methods of classes to
+# aid in organization of tests. Using the 'self' variable is not required.
+#
+# pylint: disable=missing-docstring, no-self-use, too-many-public-methods
+
+import os
+import shutil
+import socket
+import stat
+import struct
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import rsync_client
+import scraper
+
+DIRECTORY_MODE = stat.S_IFDIR | 0755
+FILE_MODE = stat.S_IFREG | 0644
+
+
+def message(data, tag=rsync_client.MSG_DATA):
+    return struct.pack('<I', ((rsync_client.MPLEX_BASE + tag) << 24) |
+                       len(data)) + data
+
+
+def entry(name, size, mtime, mode, flags=0, prefix_length=0):
+    data = ''
+    if flags & rsync_client.XMIT_SAME_NAME:
+        data += chr(prefix_length)
+    suffix = name[prefix_length:]
+    if flags & rsync_client.XMIT_LONG_NAME:
+        data += struct.pack('<i', len(suffix))
+    else:
+        data += chr(len(suffix))
+    data += suffix
+    if size < 2**31:
+        data += struct.pack('<i', size)
+    else:
+        data += struct.pack('<iq', -1, size)
+    if not flags & rsync_client.XMIT_SAME_TIME:
+        data += struct.pack('<i', mtime)
+    if not flags & rsync_client.XMIT_SAME_MODE:
+        data += struct.pack('<i', mode)
+    # Like rsync, flags of 0 are sent as two bytes, to tell the entry apart
+    # from the end of the list.
+    if flags > 0xFF or not flags:
+        return struct.pack('<H', flags | rsync_client.XMIT_EXTENDED_FLAGS) + data
+    return chr(flags) + data
+
+
+class FakeDaemon(object):
+    """Serves one connection, sending a script and recording what it gets."""
+
+    def __init__(self, script):
+        self.script = script
+        self.received = ''
+        self._server = socket.socket()
+        self._server.bind(('127.0.0.1', 0))
+        self._server.listen(1)
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _serve(self):
+        connection, _ = self._server.accept()
+        connection.sendall(self.script)
+        connection.shutdown(socket.SHUT_WR)
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            self.received += data
+        connection.close()
+        self._server.close()
+
+    def join(self):
+        self._thread.join(5)
+
+
+def greeting(version='31.0', motd=''):
+    return '@RSYNCD: %s\n%s@RSYNCD: OK\n' % (version, motd)
+
+
+class TestRsyncClient(unittest.TestCase):
+
+    def list_files(self, script, **kwargs):
+        daemon = FakeDaemon(script)
+        try:
+            return rsync_client.list_files('127.0.0.1', daemon.port,
+                                           'iupui_ndt', **kwargs)
+        finally:
+            daemon.join()
+            self.received = daemon.received
+
+    def test_list_files(self):
+        file_list = (
+            entry('.', 4096, 1507800000, DIRECTORY_MODE) +
+            entry('2017', 4096, 1507800001, DIRECTORY_MODE,
+                  rsync_client.XMIT_SAME_MODE) +
+            entry('2017/10', 4096, 0, DIRECTORY_MODE,
+                  rsync_client.XMIT_SAME_NAME | rsync_client.XMIT_SAME_TIME |
+                  rsync_client.XMIT_SAME_MODE, prefix_length=4) +
+            entry('2017/10/12/test1.gz', 3 * 2**31, 1507800002, FILE_MODE,
+                  rsync_client.XMIT_SAME_NAME, prefix_length=7) +
+            chr(0))
+        script = (greeting(motd='Welcome\n') + struct.pack('<i', 12345) +
+                  message(file_list[:10]) +
+                  message('rsync: some files vanished\n',
+                          rsync_client.MSG_WARNING) +
+                  message(file_list[10:]))
+        files = self.list_files(script, filters=['+ /2017/', '- *.tmp'])
+        self.assertEqual(
+            [rsync_client.FileListEntry('2017', 4096, 1507800001,
+                                        DIRECTORY_MODE),
+             rsync_client.FileListEntry('2017/10', 4096, 1507800001,
+                                        DIRECTORY_MODE),
+             rsync_client.FileListEntry('2017/10/12/test1.gz', 3 * 2**31,
+                                        1507800002, FILE_MODE)],
+            files)
+        self.assertEqual(
+            '@RSYNCD: 29.0\niupui_ndt\n'
+            '--server\n--sender\n-rt\n.\niupui_ndt/\n\n' +
+            struct.pack('<i', 8) + '+ /2017/' + struct.pack('<i', 7) +
+            '- *.tmp' + struct.pack('<i', 0), self.received)
+
+    def test_list_files_with_long_names_and_extended_flags(self):
+        name = 'x' * 300
+        file_list = (
+            entry(name, 1, 1507800000, FILE_MODE,
+                  rsync_client.XMIT_LONG_NAME | 1 << 9) +
+            chr(0))
+        script = (greeting() + struct.pack('<i', 1) + message(file_list))
+        self.assertEqual(
+            [rsync_client.FileListEntry(name, 1, 1507800000, FILE_MODE)],
+            self.list_files(script, path='2017/10/12/'))
+        self.assertIn('iupui_ndt/2017/10/12/\n\n', self.received)
+
+    def test_list_files_old_protocol(self):
+        with self.assertRaises(rsync_client.RsyncProtocolError):
+            self.list_files('@RSYNCD: 28.0\n')
+
+    def test_list_files_not_a_daemon(self):
+        with self.assertRaises(rsync_client.RsyncProtocolError):
+            self.list_files('SSH-2.0-OpenSSH_7.4\n')
+
+    def test_list_files_unknown_module(self):
+        with self.assertRaisesRegexp(rsync_client.RsyncProtocolError,
+                                     'Unknown module'):
+            self.list_files('@RSYNCD: 31.0\n'
+                            '@ERROR: Unknown module \'iupui_ndt\'\n')
+
+    def test_list_files_password_required(self):
+        with self.assertRaisesRegexp(rsync_client.RsyncProtocolError,
+                                     'password'):
+            self.list_files('@RSYNCD: 31.0\n@RSYNCD: AUTHREQD abcdef\n')
+
+    def test_list_files_reports_the_error_before_the_connection_closed(self):
+        script = (greeting() + struct.pack('<i', 1) +
+                  message('rsync: change_dir failed: No such file\n',
+                          rsync_client.MSG_ERROR))
+        with self.assertRaisesRegexp(rsync_client.RsyncProtocolError,
+                                     'change_dir failed'):
+            self.list_files(script)
+
+    def test_list_files_connection_refused(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        port = server.getsockname()[1]
+        server.close()
+        with self.assertRaises(socket.error):
+            rsync_client.list_files('127.0.0.1', port, 'iupui_ndt')
+
+    def test_list_files_connects_over_the_family(self):
+        daemon = FakeDaemon(greeting() + struct.pack('<i', 0) +
+                            message(chr(0)))
+        try:
+            # localhost may resolve to ::1 first, where nothing listens.
+            files = rsync_client.list_files('localhost', daemon.port,
+                                            'iupui_ndt', family=socket.AF_INET,
+                                            connect_timeout=5)
+        finally:
+            daemon.join()
+        self.assertEqual(files, [])
+        with self.assertRaises(socket.error):
+            rsync_client.list_files('127.0.0.1', daemon.port, 'iupui_ndt',
+                                    family=socket.AF_INET6)
+
+
+class TestRsyncClientWithDaemon(unittest.TestCase):
+    """Compares the listing with that of rsync, served by a real daemon.
+
+    The daemon is the one that run_tests_with_emulator.sh starts, serving
+    /tmp/iupui_ndt as the module iupui_ndt on port 7999.  Each test lists a
+    directory of its own within the module, with the filters that the
+    scraper lists with.
+    """
+
+    def setUp(self):
+        try:
+            socket.create_connection(('127.0.0.1', 7999), 1).close()
+        except socket.error:
+            self.skipTest('No rsync daemon on 127.0.0.1:7999')
+        self.root = tempfile.mkdtemp(dir='/tmp/iupui_ndt')
+        # The daemon may serve files as nobody.
+        os.chmod(self.root, 0755)
+        self.url = 'rsync://127.0.0.1:7999/iupui_ndt/%s/' % os.path.basename(
+            self.root)
+        for day, count in (('2017/10/12', 1000), ('2017/10/13', 10),
+                           ('2017/11/01', 10)):
+            os.makedirs(os.path.join(self.root, day))
+            for index in range(count):
+                with open(os.path.join(self.root, day, 'test%04d.gz' % index),
+                          'w') as test_file:
+                    test_file.write('x' * index)
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def rsync_list(self, filter_args):
+        """Returns the (name, size) of every entry rsync itself lists."""
+        output = subprocess.check_output(
+            ['rsync', '--list-only', '-r'] + filter_args + [self.url])
+        listed = set()
+        for line in output.splitlines():
+            fields = line.split()
+            if fields[-1] != '.':
+                listed.add((fields[-1], int(fields[1].replace(',', ''))))
+        return listed
+
+    def assert_agrees_with_rsync(self, filter_args):
+        entries = scraper._list_in_process(self.url, filter_args)
+        self.assertEqual(self.rsync_list(filter_args),
+                         set((entry.name, entry.size) for entry in entries))
+        for entry in entries:
+            local = os.stat(os.path.join(self.root, entry.name))
+            self.assertEqual(int(local.st_mtime), entry.mtime)
+            self.assertEqual(local.st_mode, entry.mode)
+        return entries
+
+    def test_list_files_agrees_with_rsync(self):
+        entries = self.assert_agrees_with_rsync([])
+        # 1020 files in six directories.
+        self.assertEqual(len(entries), 1026)
+
+    def test_list_days_agrees_with_rsync(self):
+        self.assert_agrees_with_rsync(['--exclude=/*/*/*/*'])
+        self.assertEqual(
+            sorted(scraper.list_rsync_days_in_process(self.url)),
+            ['2017/10/12', '2017/10/13', '2017/11/01'])
+
+    def test_list_files_of_days_agrees_with_rsync(self):
+        days = ['2017/10/12', '2017/11/01']
+        self.assert_agrees_with_rsync(scraper._day_filters(days))
+        files = scraper.list_rsync_files_in_process(self.url, '/nonexistent',
+                                                    days=days)
+        self.assertEqual(len(files), 1010)
+        self.assertEqual(set(remote.filename[:len('YYYY/MM/DD')]
+                             for remote in files), set(days))
+
+
+if __name__ == '__main__':
+    unittest.main()
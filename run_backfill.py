@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This program re-scrapes a range of time from the nodes.
+
+When data is lost after the scraper has uploaded it, the high water mark that
+run_scraper.py keeps has already moved past it, so run_scraper.py will never
+scrape it again.  run_backfill.py downloads, tars and uploads everything with
+an mtime in [--start, --end) once more, putting it in the bucket under
+--bucket_prefix.
+
+It never reads or writes the status that run_scraper.py keeps for its targets
+in Datastore, so it can run alongside the live scrapers, even on the same
+data.  The range is split into UTC days, and the days of every target are
+backfilled in parallel, each in a directory of its own with a high water mark
+of its own, so that many downloads, tarfiles and uploads are under way at
+once.  The rsync slots and bandwidth of a host are shared with the live
+scrapers when --rsync_governor_file is the same.
+
+It takes all the flags that run_scraper.py does, although those that control
+how often to scrape are ignored.
+"""
+
+import argparse
+import copy
+import datetime
+import logging
+import multiprocessing.pool
+import os
+import shutil
+import sys
+
+import retry.api
+
+import run_scraper
+import scraper
+
+# How many times to try the download of a day, and how long to wait before
+# retrying it the first time.  Each wait after that is twice as long.
+DOWNLOAD_TRIES = 3
+DOWNLOAD_RETRY_DELAY = 60
+
+
+def parse_time(text):
+    """Parses a time in UTC, given as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS."""
+    for time_format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(text, time_format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        '%r is not of the form YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS' % text)
+
+
+def parse_cmdline(args):
+    """Parse the commandline arguments.
+
+    Args:
+      args: the command-line arguments, minus the name of the binary
+
+    Returns:
+      the results of ArgumentParser.parse_args
+    """
+    parser = run_scraper.build_parser(
+        'Scrape and upload a range of time again, without touching the high '
+        'water mark of the live scraper.')
+    parser.add_argument(
+        '--start',
+        metavar='TIME',
+        type=parse_time,
+        required=True,
+        help='The start of the range to backfill, in UTC, as YYYY-MM-DD or '
+        'YYYY-MM-DDTHH:MM:SS.  Files with this mtime are backfilled.')
+    parser.add_argument(
+        '--end',
+        metavar='TIME',
+        type=parse_time,
+        required=True,
+        help='The end of the range to backfill, in UTC, as YYYY-MM-DD or '
+        'YYYY-MM-DDTHH:MM:SS.  Files with this mtime are not backfilled.')
+    parser.add_argument(
+        '--bucket_prefix',
+        metavar='PREFIX',
+        default='backfill',
+        help='The directory of --bucket to upload the backfill to.  The '
+        'tarfiles are put in PREFIX/EXPERIMENT/YYYY/MM/DD/.  Default is '
+        'backfill.')
+    parser.add_argument(
+        '--backfill_parallelism',
+        metavar='DAYS',
+        type=int,
+        default=8,
+        help='How many days to backfill at once, across all targets.  '
+        'Default is 8.')
+    parsed = parser.parse_args(args)
+    run_scraper.check_targets(parser, parsed)
+    if parsed.start >= parsed.end:
+        parser.error('--start must be before --end')
+    if parsed.end > datetime.datetime.utcnow() - parsed.data_wait_time:
+        parser.error('--end must be at least --data_wait_time in the past, '
+                     'as newer files may still be written to')
+    return parsed
+
+
+def split_into_days(start, end):
+    """Splits [start, end) into one [start, end) pair for each UTC day."""
+    days = []
+    while start < end:
+        midnight = datetime.datetime.combine(
+            start.date() + datetime.timedelta(days=1), datetime.time())
+        days.append((start, min(midnight, end)))
+        start = midnight
+    return days
+
+
+def remove_files(filenames):
+    """Removes the files that exist."""
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def backfill(args, storage_service, governor, budget, start, end):
+    """Downloads and uploads the data of one target from start to end.
+
+    The data is downloaded to a directory of its own, which is removed once
+    everything in it is uploaded, along with the ListingCache and Quarantine
+    kept next to it.  Were they left behind, they would say that the days
+    were already downloaded, and backfilling the same days again would
+    download nothing.
+
+    Returns:
+      whether the backfill succeeded
+    """
+    rsync_url = 'rsync://{}:{}/{}'.format(args.rsync_host, args.rsync_port,
+                                          args.rsync_module)
+    destination = os.path.join(args.data_dir, 'backfill', args.rsync_host,
+                               args.rsync_module,
+                               start.strftime('%Y%m%dT%H%M%S'))
+    # The tarfiles are kept apart from those of the live scraper, which could
+    # have the same names.
+    args = copy.copy(args)
+    args.tarfile_directory = destination + '.tarfiles'
+    state_files = [destination + scraper.LISTING_CACHE_SUFFIX,
+                   destination + scraper.QUARANTINE_SUFFIX]
+    if not os.path.isdir(destination):
+        # Without the files they describe, they are stale.
+        remove_files(state_files)
+    for directory in (destination, args.tarfile_directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+    status = scraper.BackfillStatus(start)
+    logging.info('Backfilling %s from %s to %s', rsync_url, start, end)
+    try:
+        retry.api.retry_call(
+            scraper.download,
+            (args, rsync_url, status, destination, governor, budget),
+            {'end': end}, exceptions=scraper.RecoverableScraperException,
+            tries=DOWNLOAD_TRIES, delay=DOWNLOAD_RETRY_DELAY, backoff=2)
+        scraper.upload_up_to_date(
+            args, status, destination, storage_service,
+            end - datetime.timedelta(seconds=1), budget=budget,
+            prefix=args.bucket_prefix)
+    except scraper.RecoverableScraperException as error:
+        logging.error('Backfilling %s from %s to %s failed: %s', rsync_url,
+                      start, end, error.message)
+        return False
+    shutil.rmtree(destination)
+    shutil.rmtree(args.tarfile_directory)
+    remove_files(state_files)
+    return True
+
+
+def main(argv):
+    """Backfill every target, and exit with an error if any of it failed."""
+    args = parse_cmdline(argv[1:])
+    scraper.start_tarfile_pool(args.tarfile_processes)
+    scraper.init_logging('%(threadName)s')
+    # The datastore client is never used.
+    _, storage_service = scraper.init_services(args)
+    rsync_governor = None
+    if args.rsync_governor_file:
+        rsync_governor = scraper.RsyncGovernor(
+            args.rsync_governor_file, args.host_bandwidth,
+            args.max_host_rsyncs)
+    budget = scraper.ResourceBudget()
+    jobs = [(target, start, end)
+            for target in run_scraper.target_args(args)
+            for start, end in split_into_days(args.start, args.end)]
+
+    def run(job):
+        target, start, end = job
+        return backfill(target, storage_service, rsync_governor, budget,
+                        start, end)
+
+    pool = multiprocessing.pool.ThreadPool(args.backfill_parallelism)
+    try:
+        results = pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    failures = results.count(False)
+    if failures:
+        sys.exit('%d of %d days failed to backfill' % (failures, len(jobs)))
+    logging.info('Backfilled %d days', len(jobs))
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main(sys.argv)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Copyright 2017 Scraper Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# No docstrings required for tests, and tests need to be methods of classes to
+# aid in organization of tests. Using the 'self' variable is not required.
+#
+# pylint: disable=missing-docstring, no-self-use, too-many-public-methods
+
+import datetime
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import run_backfill
+import scraper
+
+
+class TestRunBackfill(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger().setLevel(logging.WARNING)
+        self.temp_d = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_d)
+
+    def parse(self, *extra_args):
+        return run_backfill.parse_cmdline([
+            '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+            '--data_dir', self.temp_d] + list(extra_args))
+
+    def test_args(self):
+        args = self.parse('--start', '2017-10-01', '--end',
+                          '2017-10-03T12:00:00', '--bucket_prefix', 'lost')
+        self.assertEqual(args.start, datetime.datetime(2017, 10, 1))
+        self.assertEqual(args.end, datetime.datetime(2017, 10, 3, 12))
+        self.assertEqual(args.bucket_prefix, 'lost')
+        self.assertEqual(args.backfill_parallelism, 8)
+        self.assertEqual(args.target,
+                         [('mlab1.dne0t.measurement-lab.org', 'ndt')])
+
+    def test_args_errors(self):
+        with self.assertRaises(SystemExit):
+            self.parse('--start', '2017-10-01')
+        with self.assertRaises(SystemExit):
+            self.parse('--start', '2017-10-02', '--end', '2017-10-01')
+        with self.assertRaises(SystemExit):
+            self.parse('--start', '10/01/2017', '--end', '2017-10-02')
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with self.assertRaises(SystemExit):
+            self.parse('--start', '2017-10-01', '--end', tomorrow.isoformat())
+
+    def test_split_into_days(self):
+        self.assertEqual(
+            run_backfill.split_into_days(datetime.datetime(2017, 10, 1, 12),
+                                         datetime.datetime(2017, 10, 3, 6)),
+            [(datetime.datetime(2017, 10, 1, 12), datetime.datetime(2017, 10, 2)),
+             (datetime.datetime(2017, 10, 2), datetime.datetime(2017, 10, 3)),
+             (datetime.datetime(2017, 10, 3), datetime.datetime(2017, 10, 3, 6))])
+        self.assertEqual(
+            run_backfill.split_into_days(datetime.datetime(2017, 10, 1),
+                                         datetime.datetime(2017, 10, 2)),
+            [(datetime.datetime(2017, 10, 1), datetime.datetime(2017, 10, 2))])
+
+    @mock.patch.object(scraper, 'upload_up_to_date')
+    @mock.patch.object(scraper, 'download')
+    def test_backfill(self, patched_download, patched_upload):
+        args = self.parse('--start', '2017-10-01', '--end', '2017-10-02',
+                          '--rsync_port', '7999')
+        args.rsync_host, args.rsync_module = args.target[0]
+        start = datetime.datetime(2017, 10, 1)
+        end = datetime.datetime(2017, 10, 2)
+
+        def download(download_args, rsync_url, status, destination, _governor,
+                     _budget, end):
+            self.assertEqual(rsync_url,
+                             'rsync://mlab1.dne0t.measurement-lab.org:7999/ndt')
+            self.assertEqual(end, datetime.datetime(2017, 10, 2))
+            self.assertIsInstance(status, scraper.BackfillStatus)
+            self.assertEqual(status.get_last_archived_mtime(),
+                             datetime.datetime(2017, 9, 30, 23, 59, 59))
+            self.assertTrue(os.path.isdir(destination))
+            self.assertTrue(os.path.isdir(download_args.tarfile_directory))
+            # The cache left behind by an earlier backfill was removed.
+            self.assertFalse(os.path.exists(
+                destination + scraper.LISTING_CACHE_SUFFIX))
+            scraper.ListingCache(
+                destination + scraper.LISTING_CACHE_SUFFIX).save()
+            scraper.Quarantine(destination + scraper.QUARANTINE_SUFFIX).save()
+            return 0
+
+        patched_download.side_effect = download
+        stale = os.path.join(self.temp_d, 'backfill',
+                             'mlab1.dne0t.measurement-lab.org', 'ndt',
+                             '20171001T000000' + scraper.LISTING_CACHE_SUFFIX)
+        os.makedirs(os.path.dirname(stale))
+        file(stale, 'w').write('{"2017/10/01": "a"}')
+        self.assertTrue(run_backfill.backfill(args, 'storage', None, None,
+                                              start, end))
+        upload_args = patched_upload.call_args
+        self.assertEqual(upload_args[0][4],
+                         datetime.datetime(2017, 10, 1, 23, 59, 59))
+        self.assertEqual(upload_args[1]['prefix'], 'backfill')
+        self.assertNotEqual(upload_args[0][0].tarfile_directory,
+                            args.tarfile_directory)
+        # Everything was uploaded, so nothing is left behind.
+        self.assertEqual(os.listdir(os.path.join(
+            self.temp_d, 'backfill', 'mlab1.dne0t.measurement-lab.org',
+            'ndt')), [])
+
+    @mock.patch.object(scraper, 'upload_up_to_date')
+    @mock.patch.object(scraper, 'download')
+    def test_backfill_fails(self, patched_download, patched_upload):
+        args = self.parse('--start', '2017-10-01', '--end', '2017-10-02')
+        args.rsync_host, args.rsync_module = args.target[0]
+        patched_download.side_effect = scraper.RecoverableScraperException(
+            'rsync_download', 'failed')
+        with mock.patch.object(run_backfill, 'DOWNLOAD_RETRY_DELAY', 0):
+            self.assertFalse(run_backfill.backfill(
+                args, 'storage', None, None, datetime.datetime(2017, 10, 1),
+                datetime.datetime(2017, 10, 2)))
+        self.assertEqual(patched_download.call_count,
+                         run_backfill.DOWNLOAD_TRIES)
+        self.assertFalse(patched_upload.called)
+
+    @mock.patch.object(run_backfill, 'backfill')
+    @mock.patch.object(scraper, 'init_services')
+    @mock.patch.object(scraper, 'init_logging')
+    def test_main(self, _init_logging, init_services, patched_backfill):
+        init_services.return_value = ('datastore', 'storage')
+        patched_backfill.return_value = True
+        argv = ['run_backfill.py',
+                '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+                '--target', 'mlab2.dne0t.measurement-lab.org/ndt',
+                '--data_dir', self.temp_d,
+                '--start', '2017-10-01', '--end', '2017-10-04']
+        run_backfill.main(argv)
+        # The days are backfilled by several threads at once, which the
+        # mock's call_count does not count reliably.
+        self.assertEqual(len(patched_backfill.call_args_list), 6)
+        self.assertEqual(
+            sorted((call[0][0].rsync_host, call[0][4])
+                   for call in patched_backfill.call_args_list)[:2],
+            [('mlab1.dne0t.measurement-lab.org', datetime.datetime(2017, 10, 1)),
+             ('mlab1.dne0t.measurement-lab.org', datetime.datetime(2017, 10, 2))])
+        for call in patched_backfill.call_args_list:
+            self.assertEqual(call[0][1], 'storage')
+
+        patched_backfill.side_effect = [True, False, True, True, True, True]
+        with self.assertRaises(SystemExit):
+            run_backfill.main(argv)
+
+
+if __name__ == '__main__':
+    unittest.main()
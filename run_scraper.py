@@ -32,16 +32,26 @@ Data that is newer than the high water mark will be uploaded either starting at
 data buffer threshold that was created at least data wait time in the past.  On
 upload, the high water mark is set to the maximum mtime of all uploaded files,
 and all files with mtimes before then are deleted from the buffer.
+
+Many targets (pairs of host and rsync module) can be scraped by one process by
+giving --target once for each of them.  Every target is scraped by its own
+thread, with its own high water mark, data directory and metrics, but the
+number of downloads and uploads running at once is bounded across all of them.
 """
 
 import argparse
+import contextlib
+import copy
 import datetime
+import json
 import logging
+import os
 import random
+import signal
 import sys
+import threading
 import time
 
-import oauth2client.tools
 import prometheus_client
 import retry.api
 import scraper
@@ -52,35 +62,68 @@ import scraper
 RSYNC_RUNS = prometheus_client.Histogram(
     'scraper_rsync_runtime_seconds',
     'How long each rsync download took',
+    ['rsync_host_module'],
     buckets=scraper.TIME_BUCKETS)
 UPLOAD_RUNS = prometheus_client.Histogram(
     'scraper_gcs_upload_runtime_seconds',
     'How long each GCS upload took',
+    ['rsync_host_module'],
     buckets=scraper.TIME_BUCKETS)
 SLEEPS = prometheus_client.Histogram(
     'scraper_sleep_time_seconds',
     'How long we slept between scraper runs (should be an exp distribution)',
+    ['rsync_host_module'],
+    buckets=scraper.TIME_BUCKETS)
+MEAN_WAITS = prometheus_client.Gauge(
+    'scraper_mean_wait_seconds',
+    'The mean of the distribution the next wait between scrapes is drawn from',
+    ['rsync_host_module'])
+JOB_WAITS = prometheus_client.Histogram(
+    'scraper_job_wait_seconds',
+    'How long jobs waited for their turn to run',
+    ['job'],
     buckets=scraper.TIME_BUCKETS)
 # pylint: enable=no-value-for-parameter
+FAILOVER_TIME = prometheus_client.Histogram(
+    'scraper_failover_seconds',
+    'How long a target went unscraped when a standby took it over, from the '
+    'last renewal of the old lease to the taking of the new one',
+    ['rsync_host_module'],
+    buckets=scraper.TIME_BUCKETS)
+RESTART_LOST_TIME = prometheus_client.Histogram(
+    'scraper_restart_lost_seconds',
+    'Time lost to the last shutdown of the scraper, on work that it '
+    'abandoned and must redo, and on the wait from the shutdown to this start',
+    ['cause'],
+    buckets=scraper.TIME_BUCKETS)
 SCRAPER_SUCCESS = prometheus_client.Counter(
     'scraper_success',
     'How many times has the scraper died, how many times has it succeeded?',
-    ['message'])
+    ['rsync_host_module', 'message'])
+LISTING_PREFETCHES = prometheus_client.Counter(
+    'scraper_listing_prefetches',
+    'How many listings were prefetched during uploads, by whether the next '
+    'download used them',
+    ['rsync_host_module', 'result'])
 
 
-def parse_cmdline(args):
-    """Parse the commandline arguments.
+def parse_target(text):
+    """Parses a HOST/MODULE target into a (host, module) pair."""
+    host, _, module = text.partition('/')
+    if not module:
+        raise argparse.ArgumentTypeError(
+            'target %r is not of the form HOST/MODULE' % text)
+    return (scraper.assert_mlab_hostname(host), module)
 
-    Args:
-      args: the command-line arguments, minus the name of the binary
 
-    Returns:
-      the results of ArgumentParser.parse_args
-    """
+def build_parser(description):
+    """Returns an ArgumentParser for every flag of the scraper."""
+    # Imported here, like the cloud libraries in scraper.py, so that merely
+    # importing this module does not pay for oauth2client.
+    import oauth2client.tools
+
     parser = argparse.ArgumentParser(
-        parents=[oauth2client.tools.argparser],
-        description='Repeatedly scrape a single experiment at a site, uploading'
-                    'the results once enough time has passed.')
+        parents=[oauth2client.tools.argparser], description=description)
     parser.add_argument(
         '--expected_wait_time',
         metavar='SECONDS',
@@ -101,14 +144,126 @@ def parse_cmdline(args):
         '--rsync_host',
         metavar='HOST',
         type=scraper.assert_mlab_hostname,
-        required=True,
         help='The host to connect to over rsync')
     parser.add_argument(
         '--rsync_module',
         metavar='MODULE',
         type=str,
-        required=True,
         help='The rsync module to connect to on the server')
+    parser.add_argument(
+        '--target',
+        metavar='HOST/MODULE',
+        type=parse_target,
+        action='append',
+        default=[],
+        help='A host and rsync module to scrape, instead of --rsync_host and '
+        '--rsync_module.  May be given many times, to scrape many targets in '
+        'this one process.')
+    parser.add_argument(
+        '--max_concurrent_downloads',
+        metavar='N',
+        type=int,
+        default=4,
+        help='How many targets may be downloaded from at once (default is 4)')
+    parser.add_argument(
+        '--max_concurrent_uploads',
+        metavar='N',
+        type=int,
+        default=None,
+        help='How many targets may be tarring up and uploading data at once '
+        '(by default, two per CPU of the container\'s CPU quota, or 2 if it '
+        'has none)')
+    parser.add_argument(
+        '--rsync_listing',
+        choices=['binary', 'protocol'],
+        default='binary',
+        help='How to list the files on the rsync server: by running rsync '
+        '(binary), or by speaking the rsync protocol from within the scraper '
+        '(protocol).  Downloads always run rsync.  Default is binary.')
+    parser.add_argument(
+        '--prefetch_listing',
+        action='store_true',
+        help='List the files for the next download in the background while '
+        'uploading, rather than at the start of the next download.')
+    parser.add_argument(
+        '--listing_max_age',
+        metavar='SECONDS',
+        type=float,
+        default=1800,
+        help='How old a prefetched listing may be when the next download '
+        'starts.  An older listing is thrown away, and the files listed '
+        'again.  Default is 1800 seconds.')
+    parser.add_argument(
+        '--shard_count',
+        metavar='SHARDS',
+        type=int,
+        default=1,
+        help='How many shards to split the files of each target into, so '
+        'that as many replicas of the scraper can scrape it at once.  Each '
+        'replica takes a Datastore lease on one shard, and waits for one to '
+        'be free if none is, which makes any extra replicas standbys.  Every '
+        'replica must be given the same --shard_count and --shard_by.  '
+        'Default is 1, which does not shard.')
+    parser.add_argument(
+        '--shard_by',
+        choices=['day', 'filename'],
+        default='filename',
+        help='How to split the files into shards: by a hash of their '
+        'filename, or by the day directory they are in.  Splitting by day '
+        'lets each shard list only its own days, but new files all go into '
+        'the directory of the current day, so it only spreads the load of a '
+        'backlog of many days.  Default is filename.')
+    parser.add_argument(
+        '--standby',
+        action='store_true',
+        help='Only scrape a target while holding the lease on its Datastore '
+        'status, waiting for it to be free first.  Run a second replica with '
+        'this flag, and a data directory of its own, next to one with it, '
+        'and the second takes over as soon as the lease of the first '
+        'expires.')
+    parser.add_argument(
+        '--lease_seconds',
+        metavar='SECONDS',
+        type=float,
+        default=15,
+        help='How long a lease on a shard (see --shard_count) or on the '
+        'status of a target (see --standby) lasts without being renewed, '
+        'after which another replica may take it over.  Leases are renewed '
+        'three times as often.  Default is 15 seconds.')
+    parser.add_argument(
+        '--shutdown_deadline',
+        metavar='SECONDS',
+        type=float,
+        default=25,
+        help='How long to take to shut down on SIGTERM.  Scraping stops '
+        'before the next rsync chunk, tarfile or upload chunk, what was '
+        'uploaded is committed, leases are released, and pending status '
+        'messages are written, but if that takes longer than this, the '
+        'scraper exits anyway.  Keep it below the grace period of the pod.  '
+        'Default is 25 seconds.')
+    parser.add_argument(
+        '--rsync_governor_file',
+        metavar='FILE',
+        default='',
+        help='A file, shared by all the scrapers on this host, in which they '
+        'record their rsync downloads so as to share the host\'s bandwidth.  '
+        'By default each rsync download is limited to 10000 KB/s instead.')
+    parser.add_argument(
+        '--host_bandwidth',
+        metavar='KBYTES_PER_SECOND',
+        type=int,
+        default=10000,
+        help='With --rsync_governor_file, the bandwidth shared by all the '
+        'rsyncs on this host, in KB/s (default is 10000).  Each rsync gets '
+        'an equal part of what the running ones left unclaimed, among the '
+        'free slots of --max_host_rsyncs.')
+    parser.add_argument(
+        '--max_host_rsyncs',
+        metavar='N',
+        type=int,
+        default=4,
+        help='With --rsync_governor_file, how many rsyncs, listings and '
+        'downloads alike, may run at once on this host (default is 4)')
     parser.add_argument(
         '--data_dir',
         metavar='DIR',
@@ -152,6 +307,21 @@ def parse_cmdline(args):
              'datastore entries will be being updated by two independent '
              'scrapers, and then the nodes might delete data before the '
              'authoritative scraper has successfully scraped it off of them.')
+    parser.add_argument(
+        '--status_refresh_interval',
+        metavar='SECONDS',
+        type=float,
+        default=600,
+        help='How long a copy of the datastore entry is used before it is '
+        'read again.  Every update is written through to the copy, so this '
+        'only matters if something else changes the entry (default is 600)')
+    parser.add_argument(
+        '--status_log_interval',
+        metavar='SECONDS',
+        type=float,
+        default=60,
+        help='Logged errors are saved to the datastore entry at most this '
+        'often.  Only the most recent one is kept (default is 60)')
     parser.add_argument(
         '--tar_binary',
         metavar='TAR',
@@ -167,12 +337,69 @@ def parse_cmdline(args):
         required=False,
         help='The maximum number of bytes in an uncompressed tarfile (default '
         'is 100,000,000 = 100 MB)')
+    parser.add_argument(
+        '--max_compressed_size',
+        metavar='SIZE',
+        type=int,
+        default=0,
+        required=False,
+        help='If set, tarfiles are packed to about this many compressed bytes '
+        'each, using compression ratios learned from earlier tarfiles, and '
+        '--max_uncompressed_size is ignored (default is 0 = not set)')
+    parser.add_argument(
+        '--tar_compression',
+        choices=scraper.TAR_COMPRESSION_MODES,
+        default='gzip',
+        help='How to compress tarfiles.  "gzip" (the default) compresses '
+        'everything, like tar cfz.  "gzip-store-compressed" stores members '
+        'that are already compressed instead of compressing them again, '
+        'which uses much less CPU.')
     parser.add_argument(
         '--tarfile_directory',
         metavar='DIRECTORY',
         type=str,
         default='/tmp',
         help='The directory where temporary tarfiles will live')
+    parser.add_argument(
+        '--tarfile_processes',
+        metavar='N',
+        type=int,
+        default=1,
+        help='How many tarfiles to create at once, each in its own process '
+        'of a pool that every target shares (default is 1, which creates '
+        'them one at a time in this process)')
+    parser.add_argument(
+        '--http_pool_size',
+        metavar='SIZE',
+        type=int,
+        default=4,
+        help='The maximum number of concurrent keep-alive HTTP connections '
+        'to Google Cloud Storage (default is 4)')
+    parser.add_argument(
+        '--discovery_cache',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='Where to cache the GCS discovery document between restarts '
+        '(default is storage-v1-discovery.json in --data_dir, which should '
+        'be on a persistent volume)')
+    parser.add_argument(
+        '--checksum_log',
+        metavar='FILE',
+        type=str,
+        default=None,
+        help='The file to which the MD5 checksum of every uploaded tarfile '
+        'is appended (default is checksums.log in --data_dir).  Once it is '
+        'over 10MB, it is moved to the same name plus .1, replacing the '
+        'older checksums there.')
+    parser.add_argument(
+        '--commit_interval',
+        metavar='SECONDS',
+        type=float,
+        default=300,
+        help='While uploading, the high water mark is moved forward and '
+        'uploaded local files are deleted at most this often, as well as '
+        'when the upload ends or fails (default is 300)')
     parser.add_argument(
         '--bucket',
         metavar='BUCKET',
@@ -197,48 +424,509 @@ def parse_cmdline(args):
         type=int,
         help='The volume of data (in bytes) past which we might trigger an '
         'eager upload.  Default is 100MB.')
-    return parser.parse_args(args)
+    parser.add_argument(
+        '--low_disk_watermark',
+        metavar='FRACTION',
+        default=0.2,
+        type=float,
+        help='When less than this fraction of the disk holding --data_dir or '
+        '--tarfile_directory is free, everything that may be uploaded is '
+        'uploaded and deleted, however little data there is.  Default is 0.2; '
+        '0 turns it off.')
+    parser.add_argument(
+        '--critical_disk_watermark',
+        metavar='FRACTION',
+        default=0.05,
+        type=float,
+        help='When less than this fraction of the disk holding --data_dir is '
+        'free, downloads stop until uploads have made room.  Default is 0.05; '
+        '0 turns it off.')
+    return parser
 
 
-def main(argv):
-    """Run scraper.py in an infinite loop."""
-    args = parse_cmdline(argv[1:])
-    rsync_url, status, destination, storage_service = scraper.init(args)
-    prometheus_client.start_http_server(args.metrics_port)
+def check_targets(parser, parsed):
+    """Fills in parsed.target from --rsync_host and --rsync_module if need be.
+
+    Exits with a usage message if the targets are missing or ambiguous.
+    """
+    if not parsed.target:
+        if parsed.rsync_host is None or parsed.rsync_module is None:
+            parser.error('either --target or both --rsync_host and '
+                         '--rsync_module are required')
+        parsed.target = [(parsed.rsync_host, parsed.rsync_module)]
+    elif parsed.rsync_host is not None or parsed.rsync_module is not None:
+        parser.error('--target may not be used with --rsync_host or '
+                     '--rsync_module')
+    if parsed.standby and parsed.shard_count > 1:
+        parser.error('--standby may not be used with --shard_count, as '
+                     'replicas in excess of the shards already stand by')
+
+
+def parse_cmdline(args):
+    """Parse the commandline arguments.
+
+    Args:
+      args: the command-line arguments, minus the name of the binary
+
+    Returns:
+      the results of ArgumentParser.parse_args
+    """
+    parser = build_parser(
+        'Repeatedly scrape a single experiment at a site (or several of '
+        'them), uploading the results once enough time has passed.')
+    parsed = parser.parse_args(args)
+    check_targets(parser, parsed)
+    return parsed
+
+
+def target_args(args):
+    """Returns a copy of the arguments for each target, in --target order.
+
+    Each copy has the rsync_host and rsync_module of its target, so that it
+    can be passed to the functions in scraper which take args.
+    """
+    targets = []
+    for host, module in args.target:
+        target = copy.copy(args)
+        target.rsync_host = host
+        target.rsync_module = module
+        targets.append(target)
+    return targets
+
+
+class Scheduler(object):
+    """Decides when targets are scraped, and bounds how many jobs run at once.
+
+    A download job is an rsync listing and download.  An upload job is the
+    tarring up and uploading of data, which includes the tar processes.  The
+    bounds are shared by all targets.  The rsync governor, if there is one,
+    also bounds rsync downloads across all the scrapers on the host, and the
+    resource budget, if there is one, sizes the work done by each job.
+
+    The wait before each scrape of a target is drawn from an exponential
+    distribution (see scrape()), but the mean of the distribution is adjusted
+    for each target, starting from the expected wait time:
+      - A target that makes new files faster than one rsync download chunk
+        (FILES_PER_RSYNC_DOWNLOAD) per expected wait is scraped that much more
+        often.
+      - A target that made less than one new file per expected wait, over its
+        recent listings, is scraped IDLE_SLOWDOWN times less often.
+      - A target with more local data than the data buffer threshold, or
+        whose high water mark has not moved in STALE_UPLOAD_AGE, is scraped
+        twice as often for each, as data is only uploaded after a scrape.
+    No target is scraped more than MAX_SPEEDUP times as often as expected, and
+    no single wait is longer than MAX_WAIT seconds.
+    """
+
+    MAX_SPEEDUP = 8.0
+    IDLE_SLOWDOWN = 2.0
+    STALE_UPLOAD_AGE = 2 * 24 * 60 * 60
+    MAX_WAIT = 3600
+    # How much the newest listing counts in the moving average of file rates.
+    RATE_WEIGHT = 0.5
+
+    def __init__(self, max_downloads, max_uploads, expected_wait_time=1800,
+                 data_buffer_threshold=100 * 1000 * 1000, rsync_governor=None,
+                 budget=None):
+        self._slots = {
+            'download': threading.BoundedSemaphore(max_downloads),
+            'upload': threading.BoundedSemaphore(max_uploads),
+        }
+        self.rsync_governor = rsync_governor
+        self.budget = budget
+        self._expected_wait_time = expected_wait_time
+        self._data_buffer_threshold = data_buffer_threshold
+        self._lock = threading.Lock()
+        self._targets = {}
+
+    @contextlib.contextmanager
+    def job(self, kind):
+        """Runs the body of a `with` statement once a slot is free."""
+        slot = self._slots[kind]
+        with JOB_WAITS.labels(job=kind).time():
+            slot.acquire()
+        try:
+            yield
+        finally:
+            slot.release()
+
+    def _target(self, target):
+        if target not in self._targets:
+            self._targets[target] = {'files_per_second': None,
+                                     'listed': None,
+                                     'backlog': 0,
+                                     'uploaded': time.time()}
+        return self._targets[target]
+
+    def record_listing(self, target, new_files):
+        """Records how many new files a scrape of the target found."""
+        now = time.time()
+        with self._lock:
+            state = self._target(target)
+            if state['listed'] is not None and now > state['listed']:
+                rate = float(new_files) / (now - state['listed'])
+                if state['files_per_second'] is not None:
+                    rate = (self.RATE_WEIGHT * rate + (1 - self.RATE_WEIGHT) *
+                            state['files_per_second'])
+                state['files_per_second'] = rate
+            state['listed'] = now
+
+    def record_backlog(self, target, backlog_bytes):
+        """Records how much of the target's data is waiting to be uploaded."""
+        with self._lock:
+            self._target(target)['backlog'] = backlog_bytes
+
+    def record_upload(self, target):
+        """Records that the target's high water mark just moved forward."""
+        with self._lock:
+            self._target(target)['uploaded'] = time.time()
+
+    def mean_wait(self, target):
+        """Returns the mean wait before the target's next scrape."""
+        with self._lock:
+            state = self._target(target)
+            factor = 1.0
+            if state['files_per_second'] is not None:
+                files_per_wait = (state['files_per_second'] *
+                                  self._expected_wait_time)
+                if files_per_wait < 1:
+                    factor = self.IDLE_SLOWDOWN
+                elif files_per_wait > scraper.FILES_PER_RSYNC_DOWNLOAD:
+                    factor = (float(scraper.FILES_PER_RSYNC_DOWNLOAD) /
+                              files_per_wait)
+            if state['backlog'] > self._data_buffer_threshold:
+                factor /= 2
+            if time.time() - state['uploaded'] > self.STALE_UPLOAD_AGE:
+                factor /= 2
+        return self._expected_wait_time * max(factor, 1 / self.MAX_SPEEDUP)
+
+    def wait_time(self, target):
+        """Returns a random wait before the target's next scrape."""
+        mean = self.mean_wait(target)
+        MEAN_WAITS.labels(rsync_host_module=target).set(mean)
+        return min(random.expovariate(1.0 / mean), self.MAX_WAIT)
+
+
+class ListingPrefetch(threading.Thread):
+    """Lists the files for the next download of a target in the background.
+
+    The listing runs rsync against the same server as a download does, so it
+    takes a download slot of the Scheduler, and its rsyncs take slots of the
+    rsync governor, if there is one.  The thread is named for the rsync url,
+    like the thread that scrapes the target, so that its errors are recorded
+    in the status of the target (see scraper.SyncStatusLogHandler).
+    """
+
+    def __init__(self, args, rsync_url, status, destination, scheduler):
+        super(ListingPrefetch, self).__init__(name=rsync_url)
+        self.daemon = True
+        self._list_args = (args, rsync_url, status, destination)
+        self._scheduler = scheduler
+        self._listing = None
+
+    def run(self):
+        try:
+            with self._scheduler.job('download'):
+                self._listing = scraper.list_remote(
+                    *self._list_args, governor=self._scheduler.rsync_governor)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Prefetching the listing failed')
+
+    def result(self, max_age):
+        """Waits for the listing, and returns it unless it is too old.
+
+        Returns:
+          the scraper.Listing, or None if it failed or is older than max_age
+          seconds, in which case the files must be listed again
+
+        Raises:
+          scraper.ScraperShutdown if a shutdown is requested while the listing
+          is still running, which is then left to the daemon thread
+        """
+        while self.is_alive():
+            # Polled, so that a slow listing does not hold up a shutdown.
+            scraper.SHUTDOWN.check()
+            self.join(1)
+        label = scraper.rsync_host_module(self._list_args[0])
+        if self._listing is None:
+            LISTING_PREFETCHES.labels(rsync_host_module=label,
+                                      result='failed').inc()
+            return None
+        age = (datetime.datetime.utcnow() -
+               self._listing.time).total_seconds()
+        if age > max_age:
+            logging.info('The prefetched listing is %g seconds old, so the '
+                         'files will be listed again', age)
+            LISTING_PREFETCHES.labels(rsync_host_module=label,
+                                      result='stale').inc()
+            return None
+        LISTING_PREFETCHES.labels(rsync_host_module=label,
+                                  result='used').inc()
+        return self._listing
+
+
+def scrape(args, rsync_url, status, destination, storage_service,
+           scheduler, start_time):
+    """Scrapes one target until it has run args.num_runs times.
+
+    With args.standby, the lease on the status of the target is taken first,
+    waiting for as long as another scraper holds it, and the scrape stops
+    with a NonRecoverableScraperException as soon as the lease is lost,
+    before it downloads or uploads anything more (see
+    scraper.SyncStatus.check_lease()).  With args.prefetch_listing, the files
+    for each download are listed while the previous upload runs.
+    """
+    label = scraper.rsync_host_module(args)
+    if args.standby:
+        holder = scraper.lease_holder_name()
+        logging.info('Standing by to scrape %s as %s', rsync_url, holder)
+        failover_time = scraper.wait_for_lease(status, holder,
+                                               args.lease_seconds)
+        if failover_time is not None:
+            logging.warning('Took over %s after %g seconds', rsync_url,
+                            failover_time)
+            FAILOVER_TIME.labels(rsync_host_module=label).observe(
+                failover_time)
+        scraper.LeaseRenewer(status, holder, args.lease_seconds).start()
     # First, clear out any existing cache that can be cleared.
-    with UPLOAD_RUNS.time():
-        # Upload except for the most recent day on disk.
-        retry.api.retry_call(scraper.upload_stale_disk,
-                             (args, status, destination, storage_service),
-                             exceptions=scraper.RecoverableScraperException)
+    with scraper.STARTUP_PHASE_TIME.labels(phase='stale_upload').time():
+        with scheduler.job('upload'):
+            with UPLOAD_RUNS.labels(rsync_host_module=label).time():
+                # Upload except for the most recent day on disk.
+                retry.api.retry_call(
+                    scraper.upload_stale_disk,
+                    (args, status, destination, storage_service,
+                     scheduler.budget),
+                    exceptions=scraper.RecoverableScraperException)
+    scraper.STARTUP_PHASE_TIME.labels(phase='time_to_first_rsync').observe(
+        time.time() - start_time)
     # Now, download then upload until we run out of num_runs
+    prefetch = None
     while args.num_runs > 0:
+        scraper.SHUTDOWN.check()
+        status.check_lease()
         try:
             logging.info('Scraping %s', rsync_url)
-            with RSYNC_RUNS.time():
-                scraper.download(args, rsync_url, status, destination)
-            with UPLOAD_RUNS.time():
-                scraper.upload_if_allowed(args, status, destination,
-                                          storage_service)
-            SCRAPER_SUCCESS.labels(message='success').inc()
+            listing = None
+            if prefetch is not None:
+                listing = prefetch.result(args.listing_max_age)
+                prefetch = None
+            with scheduler.job('download'):
+                with RSYNC_RUNS.labels(rsync_host_module=label).time():
+                    new_files = scraper.download(args, rsync_url, status,
+                                                 destination,
+                                                 scheduler.rsync_governor,
+                                                 scheduler.budget,
+                                                 listing=listing)
+            scheduler.record_listing(label, new_files)
+            if args.prefetch_listing:
+                prefetch = ListingPrefetch(args, rsync_url, status,
+                                           destination, scheduler)
+                prefetch.start()
+            high_water_mark = status.get_last_archived_mtime()
+            with scheduler.job('upload'):
+                with UPLOAD_RUNS.labels(rsync_host_module=label).time():
+                    scraper.upload_if_allowed(args, status, destination,
+                                              storage_service,
+                                              scheduler.budget)
+            if status.get_last_archived_mtime() > high_water_mark:
+                scheduler.record_upload(label)
+            SCRAPER_SUCCESS.labels(rsync_host_module=label,
+                                   message='success').inc()
         except scraper.RecoverableScraperException as error:
             logging.error('Scrape and upload failed: %s', error.message)
-            SCRAPER_SUCCESS.labels(message=str(error.prometheus_label)).inc()
+            SCRAPER_SUCCESS.labels(rsync_host_module=label,
+                                   message=str(error.prometheus_label)).inc()
+        scheduler.record_backlog(label, scraper.local_data_size(destination))
         # In order to prevent a thundering herd of rsync jobs, we spread the
         # jobs around in a memoryless way.  By choosing our inter-job sleep
         # time from an exponential distribution, we ensure that the resulting
         # time distribution of jobs is Poisson, the one and only memoryless
-        # distribution.  The denominator of the fraction in the code below is
-        # the mean sleep time in seconds.
+        # distribution.  The scheduler picks the mean of the distribution
+        # for each target, based on how busy it is.
         #
         # That said, don't sleep for more than an hour.
-        sleep_time = min(random.expovariate(1.0 / args.expected_wait_time),
-                         3600)
+        sleep_time = scheduler.wait_time(label)
         logging.info('Sleeping for %g seconds', sleep_time)
-        with SLEEPS.time():
-            time.sleep(sleep_time)
+        with SLEEPS.labels(rsync_host_module=label).time():
+            scraper.SHUTDOWN.sleep(sleep_time)
         args.num_runs -= 1
 
 
+class ScrapeThread(threading.Thread):
+    """Scrapes one of several targets, remembering how it failed, if it did."""
+
+    def __init__(self, name, scrape_args):
+        super(ScrapeThread, self).__init__(name=name)
+        self.daemon = True
+        self._scrape_args = scrape_args
+        self.exc_info = None
+
+    def run(self):
+        try:
+            scrape(*self._scrape_args)
+        except scraper.ScraperShutdown:
+            logging.info('Scraping stopped for the shutdown')
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Scraping stopped')
+            self.exc_info = sys.exc_info()
+
+
+# The file in --data_dir which the time lost to a shutdown is written to, to
+# be exported by the next start.
+SHUTDOWN_RECORD = 'shutdown.json'
+
+
+def save_shutdown_record(args):
+    """Writes when the shutdown began, and how much work it abandoned."""
+    record = {'time': scraper.SHUTDOWN.request_time,
+              'lost': scraper.SHUTDOWN.lost_time()}
+    filename = os.path.join(args.data_dir, SHUTDOWN_RECORD)
+    with open(filename + '.tmp', 'w') as record_file:
+        json.dump(record, record_file)
+    os.rename(filename + '.tmp', filename)
+
+
+def report_last_shutdown(args, start_time):
+    """Exports the time lost to the last shutdown, if it saved a record."""
+    filename = os.path.join(args.data_dir, SHUTDOWN_RECORD)
+    if not os.path.exists(filename):
+        return
+    try:
+        with open(filename) as record_file:
+            record = json.load(record_file)
+        lost = float(record['lost'])
+        downtime = max(start_time - float(record['time']), 0)
+    except (IOError, ValueError, KeyError, TypeError) as error:
+        logging.warning('Ignoring bad shutdown record %s: %s', filename,
+                        error)
+    else:
+        logging.info('The last shutdown abandoned %g seconds of work, and '
+                     'was %g seconds ago', lost, downtime)
+        RESTART_LOST_TIME.labels(cause='abandoned_work').observe(lost)
+        RESTART_LOST_TIME.labels(cause='downtime').observe(downtime)
+    os.remove(filename)
+
+
+def exit_at_deadline(args):
+    """Exits right away, as the shutdown took too long."""
+    logging.error('Could not shut down within %g seconds, exiting anyway',
+                  args.shutdown_deadline)
+    try:
+        save_shutdown_record(args)
+    finally:
+        os._exit(1)  # pylint: disable=protected-access
+
+
+def handle_sigterm(args):
+    """Shuts down gracefully on SIGTERM, as Kubernetes asks pods to.
+
+    The handler asks every scraper thread to stop (see scraper.Shutdown), and
+    exits at args.shutdown_deadline if they have not stopped by then.
+    """
+
+    def handler(_signum, _frame):
+        if scraper.SHUTDOWN.requested.is_set():
+            return
+        logging.warning('SIGTERM received, shutting down within %g seconds',
+                        args.shutdown_deadline)
+        scraper.SHUTDOWN.request()
+        deadline = threading.Timer(args.shutdown_deadline, exit_at_deadline,
+                                   (args,))
+        deadline.daemon = True
+        deadline.start()
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def finish_shutdown(args):
+    """Finishes shutting down once the scraper threads have stopped.
+
+    The pending status messages are written while the leases are still held,
+    as the writes of a scraper without its lease fail, then the leases are
+    handed over, and the time lost to the shutdown saved for the next start
+    to export.  Writing the messages may only take half of what is left of
+    args.shutdown_deadline, so that there is time to hand the leases over.
+    """
+    remaining = (scraper.SHUTDOWN.request_time + args.shutdown_deadline -
+                 time.time())
+    flush_deadline = time.time() + max(0, remaining / 2)
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, scraper.SyncStatusLogHandler):
+            handler.flush(max(0, flush_deadline - time.time()))
+        else:
+            handler.flush()
+    scraper.SHUTDOWN.finish()
+    save_shutdown_record(args)
+    logging.info('Shut down after %g seconds',
+                 time.time() - scraper.SHUTDOWN.request_time)
+
+
+def main(argv):
+    """Run scraper.py in an infinite loop, or until SIGTERM."""
+    start_time = time.time()
+    args = parse_cmdline(argv[1:])
+    # Forked before any thread starts, see scraper.start_tarfile_pool().
+    scraper.start_tarfile_pool(args.tarfile_processes)
+    report_last_shutdown(args, start_time)
+    handle_sigterm(args)
+    targets = target_args(args)
+    rsync_governor = None
+    if args.rsync_governor_file:
+        rsync_governor = scraper.RsyncGovernor(
+            args.rsync_governor_file, args.host_bandwidth,
+            args.max_host_rsyncs)
+    budget = scraper.ResourceBudget()
+    max_uploads = args.max_concurrent_uploads
+    if max_uploads is None:
+        max_uploads = budget.upload_concurrency(2)
+    scheduler = Scheduler(args.max_concurrent_downloads, max_uploads,
+                          args.expected_wait_time, args.data_buffer_threshold,
+                          rsync_governor, budget)
+    if len(targets) == 1:
+        with scraper.STARTUP_PHASE_TIME.labels(phase='init').time():
+            rsync_url, status, destination, storage_service = scraper.init(
+                targets[0])
+        prometheus_client.start_http_server(args.metrics_port)
+        try:
+            scrape(targets[0], rsync_url, status, destination,
+                   storage_service, scheduler, start_time)
+        except scraper.ScraperShutdown:
+            logging.info('Scraping stopped for the shutdown')
+            finish_shutdown(args)
+        return
+
+    # Each target is scraped by a thread named for its rsync url.
+    threads = []
+    with scraper.STARTUP_PHASE_TIME.labels(phase='init').time():
+        scraper.init_logging('%(threadName)s')
+        datastore_service, storage_service = scraper.init_services(args)
+        # The status of every target is read in one batch.
+        status_batch = scraper.SyncStatusBatch(
+            datastore_service, [], args.status_refresh_interval)
+        for target in targets:
+            rsync_url = 'rsync://{}:{}/{}'.format(
+                target.rsync_host, target.rsync_port, target.rsync_module)
+            _, status, destination = scraper.init_target(
+                target, datastore_service, thread_name=rsync_url,
+                status_batch=status_batch)
+            threads.append(ScrapeThread(
+                rsync_url, (target, rsync_url, status, destination,
+                            storage_service, scheduler, start_time)))
+    prometheus_client.start_http_server(args.metrics_port)
+    for thread in threads:
+        thread.start()
+    # A target that stops with an exception stops the whole process, just as
+    # it would if it were the only target.
+    while threads:
+        for thread in threads:
+            thread.join(1)
+            if thread.exc_info is not None:
+                raise thread.exc_info[0], thread.exc_info[1], thread.exc_info[2]
+        threads = [thread for thread in threads if thread.is_alive()]
+    if scraper.SHUTDOWN.requested.is_set():
+        finish_shutdown(args)
+
+
 if __name__ == '__main__':  # pragma: no cover
     main(sys.argv)
@@ -19,12 +19,18 @@
 # pylint: disable=missing-docstring, no-self-use, too-many-public-methods
 
 import datetime
+import logging
 import os
 import shutil
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-import apiclient
+import apiclient.discovery
 import mock
 import requests
 import testfixtures
@@ -71,6 +77,342 @@ class TestRunScraper(unittest.TestCase):
         self.assertEqual(args.num_runs, float('inf'))
         self.assertEqual(args.timeout_binary, '/usr/bin/timeout')
 
+    def test_args_targets(self):
+        args = run_scraper.parse_cmdline([
+            '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+            '--target', 'ndt.iupui.mlab2.dne0t.measurement-lab.org/iupui_ndt',
+            '--data_dir', '/tmp/bigplaceforbackup'])
+        targets = run_scraper.target_args(args)
+        self.assertEqual(
+            [(target.rsync_host, target.rsync_module) for target in targets],
+            [('mlab1.dne0t.measurement-lab.org', 'ndt'),
+             ('ndt.iupui.mlab2.dne0t.measurement-lab.org', 'iupui_ndt')])
+        self.assertEqual(targets[1].data_dir, '/tmp/bigplaceforbackup')
+        args = run_scraper.parse_cmdline([
+            '--rsync_host', 'mlab1.dne0t.measurement-lab.org',
+            '--rsync_module', 'ndt', '--data_dir', '/tmp'])
+        self.assertEqual(args.target,
+                         [('mlab1.dne0t.measurement-lab.org', 'ndt')])
+
+    def test_args_targets_errors(self):
+        for bad_args in (
+                [],
+                ['--rsync_host', 'mlab1.dne0t.measurement-lab.org'],
+                ['--target', 'mlab1.dne0t.measurement-lab.org'],
+                ['--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+                 '--rsync_module', 'ndt']):
+            with self.assertRaises(SystemExit):
+                with testfixtures.OutputCapture() as _:
+                    run_scraper.parse_cmdline(['--data_dir', '/tmp'] +
+                                              bad_args)
+
+    def test_args_standby(self):
+        args = run_scraper.parse_cmdline([
+            '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+            '--data_dir', '/tmp', '--standby'])
+        self.assertTrue(args.standby)
+        self.assertEqual(args.lease_seconds, 15)
+        with self.assertRaises(SystemExit):
+            with testfixtures.OutputCapture() as _:
+                run_scraper.parse_cmdline([
+                    '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+                    '--data_dir', '/tmp', '--standby', '--shard_count', '2'])
+
+    @mock.patch.object(run_scraper, 'RESTART_LOST_TIME')
+    def test_shutdown_record(self, patched_lost_time):
+        temp_d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_d)
+        args = run_scraper.parse_cmdline([
+            '--target', 'mlab1.dne0t.measurement-lab.org/ndt',
+            '--data_dir', temp_d])
+        self.assertEqual(args.shutdown_deadline, 25)
+        # Nothing is reported without a record.
+        run_scraper.report_last_shutdown(args, 1000)
+        self.assertFalse(patched_lost_time.labels.called)
+        shutdown = scraper.Shutdown()
+        shutdown.request_time = 900
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown), \
+                mock.patch.object(shutdown, 'lost_time', return_value=12.5):
+            run_scraper.save_shutdown_record(args)
+        run_scraper.report_last_shutdown(args, 1000)
+        self.assertEqual(
+            [(call[1]['cause'], observe[0][0]) for call, observe in zip(
+                patched_lost_time.labels.call_args_list,
+                patched_lost_time.labels.return_value.observe.call_args_list)],
+            [('abandoned_work', 12.5), ('downtime', 100)])
+        self.assertEqual(os.listdir(temp_d), [])
+
+    def test_finish_shutdown_flushes_before_handing_over_leases(self):
+        temp_d = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_d)
+        args = mock.Mock(shutdown_deadline=25, data_dir=temp_d)
+        events = []
+        shutdown = scraper.Shutdown()
+        shutdown.request()
+        shutdown.request_time = time.time() - 5
+        shutdown.at_exit(lambda: events.append('release'))
+        handler = scraper.SyncStatusLogHandler(mock.Mock())
+        self.addCleanup(handler.close)
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown), \
+                mock.patch.object(handler, 'flush',
+                                  side_effect=lambda timeout: events.append(
+                                      ('flush', timeout))):
+            with testfixtures.LogCapture() as _:
+                # LogCapture takes the place of the other handlers.
+                logging.getLogger().addHandler(handler)
+                try:
+                    run_scraper.finish_shutdown(args)
+                finally:
+                    logging.getLogger().removeHandler(handler)
+        self.assertEqual(events[-1], 'release')
+        flush, timeout = events[0]
+        self.assertEqual(flush, 'flush')
+        # Half of the 20 seconds left before the deadline.
+        self.assertLessEqual(timeout, 10)
+        self.assertGreater(timeout, 9)
+
+    @mock.patch.object(run_scraper.threading, 'Timer')
+    def test_sigterm_requests_shutdown(self, patched_timer):
+        args = mock.Mock(shutdown_deadline=25)
+        shutdown = scraper.Shutdown()
+        self.addCleanup(signal.signal, signal.SIGTERM,
+                        signal.getsignal(signal.SIGTERM))
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            run_scraper.handle_sigterm(args)
+            with testfixtures.LogCapture() as _:
+                os.kill(os.getpid(), signal.SIGTERM)
+                os.kill(os.getpid(), signal.SIGTERM)
+        self.assertTrue(shutdown.requested.is_set())
+        # The deadline is only set once.
+        patched_timer.assert_called_once_with(
+            25, run_scraper.exit_at_deadline, (args,))
+        patched_timer.return_value.start.assert_called_once_with()
+
+    @mock.patch.object(scraper, 'list_remote')
+    def test_listing_prefetch(self, patched_list):
+        args = mock.Mock(rsync_host='mlab1.dne0t.measurement-lab.org',
+                         rsync_module='ndt')
+        listing = scraper.Listing(
+            datetime.datetime.utcnow() - datetime.timedelta(seconds=10), {},
+            [], [])
+        scheduler = run_scraper.Scheduler(1, 1, rsync_governor='governor')
+        free_slots = []
+
+        def list_remote(*_args, **_kwargs):
+            # The listing holds the only download slot.
+            # pylint: disable=protected-access
+            free_slots.append(scheduler._slots['download'].acquire(False))
+            # pylint: enable=protected-access
+            return listing
+
+        patched_list.side_effect = list_remote
+        prefetch = run_scraper.ListingPrefetch(args, 'rsync://a', 'status',
+                                               'destination', scheduler)
+        prefetch.start()
+        self.assertIs(prefetch.result(60), listing)
+        patched_list.assert_called_once_with(args, 'rsync://a', 'status',
+                                             'destination',
+                                             governor='governor')
+        self.assertEqual(free_slots, [False])
+        self.assertIsNone(prefetch.result(5))
+
+        patched_list.side_effect = scraper.RecoverableScraperException(
+            'rsync_listing', 'failed')
+        prefetch = run_scraper.ListingPrefetch(args, 'rsync://a', 'status',
+                                               'destination', scheduler)
+        # Its errors are recorded in the status of the target.
+        self.assertEqual(prefetch.name, 'rsync://a')
+        with testfixtures.LogCapture() as _:
+            prefetch.start()
+            self.assertIsNone(prefetch.result(60))
+
+    @mock.patch.object(scraper, 'list_remote')
+    def test_listing_prefetch_gives_up_for_shutdown(self, patched_list):
+        args = mock.Mock(rsync_host='mlab1.dne0t.measurement-lab.org',
+                         rsync_module='ndt')
+        release = threading.Event()
+        self.addCleanup(release.set)
+        patched_list.side_effect = lambda *_args, **_kwargs: release.wait()
+        shutdown = scraper.Shutdown()
+        shutdown.request()
+        prefetch = run_scraper.ListingPrefetch(
+            args, 'rsync://a', 'status', 'destination',
+            run_scraper.Scheduler(1, 1))
+        prefetch.start()
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            with self.assertRaises(scraper.ScraperShutdown):
+                prefetch.result(60)
+        self.assertTrue(prefetch.is_alive())
+
+    @mock.patch.object(scraper, 'list_remote')
+    def test_listing_prefetch_errors_go_to_the_target_status(self,
+                                                             patched_list):
+        args = mock.Mock(rsync_host='mlab1.dne0t.measurement-lab.org',
+                         rsync_module='ndt')
+        patched_list.side_effect = scraper.RecoverableScraperException(
+            'rsync_listing', 'failed')
+        status = mock.Mock()
+        handler = scraper.SyncStatusLogHandler(status, thread_name='rsync://a')
+        self.addCleanup(handler.close)
+        prefetch = run_scraper.ListingPrefetch(args, 'rsync://a', status,
+                                               'destination',
+                                               run_scraper.Scheduler(1, 1))
+        with testfixtures.LogCapture() as _:
+            # LogCapture takes the place of the other handlers.
+            logging.getLogger().addHandler(handler)
+            try:
+                prefetch.start()
+                self.assertIsNone(prefetch.result(60))
+                handler.flush()
+            finally:
+                logging.getLogger().removeHandler(handler)
+        self.assertIn('Prefetching the listing failed',
+                      status.update_debug_message.call_args[0][0])
+
+    @mock.patch.object(scraper, 'list_remote')
+    def test_listing_prefetch_does_not_hold_up_uploads(self, patched_list):
+        args = mock.Mock(rsync_host='mlab1.dne0t.measurement-lab.org',
+                         rsync_module='ndt')
+        scheduler = run_scraper.Scheduler(1, 1)
+        listing_started = threading.Event()
+        uploaded = threading.Event()
+        uploaded_while_listing = []
+
+        def list_remote(*_args, **_kwargs):
+            # The listing holds the only download slot until the upload is
+            # done.
+            listing_started.set()
+            uploaded_while_listing.append(uploaded.wait(5))
+
+        patched_list.side_effect = list_remote
+        prefetch = run_scraper.ListingPrefetch(args, 'rsync://a', 'status',
+                                               'destination', scheduler)
+        prefetch.start()
+        listing_started.wait(5)
+        with scheduler.job('upload'):
+            uploaded.set()
+        prefetch.join(5)
+        self.assertEqual(uploaded_while_listing, [True])
+        # The download slot is free again for the next download.
+        with scheduler.job('download'):
+            pass
+
+    def test_scheduler_bounds_jobs(self):
+        scheduler = run_scraper.Scheduler(2, 1)
+        lock = threading.Lock()
+        running = []
+        most_running = []
+
+        def job():
+            with scheduler.job('download'):
+                with lock:
+                    running.append(1)
+                    most_running.append(len(running))
+                time.sleep(0.05)
+                with lock:
+                    running.pop()
+
+        threads = [threading.Thread(target=job) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(most_running), 2)
+
+    @mock.patch.object(run_scraper.time, 'time')
+    def test_scheduler_adjusts_mean_wait(self, patched_time):
+        patched_time.return_value = 1000000
+        scheduler = run_scraper.Scheduler(1, 1, expected_wait_time=1800,
+                                          data_buffer_threshold=100)
+        self.assertEqual(scheduler.mean_wait('idle'), 1800)
+        self.assertEqual(scheduler.mean_wait('busy'), 1800)
+
+        # Fewer than one file per expected wait slows scrapes down.
+        scheduler.record_listing('idle', 0)
+        scheduler.record_listing('busy', 0)
+        patched_time.return_value += 1800
+        scheduler.record_listing('idle', 0)
+        self.assertEqual(scheduler.mean_wait('idle'), 3600)
+
+        # Four download chunks per expected wait speeds them up fourfold.
+        scheduler.record_listing(
+            'busy', 4 * scraper.FILES_PER_RSYNC_DOWNLOAD)
+        self.assertEqual(scheduler.mean_wait('busy'), 450)
+
+        # As does a backlog, and a high water mark that has not moved, up to
+        # the maximum speedup.
+        scheduler.record_backlog('busy', 101)
+        self.assertEqual(scheduler.mean_wait('busy'), 225)
+        patched_time.return_value += 3 * 24 * 60 * 60
+        self.assertEqual(scheduler.mean_wait('busy'), 225)
+        scheduler.record_upload('busy')
+        scheduler.record_backlog('busy', 100)
+        self.assertEqual(scheduler.mean_wait('busy'), 450)
+
+    @mock.patch.object(run_scraper.random, 'expovariate')
+    def test_scheduler_wait_time_is_bounded(self, patched_expovariate):
+        scheduler = run_scraper.Scheduler(1, 1, expected_wait_time=600)
+        patched_expovariate.return_value = 10
+        self.assertEqual(scheduler.wait_time('target'), 10)
+        patched_expovariate.assert_called_once_with(1.0 / 600)
+        patched_expovariate.return_value = 100000
+        self.assertEqual(scheduler.wait_time('target'), 3600)
+
+    @mock.patch.object(run_scraper.prometheus_client, 'start_http_server')
+    @mock.patch.object(run_scraper, 'scrape')
+    @mock.patch.object(scraper, 'init_target')
+    @mock.patch.object(scraper, 'init_services')
+    @mock.patch.object(scraper, 'init_logging')
+    def test_main_with_many_targets(self, _init_logging, init_services,
+                                    init_target, patched_scrape, _server):
+        init_services.return_value = ('datastore', 'storage')
+        init_target.side_effect = lambda target, *_args, **_kwargs: (
+            None, 'status', target.rsync_module)
+        scraped = []
+        patched_scrape.side_effect = lambda *args: scraped.append(
+            (threading.current_thread().name, args[3]))
+        run_scraper.main([
+            'run_scraper', '--data_dir', '/tmp',
+            '--target', 'mlab1.dne0t.measurement-lab.org/one',
+            '--target', 'mlab2.dne0t.measurement-lab.org/two'])
+        self.assertEqual(sorted(scraped), [
+            ('rsync://mlab1.dne0t.measurement-lab.org:7999/one', 'one'),
+            ('rsync://mlab2.dne0t.measurement-lab.org:7999/two', 'two')])
+        self.assertEqual(init_services.call_count, 1)
+        self.assertEqual(
+            [call[1]['thread_name'] for call in init_target.call_args_list],
+            ['rsync://mlab1.dne0t.measurement-lab.org:7999/one',
+             'rsync://mlab2.dne0t.measurement-lab.org:7999/two'])
+        batches = set(call[1]['status_batch']
+                      for call in init_target.call_args_list)
+        self.assertEqual(len(batches), 1)
+
+    @mock.patch.object(run_scraper.prometheus_client, 'start_http_server')
+    @mock.patch.object(run_scraper, 'scrape')
+    @mock.patch.object(scraper, 'init_target')
+    @mock.patch.object(scraper, 'init_services')
+    @mock.patch.object(scraper, 'init_logging')
+    def test_main_with_many_targets_fails_when_one_does(
+            self, _init_logging, init_services, init_target, patched_scrape,
+            _server):
+        init_services.return_value = ('datastore', 'storage')
+        init_target.return_value = (None, 'status', 'destination')
+        patched_scrape.side_effect = scraper.NonRecoverableScraperException(
+            'label', 'failed')
+        with testfixtures.LogCapture() as _:
+            with self.assertRaises(scraper.NonRecoverableScraperException):
+                run_scraper.main([
+                    'run_scraper', '--data_dir', '/tmp',
+                    '--target', 'mlab1.dne0t.measurement-lab.org/one',
+                    '--target', 'mlab2.dne0t.measurement-lab.org/two'])
+
+    def test_import_does_not_load_oauth2client(self):
+        loaded = subprocess.check_output([
+            sys.executable, '-c',
+            'import sys, run_scraper; '
+            'print sorted(m for m in sys.modules if m.startswith("oauth2"))'])
+        self.assertEqual(loaded.strip(), '[]')
+
     def test_args_help(self):
         with self.assertRaises(SystemExit):
             with testfixtures.OutputCapture() as _:
@@ -141,9 +483,14 @@ class EndToEndWithFakes(unittest.TestCase):
         # Make an entirely mocked storage service
         self.mock_storage = mock.MagicMock()
         discovery_build_patcher = mock.patch.object(
-            apiclient.discovery, 'build', return_value=self.mock_storage)
+            apiclient.discovery, 'build_from_document',
+            return_value=self.mock_storage)
         discovery_build_patcher.start()
         self.addCleanup(discovery_build_patcher.stop)
+        discovery_doc_patcher = mock.patch.object(
+            scraper, 'load_discovery_document', return_value='{}')
+        discovery_doc_patcher.start()
+        self.addCleanup(discovery_doc_patcher.stop)
 
         class FakeProgress(object):
             def __init__(self, status):
@@ -214,7 +561,8 @@ class EndToEndWithFakes(unittest.TestCase):
             '--max_uncompressed_size', '1024'])
 
         # Verify that the storage service received the files
-        tgzfiles = os.listdir(self.cloud_upload_dir)
+        tgzfiles = [name for name in os.listdir(self.cloud_upload_dir)
+                    if name.endswith('.tgz')]
         self.assertEqual(len(tgzfiles), 2)
 
     @mock.patch('time.sleep')
@@ -235,7 +583,8 @@ class EndToEndWithFakes(unittest.TestCase):
             '--max_uncompressed_size', '1024'])
 
         # Verify that the storage service received the file
-        tgzfiles = os.listdir(self.cloud_upload_dir)
+        tgzfiles = [name for name in os.listdir(self.cloud_upload_dir)
+                    if name.endswith('.tgz')]
         self.assertEqual(len(tgzfiles), 1)
 
     @mock.patch.object(scraper, 'download')
@@ -325,7 +674,8 @@ class EndToEndWithFakes(unittest.TestCase):
         self.assertLess(value['maxrawfilemtimearchived'], time_since_epoch)
 
         # Verify that the storage service received one file
-        tgzfiles = os.listdir(self.cloud_upload_dir)
+        tgzfiles = [name for name in os.listdir(self.cloud_upload_dir)
+                    if name.endswith('.tgz')]
         self.assertEqual(len(tgzfiles), 1)
 
 
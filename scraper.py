@@ -24,29 +24,47 @@ This program expects to be run on GCE and uses cloud APIs with the default
 credentials available to a GCE instance.
 """
 
+import base64
 import collections
 import contextlib
+import ctypes
+import ctypes.util
 import datetime
+import functools
+import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import Queue
 import re
+import signal
+import socket
+import stat
 import subprocess
+import tarfile
 import tempfile
+import threading
+import time
+import zlib
 
-import apiclient
-import googleapiclient.errors
+import fasteners
+import httplib2
 import prometheus_client
 import retry
+import retry.api
 
-from oauth2client.contrib import gce
+import rsync_client
 
-# pylint: disable=no-name-in-module
-import google.cloud.datastore as cloud_datastore
-# pylint: enable=no-name-in-module
+# The Google cloud client libraries (apiclient, googleapiclient, oauth2client
+# and google.cloud.datastore) take seconds to import, so they are imported
+# inside the functions that use them instead of here.  That way nothing pays
+# for them until they are actually needed.
 
 
-# Three kinds of exception, a base and two that contain hints about what can be
-# done next.
+# Four kinds of exception, a base, two that contain hints about what can be
+# done next, and one that stops the scraper on its way out.
 class ScraperException(Exception):
     """Base class for exceptions in scraper."""
 
@@ -54,6 +72,11 @@ class ScraperException(Exception):
         super(ScraperException, self).__init__(message)
         self.prometheus_label = prometheus_label
 
+    def __reduce__(self):
+        # Lets exceptions raised in tarfile worker processes be re-raised in
+        # the main process.
+        return (self.__class__, (self.prometheus_label, self.args[0]))
+
 
 class RecoverableScraperException(ScraperException):
     """Exceptions where it is better to retry than crash."""
@@ -63,6 +86,14 @@ class NonRecoverableScraperException(ScraperException):
     """Exceptions where it is better to crash than retry."""
 
 
+class ScraperShutdown(ScraperException):
+    """The scraper is shutting down, so no new work may be started."""
+
+    def __init__(self, prometheus_label='shutdown',
+                 message='The scraper is shutting down'):
+        super(ScraperShutdown, self).__init__(prometheus_label, message)
+
+
 # Prometheus histogram buckets are web-response-sized by default, with lots of
 # sub-second buckets and very few multi-second buckets.  We need to change them
 # to rsync-download-sized, with lots of multi-second buckets up to even a
@@ -76,7 +107,7 @@ TIME_BUCKETS = (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0,
 BYTES_UPLOADED = prometheus_client.Counter(
     'scraper_bytes_uploaded',
     'Total bytes uploaded to GCS',
-    ['bucket'])
+    ['bucket', 'rsync_host_module'])
 FILES_UPLOADED = prometheus_client.Counter(
     'scraper_files_uploaded',
     'Total file count of the test files uploaded to GCS',
@@ -86,23 +117,81 @@ FILES_UPLOADED = prometheus_client.Counter(
 RSYNC_LIST_FILES_RUNS = prometheus_client.Histogram(
     'scraper_rsync_list_runtime_seconds',
     'How long each rsync list-files op took',
+    ['rsync_host_module'],
     buckets=TIME_BUCKETS)
+RSYNC_LIST_DAYS_RUNS = prometheus_client.Histogram(
+    'scraper_rsync_list_days_runtime_seconds',
+    'How long each rsync listing of the day directories took',
+    ['rsync_host_module'],
+    buckets=TIME_BUCKETS)
+RSYNC_DAYS_LISTED = prometheus_client.Counter(
+    'scraper_rsync_days_listed',
+    'Day directories on the server, by whether their files were listed in '
+    'full or known from the listing cache',
+    ['listing'])
+RSYNC_QUARANTINED_FILES = prometheus_client.Counter(
+    'scraper_rsync_quarantined_files',
+    'Files that rsync kept failing to download, and which were set aside '
+    'so that the other files could be downloaded')
+RSYNC_ABANDONED_FILES = prometheus_client.Counter(
+    'scraper_rsync_abandoned_files',
+    'Quarantined files that were given up on, after failing to download '
+    'every time they were released, and which will never be uploaded')
+LEASE_RENEWALS = prometheus_client.Counter(
+    'scraper_lease_renewals',
+    'Attempts to renew the Datastore lease on a shard, by how they went',
+    ['result'])
 RSYNC_FILE_CHUNK_DOWNLOADS = prometheus_client.Histogram(
     'scraper_rsync_chunk_download_runtime_seconds',
     'How long each rsync download of a 1000-file chunk took',
+    ['rsync_host_module'],
     buckets=TIME_BUCKETS)
 TARFILE_CREATION_TIME = prometheus_client.Histogram(
     'scraper_per_tarfile_creation_runtime_seconds',
     'How long it took to make each tarfile',
+    ['rsync_host_module'],
     buckets=TIME_BUCKETS)
 TARFILE_UPLOAD_TIME = prometheus_client.Histogram(
     'scraper_per_tarfile_upload_time_seconds',
     'How long it took to upload each tarfile',
+    ['rsync_host_module'],
     buckets=TIME_BUCKETS)
 TARFILE_CHUNK_UPLOAD_TIME = prometheus_client.Histogram(
     'scraper_tarfile_chunk_upload_time_seconds',
-    'How long it took to upload each tarfile chunk')
+    'How long it took to upload each tarfile chunk',
+    ['rsync_host_module'])
+RSYNC_SLOT_WAITS = prometheus_client.Histogram(
+    'scraper_rsync_slot_wait_seconds',
+    'How long each rsync download waited for a slot on the host',
+    buckets=TIME_BUCKETS)
 # pylint: enable=no-value-for-parameter
+RSYNC_BANDWIDTH_LIMIT = prometheus_client.Gauge(
+    'scraper_rsync_bwlimit_kbytes_per_second',
+    'The --bwlimit given to the most recent rsync download')
+# Startup phases are measured in (sub-)seconds rather than minutes.
+STARTUP_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0,
+                   300.0, 600.0, float('inf'))
+STARTUP_PHASE_TIME = prometheus_client.Histogram(
+    'scraper_startup_phase_runtime_seconds',
+    'How long each phase of scraper startup took',
+    ['phase'],
+    buckets=STARTUP_BUCKETS)
+HTTP_CONNECTIONS_OPENED = prometheus_client.Counter(
+    'scraper_http_connections_opened',
+    'How many new TCP/TLS connections (handshakes) the HTTP pool has made',
+    ['scheme'])
+RESOURCE_BUDGET = prometheus_client.Gauge(
+    'scraper_resource_budget',
+    'The container limits, and how much work is done at once to fit them',
+    ['budget'])
+DISK_FREE_FRACTION = prometheus_client.Gauge(
+    'scraper_disk_free_fraction',
+    'The fraction of the filesystem holding each directory that is free',
+    ['directory'])
+HTTP_REQUESTS = prometheus_client.Counter(
+    'scraper_http_requests',
+    'HTTP requests made through the pool, by whether the connection was reused',
+    ['connection'])
 
 
 def assert_mlab_hostname(hostname):
@@ -145,9 +234,8 @@ RSYNC_ARGS = ['-4', '-az', '--bwlimit=10000', '--timeout=300',
 RemoteFile = collections.namedtuple('RemoteFile', ['filename', 'mtime'])
 
 
-@RSYNC_LIST_FILES_RUNS.time()
 def list_rsync_files(timeout_binary, rsync_binary, rsync_url, destination,
-                     timeout_time='86400'):
+                     timeout_time='86400', days=None, bwlimit=None):
     """Get a list of all files in the rsync module on the server.
 
     Lists all the files we might wish to download from the server. Be
@@ -162,6 +250,10 @@ def list_rsync_files(timeout_binary, rsync_binary, rsync_url, destination,
       destination: the directory to download to
       timeout_time: optional string to pass to timeout - default is '86400',
                     which is 24 hours in seconds
+      days: optional list of the day directories ('YYYY/MM/DD') to list,
+            instead of every directory
+      bwlimit: optional bandwidth limit in KB/s, instead of the one in
+               RSYNC_ARGS
 
     Returns:
       a list of RemoteFile objects
@@ -220,7 +312,9 @@ def list_rsync_files(timeout_binary, rsync_binary, rsync_url, destination,
     command = ([timeout_binary, '-s', 'KILL', '-t', timeout_time] +
                [rsync_binary, '-n', '-vv', '--out-format', '%n %M'] +
                RSYNC_ARGS +
+               (_day_filters(days) if days is not None else []) +
                [rsync_url, destination])
+    command = _with_bwlimit(command, bwlimit)
     logging.info('Listing files on server with the command: %s',
                  ' '.join(command))
     process = subprocess.Popen(command, stdout=subprocess.PIPE,
@@ -274,18 +368,573 @@ def list_rsync_files(timeout_binary, rsync_binary, rsync_url, destination,
     return files
 
 
+def _day_filters(days):
+    """Returns rsync filter arguments that select only the day directories."""
+    parents = set()
+    for day in days:
+        year, month, _ = day.split('/')
+        parents.update(['/%s/' % year, '/%s/%s/' % (year, month)])
+    return (['--include=' + parent for parent in sorted(parents)] +
+            ['--include=/%s/***' % day for day in days] +
+            ['--exclude=*'])
+
+
+# Directories in the output of `rsync --list-only` look like
+#   drwxr-xr-x          4,096 2017/10/12 22:09:38 2017/10/12
+_DAY_DIRECTORY_REGEX = re.compile(
+    r'^d\S*\s+([\d,.]+) (\d{4}/\d\d/\d\d \d\d:\d\d:\d\d) '
+    r'(\d{4}/\d\d/\d\d)/?$')
+
+
+def list_rsync_days(timeout_binary, rsync_binary, rsync_url,
+                    timeout_time='86400', bwlimit=None):
+    """Lists the day directories in the rsync module, but not their files.
+
+    Like list_rsync_files(), the listing is limited to bwlimit KB/s if given.
+
+    Returns:
+      a dict from each day directory ('YYYY/MM/DD') to its signature, a string
+      holding the mtime and size the directory has on the server.  rsync does
+      not report how many entries a directory has, but the mtime changes
+      whenever an entry is added, removed or renamed, and the size grows as
+      entries are added.
+
+    Raises:
+      RecoverableScraperException when rsync doesn't run successfully
+    """
+    # Nothing deeper than a day directory is listed.
+    command = ([timeout_binary, '-s', 'KILL', '-t', timeout_time] +
+               [rsync_binary, '--list-only'] + RSYNC_ARGS +
+               ['--exclude=/*/*/*/*', rsync_url])
+    command = _with_bwlimit(command, bwlimit)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    days = {}
+    for line in process.stdout:
+        match = _DAY_DIRECTORY_REGEX.match(line.strip())
+        if match:
+            size, mtime, day = match.groups()
+            days[day] = '%s %s' % (mtime, size)
+    process.wait()
+    if process.returncode not in (0, 23, 24):
+        message = 'rsync day listing failed (%d): %s' % (process.returncode,
+                                                         process.stderr.read())
+        logging.error(message)
+        raise RecoverableScraperException('rsync_listing', message)
+    logging.info('Found %d day directories on %s', len(days), rsync_url)
+    return days
+
+
+def _split_rsync_url(rsync_url):
+    """Returns the host, port, module and path within it of an rsync:// url."""
+    match = re.match(r'^rsync://([^:/]+)(?::(\d+))?/([^/]+)/?(.*)$',
+                     rsync_url)
+    if not match:
+        raise NonRecoverableScraperException(
+            'rsync_url', 'Bad rsync url: %s' % rsync_url)
+    host, port, module, path = match.groups()
+    return host, int(port or 873), module, path
+
+
+def _rsync_option(name, default):
+    """Returns the value of the --name=VALUE option in RSYNC_ARGS."""
+    for arg in RSYNC_ARGS:
+        if arg.startswith('--%s=' % name):
+            return arg.split('=', 1)[1]
+    return default
+
+
+def _list_in_process(rsync_url, filter_args):
+    """Lists the module with rsync_client, taking rsync filter arguments.
+
+    The connection is made the way RSYNC_ARGS has the rsync binary make it.
+    """
+    host, port, module, path = _split_rsync_url(rsync_url)
+    # --include=PATTERN and --exclude=PATTERN become the rules + PATTERN and
+    # - PATTERN.
+    rules = [('+ ' if arg.startswith('--include=') else '- ') +
+             arg.split('=', 1)[1] for arg in filter_args]
+    try:
+        return rsync_client.list_files(
+            host, port, module, path=path, filters=rules,
+            timeout=int(_rsync_option('timeout', 300)),
+            connect_timeout=int(_rsync_option('contimeout', 300)),
+            family=socket.AF_INET if '-4' in RSYNC_ARGS else socket.AF_UNSPEC)
+    except (rsync_client.RsyncProtocolError, socket.error) as error:
+        message = 'rsync listing failed: %s' % error
+        logging.error(message)
+        raise RecoverableScraperException('rsync_listing', message)
+
+
+def list_rsync_files_in_process(rsync_url, destination, days=None):
+    """Does what list_rsync_files() does, without running rsync.
+
+    Files are left out if a local copy in the destination has the same size
+    and mtime, which is the check that rsync itself makes.
+    """
+    files_regex = re.compile(r'^\d{4}/\d\d/\d\d/.*[^/]$')
+    files = []
+    for entry in _list_in_process(
+            rsync_url, _day_filters(days) if days is not None else []):
+        if not stat.S_ISREG(entry.mode) or not files_regex.match(entry.name):
+            continue
+        try:
+            local = os.stat(os.path.join(destination, entry.name))
+            if (local.st_size == entry.size and
+                    int(local.st_mtime) == entry.mtime):
+                continue
+        except OSError:
+            pass
+        files.append(RemoteFile(
+            entry.name, datetime.datetime.utcfromtimestamp(entry.mtime)))
+    logging.info('Found %d files to download in total', len(files))
+    return files
+
+
+def list_rsync_days_in_process(rsync_url):
+    """Does what list_rsync_days() does, without running rsync."""
+    days = {}
+    for entry in _list_in_process(rsync_url, ['--exclude=/*/*/*/*']):
+        if (stat.S_ISDIR(entry.mode) and
+                re.match(r'^\d{4}/\d\d/\d\d$', entry.name)):
+            days[entry.name] = '%d %d' % (entry.mtime, entry.size)
+    logging.info('Found %d day directories on %s', len(days), rsync_url)
+    return days
+
+
+class ListingCache(object):
+    """Remembers the day directories on the server with nothing to download.
+
+    Once every file listed in a day directory has been downloaded, and none
+    of them was too recent to download, listing that day again finds nothing
+    new until something is added to or removed from it on the server, which
+    changes the directory's signature (see list_rsync_days()).  The cache
+    maps each such day to the signature it had when it was listed, and is
+    kept in a JSON file so that it survives restarts.  A file that is
+    rewritten in place, without a change to its directory, is missed, which
+    is fine for data that is written once.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        try:
+            with open(filename) as cache_file:
+                self._days = json.load(cache_file)
+        except (IOError, ValueError):
+            self._days = {}
+
+    def changed_days(self, days):
+        """Returns, in order, the days that must be listed in full.
+
+        Days which have changed, or which are gone from the server, are
+        forgotten.
+
+        Args:
+          days: the dict returned by list_rsync_days()
+        """
+        self._days = dict((day, signature)
+                          for day, signature in self._days.iteritems()
+                          if days.get(day) == signature)
+        changed = sorted(day for day in days if day not in self._days)
+        RSYNC_DAYS_LISTED.labels(listing='full').inc(len(changed))
+        RSYNC_DAYS_LISTED.labels(listing='cached').inc(len(self._days))
+        return changed
+
+    def remember(self, day, signature):
+        """Records that the day has nothing to download."""
+        self._days[day] = signature
+
+    def save(self):
+        """Writes the cache to its file."""
+        temp_name = self._filename + '.tmp'
+        with open(temp_name, 'w') as cache_file:
+            json.dump(self._days, cache_file)
+        os.rename(temp_name, self._filename)
+
+
+# The ListingCache of a destination directory is kept in a file next to it.
+LISTING_CACHE_SUFFIX = '.listing.json'
+
+
+class Quarantine(object):
+    """Remembers the files that rsync keeps failing to download.
+
+    Quarantined files are left out of downloads for QUARANTINE_TIME, after
+    which they are released and tried again, in case the problem was on the
+    server and has been fixed.  Until they are downloaded, the high water mark
+    must stay below their mtimes, or they would never be downloaded at all,
+    so upload_up_to_date() holds it below oldest_mtime().  A file that is
+    quarantined QUARANTINE_TRIES times is given up on, and counted in
+    RSYNC_ABANDONED_FILES, so that one bad file cannot hold up the rest of the
+    data forever.  Like the ListingCache, the quarantine is kept in a JSON
+    file so that it survives restarts.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        try:
+            with open(filename) as quarantine_file:
+                self._files = json.load(quarantine_file)
+        except (IOError, ValueError):
+            self._files = {}
+
+    def abandoned(self, filename):
+        """Returns whether the file was given up on."""
+        return (filename in self._files and
+                self._files[filename]['tries'] >= QUARANTINE_TRIES)
+
+    def __contains__(self, filename):
+        """Returns whether the file is to be left out of downloads."""
+        if filename not in self._files:
+            return False
+        released = time.time() - QUARANTINE_TIME.total_seconds()
+        return (self.abandoned(filename) or
+                self._files[filename]['time'] > released)
+
+    def add(self, remote_files):
+        """Quarantines the RemoteFiles, or gives up on them."""
+        for remote_file in remote_files:
+            entry = self._files.setdefault(remote_file.filename, {'tries': 0})
+            entry['time'] = time.time()
+            entry['mtime'] = datetime_to_epoch(remote_file.mtime)
+            entry['tries'] += 1
+            if self.abandoned(remote_file.filename):
+                logging.error('Giving up on %s, which rsync failed to '
+                              'download %d times', remote_file.filename,
+                              entry['tries'])
+                RSYNC_ABANDONED_FILES.inc()
+            else:
+                logging.error('Quarantining %s, which rsync failed to '
+                              'download', remote_file.filename)
+                RSYNC_QUARANTINED_FILES.inc()
+
+    def remove(self, filenames):
+        """Forgets the files, which were downloaded or are gone."""
+        for filename in filenames:
+            self._files.pop(filename, None)
+
+    def forget_missing(self, days, filenames):
+        """Forgets the files of the days that a listing of them did not find.
+
+        Args:
+          days: the day directories ('YYYY/MM/DD') that were listed
+          filenames: the names of the files that the listing found
+        """
+        days = set(days)
+        filenames = set(filenames)
+        self.remove([filename for filename in self._files.keys()
+                     if filename[:len('YYYY/MM/DD')] in days and
+                     filename not in filenames])
+
+    def forget_up_to(self, high_water_mark):
+        """Forgets the files that the high water mark has passed.
+
+        Once it has, they would never be downloaded, quarantined or not.
+        """
+        mtime = datetime_to_epoch(high_water_mark)
+        self.remove([filename for filename, entry in self._files.items()
+                     if entry['mtime'] <= mtime])
+
+    def oldest_mtime(self):
+        """Returns the oldest mtime of the files not given up on, or None."""
+        mtimes = [entry['mtime'] for filename, entry in self._files.items()
+                  if not self.abandoned(filename)]
+        if not mtimes:
+            return None
+        return datetime.datetime.utcfromtimestamp(min(mtimes))
+
+    def save(self):
+        """Writes the quarantine to its file."""
+        temp_name = self._filename + '.tmp'
+        with open(temp_name, 'w') as quarantine_file:
+            json.dump(self._files, quarantine_file)
+        os.rename(temp_name, self._filename)
+
+
+# The Quarantine of a destination directory is kept in a file next to it.
+QUARANTINE_SUFFIX = '.quarantine.json'
+QUARANTINE_TIME = datetime.timedelta(days=1)
+QUARANTINE_TRIES = 3
+
+
+def state_filename(destination, shard, suffix):
+    """Returns the name of a file of listing state next to a destination.
+
+    The shards of a target share its destination directory, so that a replica
+    which moves to another shard still uploads the files it has, but each
+    shard keeps its own listing cache and quarantine, which only know of the
+    files of that shard.
+    """
+    if shard is None:
+        return destination + suffix
+    return '%s.shard%dof%d%s' % (destination, shard.index, shard.count, suffix)
+
 # Download files 1000 at a time to help keep rsync memory usage low.
 #    https://rsync.samba.org/FAQ.html#5
 FILES_PER_RSYNC_DOWNLOAD = 1000
 
+# A chunk of files which rsync fails to download is tried this many times in
+# all, waiting RSYNC_RETRY_DELAY seconds before the first retry and twice as
+# long before each retry after it.
+RSYNC_CHUNK_TRIES = 3
+RSYNC_RETRY_DELAY = 10
+
+# The rsync exit codes that can be down to particular files: 11 is an error in
+# file I/O, and 23 a partial transfer due to an error.  A chunk that keeps
+# failing with one of them is split in half, and each half downloaded on its
+# own, until the files to blame are found.  Any other failure, such as being
+# unable to reach the server, would be the same for every file.
+RSYNC_FILE_ERRORS = (11, 23)
+
+
+class RsyncGovernor(object):
+    """Shares bandwidth and rsync slots among all the scrapers on a host.
+
+    Scrapers that share a host (a Kubernetes node, say) also share its link,
+    so a fixed --bwlimit for every rsync in every scraper oversubscribes the
+    link as soon as enough of them run at once.  Instead, every scraper
+    records the rsyncs it runs, listings and downloads alike, in a JSON file
+    on the host, guarded by an interprocess file lock.  At most max_rsyncs
+    rsyncs run at once, and each one is given an equal part of the bandwidth
+    left unclaimed among the slots left free, so that together they never
+    claim more than all of it.
+
+    Rsync fixes its bandwidth limit when it starts, so a share cannot grow
+    when others finish, and the bandwidth of the free slots is kept for those
+    that start while it runs.  Each record is a lease
+    that the running scraper renews, so that the slots of scrapers that died
+    without cleaning up are freed after LEASE_SECONDS.
+    """
+
+    LEASE_SECONDS = 60
+    POLL_SECONDS = 1
+
+    def __init__(self, path, bandwidth, max_rsyncs):
+        """Creates a governor.
+
+        Args:
+          path: the file that records the host's rsyncs
+          bandwidth: the host's total bandwidth for rsync, in KB/s
+          max_rsyncs: how many rsyncs may run at once on the host
+        """
+        self._path = path
+        self._lock = fasteners.InterProcessLock(path + '.lock')
+        self._bandwidth = bandwidth
+        self._max_rsyncs = max_rsyncs
+        self._names = itertools.count()
+
+    def _read(self):
+        """Returns the unexpired rsyncs.  Must be called with the lock held."""
+        try:
+            with open(self._path) as state_file:
+                rsyncs = json.load(state_file)
+        except (IOError, ValueError):
+            return {}
+        now = time.time()
+        return dict((name, rsync) for name, rsync in rsyncs.iteritems()
+                    if rsync['expires'] > now)
+
+    def _write(self, rsyncs):
+        """Replaces the recorded rsyncs.  Must be called with the lock held."""
+        temp_name = self._path + '.tmp'
+        with open(temp_name, 'w') as state_file:
+            json.dump(rsyncs, state_file)
+        os.rename(temp_name, self._path)
+
+    def try_acquire(self, name):
+        """Claims a slot, and returns its bandwidth, or None if none is free."""
+        with self._lock:
+            rsyncs = self._read()
+            unclaimed = self._bandwidth - sum(
+                rsync['bwlimit'] for rsync in rsyncs.itervalues())
+            # Slots claimed under a different --host_bandwidth or
+            # --max_host_rsyncs may leave no bandwidth unclaimed.
+            if len(rsyncs) >= self._max_rsyncs or unclaimed < 1:
+                return None
+            bwlimit = max(unclaimed // (self._max_rsyncs - len(rsyncs)), 1)
+            rsyncs[name] = {'bwlimit': bwlimit,
+                            'expires': time.time() + self.LEASE_SECONDS}
+            self._write(rsyncs)
+            return bwlimit
+
+    def renew(self, name):
+        """Extends the lease on a claimed slot."""
+        with self._lock:
+            rsyncs = self._read()
+            if name in rsyncs:
+                rsyncs[name]['expires'] = time.time() + self.LEASE_SECONDS
+                self._write(rsyncs)
+
+    def release(self, name):
+        """Frees a claimed slot."""
+        with self._lock:
+            rsyncs = self._read()
+            rsyncs.pop(name, None)
+            self._write(rsyncs)
+
+    def _renew_until(self, name, done):
+        """Renews the lease on a slot until the done Event is set."""
+        while not done.wait(self.LEASE_SECONDS / 3):
+            self.renew(name)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """Claims a slot once one is free, and holds it until the block ends.
+
+        Yields:
+          the slot's share of the bandwidth, in KB/s
+
+        Raises:
+          ScraperShutdown if the scraper shuts down while waiting for a slot
+        """
+        name = '%s/%d/%d' % (socket.gethostname(), os.getpid(),
+                             next(self._names))
+        with RSYNC_SLOT_WAITS.time():
+            bwlimit = self.try_acquire(name)
+            while bwlimit is None:
+                SHUTDOWN.sleep(self.POLL_SECONDS)
+                SHUTDOWN.check()
+                bwlimit = self.try_acquire(name)
+        RSYNC_BANDWIDTH_LIMIT.set(bwlimit)
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew_until,
+                                   args=(name, done))
+        renewer.daemon = True
+        renewer.start()
+        try:
+            yield bwlimit
+        finally:
+            done.set()
+            renewer.join()
+            self.release(name)
+
+    def call(self, command):
+        """Runs an rsync command once a slot is free, and returns its exit code.
+
+        The command's --bwlimit is set to the slot's share of the bandwidth.
+        The command runs in a process group of its own, so that if it has to
+        be killed, the rsync that `timeout` runs is killed along with it.
+        """
+        with self.slot() as bwlimit:
+            process = None
+            try:
+                process = subprocess.Popen(_with_bwlimit(command, bwlimit),
+                                           preexec_fn=os.setsid)
+                while process.poll() is None:
+                    time.sleep(self.POLL_SECONDS)
+                return process.returncode
+            finally:
+                if process is not None and process.poll() is None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                    process.wait()
+
+
+@contextlib.contextmanager
+def _governed(governor):
+    """Holds a slot from the governor, if there is one, during the block.
+
+    Yields:
+      the slot's share of the bandwidth, or None if there is no governor
+    """
+    if governor is None:
+        yield None
+    else:
+        with governor.slot() as bwlimit:
+            yield bwlimit
+
+
+def _with_bwlimit(command, bwlimit):
+    """Returns the rsync command with its --bwlimit set to bwlimit, if any."""
+    if bwlimit is None:
+        return command
+    return ['--bwlimit=%d' % bwlimit if arg.startswith('--bwlimit=') else arg
+            for arg in command]
+
+
+def free_space_fraction(directory):
+    """Returns the fraction of the directory's filesystem that is free.
+
+    Only the space available to unprivileged users counts as free, as the
+    space reserved for root is not available to the scraper either.
+    """
+    fs_stat = os.statvfs(directory)
+    fraction = (float(fs_stat.f_bavail) / fs_stat.f_blocks
+                if fs_stat.f_blocks else 1.0)
+    DISK_FREE_FRACTION.labels(directory=directory).set(fraction)
+    return fraction
+
+
+def _run_rsync(command_prefix, rsync_url, filenames, destination, governor):
+    """Runs rsync once to download the files, and returns its exit code."""
+    with tempfile.NamedTemporaryFile() as temp:
+        # Write the list of files to a tempfile, so as not to have to
+        # worry about too-long command lines full of filenames.
+        temp.write('\0'.join(filenames))
+        temp.flush()
+        # Don't crash when ephemeral files disappear.
+        # Filenames in the temp file are null-separated.
+        # The filenames to transfer are in a file.
+        command = command_prefix + ['--from0', '--files-from', temp.name,
+                                    rsync_url, destination]
+        if governor is None:
+            return subprocess.call(command)
+        return governor.call(command)
+
+
+def _download_chunk(command_prefix, rsync_url, filenames, destination,
+                    governor, tries):
+    """Downloads a chunk of files, retrying it and bisecting it as needed.
+
+    Returns:
+      the files to blame for the chunk failing, which were not downloaded
+
+    Raises:
+      RecoverableScraperException if rsync fails in a way that no one file
+      could have caused
+      ScraperShutdown if the scraper shuts down while waiting to retry
+    """
+    delay = RSYNC_RETRY_DELAY
+    for attempt in range(tries):
+        if attempt:
+            logging.warning('Retrying the download of %d files in %d seconds',
+                            len(filenames), delay)
+            SHUTDOWN.sleep(delay)
+            SHUTDOWN.check()
+            delay *= 2
+        with SHUTDOWN.work():
+            error_code = _run_rsync(command_prefix, rsync_url, filenames,
+                                    destination, governor)
+        if error_code in (0, 24):
+            return []
+    message = 'rsync download failed exit code: %d' % error_code
+    logging.error(message)
+    if error_code not in RSYNC_FILE_ERRORS:
+        raise RecoverableScraperException('rsync_download', message)
+    if len(filenames) == 1:
+        return filenames
+    # The retries showed that the failure persists, so each half is only
+    # downloaded once.
+    middle = len(filenames) // 2
+    return (_download_chunk(command_prefix, rsync_url, filenames[:middle],
+                            destination, governor, 1) +
+            _download_chunk(command_prefix, rsync_url, filenames[middle:],
+                            destination, governor, 1))
+
 
 def download_files(timeout_binary, rsync_binary, rsync_url, files, destination,
-                   timeout_time='86400'):
+                   timeout_time='86400', governor=None,
+                   files_per_download=FILES_PER_RSYNC_DOWNLOAD,
+                   min_free_fraction=0, quarantine=None, label='',
+                   check=None):
     """Downloads the files from the server.
 
     The filenames may not be safe for shell interpretation, so make sure
-    they are never interpreted by a shell.  If something goes wrong with
-    the download, exit.
+    they are never interpreted by a shell.  A chunk of files that rsync fails
+    to download is retried with backoff, and if it keeps failing, it is
+    bisected to find the files to blame, which are quarantined so that the
+    rest of the files still get downloaded.  If less than min_free_fraction of
+    the destination's filesystem is free before a chunk of files is
+    downloaded, the rest of the files are left for a later download.
 
     Args:
       timeout_binary: The full path to `timeout`
@@ -295,45 +944,67 @@ def download_files(timeout_binary, rsync_binary, rsync_url, files, destination,
       destination: the directory on the local host to put the files
       timeout_time: optional string to pass to timeout - default is '86400',
                     which is 24 hours in seconds
+      governor: optional RsyncGovernor that shares the host's bandwidth among
+                rsyncs, instead of the fixed limit in RSYNC_ARGS
+      files_per_download: optional number of files to download per rsync
+      min_free_fraction: optional fraction of the disk to always leave free
+      quarantine: optional Quarantine, in which the files that keep failing
+                  to download are put, and from which the files that are
+                  downloaded are removed
+      check: optional function to call before each chunk, which raises an
+             exception to stop the download, such as SyncStatus.check_lease
+
+    Returns:
+      whether all the files were downloaded
+
+    Raises:
+      RecoverableScraperException if rsync keeps failing for a reason other
+      than the files it was asked for
     """
-    # Dates are no longer needed, and we need to iterate over the sequence of
-    # filenames multiple times.
+    # Dates are only needed to quarantine files, and we need to iterate over
+    # the sequence of filenames multiple times.
+    mtimes = dict(files)
     files = [remote.filename for remote in files]
     if not files:
         logging.info('No files to be downloaded from %s', rsync_url)
-        return
+        return True
     # We use the -s option to timeout insted of --signal because not all timeout
     # implementations accept --signal.
     timeout_command_prefix = [timeout_binary, '-s', 'KILL', '-t', timeout_time]
+    # Run rsync inside of timeout, with all the default arguments.
+    command_prefix = timeout_command_prefix + [rsync_binary] + RSYNC_ARGS
+    failed = []
     # Rsync all the files passed in.  Do this piecewise, because rsync allocates
     # a per-file chunk of memory, so long file lists end up causing huge memory
     # usage.
-    for start in range(0, len(files), FILES_PER_RSYNC_DOWNLOAD):
-        with RSYNC_FILE_CHUNK_DOWNLOADS.time():
-            filenames = files[start:start + FILES_PER_RSYNC_DOWNLOAD]
-            with tempfile.NamedTemporaryFile() as temp:
-                # Write the list of files to a tempfile, so as not to have to
-                # worry about too-long command lines full of filenames.
-                temp.write('\0'.join(filenames))
-                temp.flush()
-                # Download all the files.
-                logging.info('Synching %d files (already synched %d/%d)',
-                             len(filenames), start, len(files))
-                # Run rsync inside of timeout.
-                # Use all the default arguments.
-                # Don't crash when ephemeral files disappear.
-                # Filenames in the temp file are null-separated.
-                # The filenames to transfer are in a file.
-                command = (timeout_command_prefix +
-                           [rsync_binary] +
-                           RSYNC_ARGS + ['--from0', '--files-from', temp.name,
-                                         rsync_url, destination])
-                error_code = subprocess.call(command)
-                if error_code not in (0, 24):
-                    message = 'rsync download failed exit code: %d' % error_code
-                    logging.error(message)
-                    raise RecoverableScraperException('rsync_download', message)
+    for start in range(0, len(files), files_per_download):
+        SHUTDOWN.check()
+        if check is not None:
+            check()
+        if (min_free_fraction and
+                free_space_fraction(destination) < min_free_fraction):
+            logging.warning('Less than %g of the disk holding %s is free, so '
+                            'the download stopped after %d/%d files',
+                            min_free_fraction, destination, start, len(files))
+            return False
+        with RSYNC_FILE_CHUNK_DOWNLOADS.labels(rsync_host_module=label).time():
+            filenames = files[start:start + files_per_download]
+            logging.info('Synching %d files (already synched %d/%d)',
+                         len(filenames), start, len(files))
+            chunk_failed = _download_chunk(command_prefix, rsync_url,
+                                           filenames, destination, governor,
+                                           RSYNC_CHUNK_TRIES)
+        failed.extend(chunk_failed)
+        if quarantine is not None:
+            quarantine.add([RemoteFile(filename, mtimes[filename])
+                            for filename in chunk_failed])
+            quarantine.remove(set(filenames) - set(chunk_failed))
+    if failed:
+        logging.error('%d files from %s could not be downloaded', len(failed),
+                      rsync_url)
+        return False
     logging.info('sync completed successfully from %s', rsync_url)
+    return True
 
 
 def must_upload_up_to():
@@ -380,17 +1051,405 @@ def chdir(directory):
         os.chdir(cwd)
 
 
-@TARFILE_CREATION_TIME.time()
-def create_tarfile(tar_binary, tarfile_name, component_files):
-    """Creates a tarfile in the current directory.
+# How much tar output to read from tar at a time.
+TARFILE_READ_CHUNK_SIZE = 1024 * 1024
+
+# The compressor fully flushes its state every GZIP_RESTART_INTERVAL bytes of
+# uncompressed tar data.  Decompression can begin afresh at each of these
+# points, so a reader that wants one member of a tarfile need only fetch the
+# compressed bytes from the restart point preceding that member.  At 1MB the
+# cost in compression ratio is negligible.
+GZIP_RESTART_INTERVAL = 1024 * 1024
+
+# The gzip compression level, which is the same as the default for `tar cfz`.
+GZIP_COMPRESSION_LEVEL = 6
+
+# The manifest for a tarfile lives next to it, both locally and in GCS.
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Ways to compress tarfiles.  'gzip' compresses everything, exactly like
+# `tar cfz`.  'gzip-store-compressed' puts members that are already compressed
+# into stored (uncompressed) deflate blocks instead of compressing them a
+# second time, which saves a lot of CPU for very little size.  Both produce
+# ordinary .tgz files, although the second kind is made of several
+# concatenated gzip members, which gzip and tar handle transparently.
+TAR_COMPRESSION_MODES = ('gzip', 'gzip-store-compressed')
+
+# The leading bytes of gzip, bzip2, xz, zip and zstd files.
+COMPRESSED_MAGIC = ('\x1f\x8b', 'BZh', '\xfd7zXZ\x00', 'PK\x03\x04',
+                    '\x28\xb5\x2f\xfd')
+
+# Already-compressed members smaller than this are compressed along with their
+# neighbours anyway, because starting a new gzip member would cost more than
+# it saves.
+MIN_STORED_MEMBER_SIZE = 16 * 1024
+
+# tar headers that hold metadata (long names, pax attributes) for the header
+# that follows them, rather than being members in their own right.
+_TAR_METADATA_TYPES = (tarfile.GNUTYPE_LONGNAME, tarfile.GNUTYPE_LONGLINK,
+                       tarfile.XHDTYPE, tarfile.XGLTYPE,
+                       tarfile.SOLARIS_XHDTYPE)
+
+# File types whose names end in one of these are named by the extension before
+# it too, so that e.g. "cputime.gz" and "s2c_snaplog.gz" are told apart.
+COMPRESSED_SUFFIXES = ('gz', 'bz2', 'xz', 'zip', 'zst')
+
+
+def file_type(filename):
+    """Returns the part of a filename that says what kind of data it holds.
+
+    That is the extension, or the last two extensions if the last one only
+    says that the file is compressed.  Files without an extension are of type
+    ''.
+    """
+    parts = os.path.basename(filename).split('.')[1:]
+    if len(parts) > 1 and parts[-1] in COMPRESSED_SUFFIXES:
+        return '.'.join(parts[-2:])
+    return parts[-1] if parts else ''
+
+
+class CompressionRatios(object):
+    """Learns how well each type of file compresses, from tarfiles made so far.
+
+    For each file type this keeps the number of compressed and uncompressed
+    bytes observed.  When the uncompressed total for a type passes window
+    bytes, both totals are halved, so the ratio follows the recent data.
+    Types that have never been observed are assumed not to compress at all,
+    which errs on the side of making tarfiles too small rather than too big.
+
+    The compressed size of each member is measured by how much the compressor
+    wrote while the member was being fed to it.  zlib buffers its output, so
+    some of a member's compressed bytes are counted against the members that
+    follow it, but that evens out over many members.  Members which are
+    stored rather than compressed are measured exactly.
+    """
+
+    def __init__(self, window=1024 * 1024 * 1024):
+        self._window = window
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def _add(self, key, compressed_size, uncompressed_size):
+        with self._lock:
+            compressed, uncompressed = self._totals.get(key, (0, 0))
+            compressed += compressed_size
+            uncompressed += uncompressed_size
+            if uncompressed > self._window:
+                compressed /= 2.0
+                uncompressed /= 2.0
+            self._totals[key] = (compressed, uncompressed)
+
+    def observe(self, filename, uncompressed_size, compressed_size):
+        """Records how much one file compressed to."""
+        self._add(file_type(filename), compressed_size, uncompressed_size)
+
+    def ratio(self, filename):
+        """Returns the expected ratio of compressed to uncompressed size."""
+        with self._lock:
+            compressed, uncompressed = self._totals.get(file_type(filename),
+                                                        (0, 0))
+        if not uncompressed:
+            return 1.0
+        return float(compressed) / uncompressed
+
+    def estimate(self, filename, size):
+        """Returns the expected compressed size of a file of the given size."""
+        return self.ratio(filename) * size
+
+    def totals(self):
+        """Returns the compressed and uncompressed totals for each file type."""
+        with self._lock:
+            return dict(self._totals)
+
+    def merge(self, totals):
+        """Adds totals from another CompressionRatios to these ones."""
+        for key, (compressed, uncompressed) in totals.iteritems():
+            self._add(key, compressed, uncompressed)
+
+
+# What this process has learned about the data it tars up.  It is shared by
+# every tarfile made, because the kinds of files an experiment writes, and how
+# well they compress, change very slowly.
+_LEARNED_COMPRESSION_RATIOS = CompressionRatios()
+
+TarMember = collections.namedtuple('TarMember', ['name', 'mtime', 'size',
+                                                 'offset', 'data_offset'])
+
+
+class _IndexingGzipWriter(object):
+    """Gzips data to a file, checksumming it and recording restart points.
+
+    Every restart point is a pair (uncompressed offset, compressed offset).
+    Inflating raw deflate data (zlib wbits=-15) starting at the compressed
+    offset yields the uncompressed data starting at the uncompressed offset.
+    Restart points are made every restart_interval bytes, and whenever the
+    compression level changes, which ends one gzip member and starts another.
+    The first restart point is the start of the deflate data, right after the
+    10-byte gzip header that zlib writes.
+    """
+
+    def __init__(self, output, restart_interval=GZIP_RESTART_INTERVAL,
+                 level=GZIP_COMPRESSION_LEVEL):
+        self._output = output
+        self.default_level = level
+        self._level = level
+        # wbits=31 produces gzip framing rather than zlib framing.
+        self._compressor = zlib.compressobj(self._level, zlib.DEFLATED, 31)
+        self._compressor_input = 0
+        self._restart_interval = restart_interval
+        self._next_restart = restart_interval
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.uncompressed_size = 0
+        self.restart_points = [(0, 10)]
+
+    def _emit(self, data):
+        if data:
+            self.md5.update(data)
+            self._output.write(data)
+            self.size += len(data)
+
+    def set_level(self, level):
+        """Compresses subsequent data at a different zlib level."""
+        if level == self._level:
+            return
+        self._level = level
+        if self._compressor_input:
+            self._emit(self._compressor.flush())
+            self.restart_points.append((self.uncompressed_size,
+                                        self.size + 10))
+            self._next_restart = (self.uncompressed_size +
+                                  self._restart_interval)
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self._compressor_input = 0
+
+    def write(self, data):
+        """Compresses the data, stopping to flush at each restart point."""
+        while data:
+            piece = data[:self._next_restart - self.uncompressed_size]
+            data = data[len(piece):]
+            self._emit(self._compressor.compress(piece))
+            self._compressor_input += len(piece)
+            self.uncompressed_size += len(piece)
+            if self.uncompressed_size == self._next_restart:
+                self._emit(self._compressor.flush(zlib.Z_FULL_FLUSH))
+                self.restart_points.append((self.uncompressed_size,
+                                            self.size))
+                self._next_restart += self._restart_interval
+
+    def close(self):
+        """Writes the remaining compressed data and the gzip trailer."""
+        self._emit(self._compressor.flush())
+
+
+def _read_exactly(stream, size):
+    """Reads size bytes from the stream, or fewer if it ends first."""
+    chunks = []
+    while size > 0:
+        chunk = stream.read(min(size, TARFILE_READ_CHUNK_SIZE))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _pax_path(data):
+    """Returns the path recorded in a pax extended header, if there is one."""
+    path = None
+    try:
+        while data:
+            length, rest = data.split(' ', 1)
+            record = rest[:int(length) - len(length) - 2]
+            data = data[int(length):]
+            key, value = record.split('=', 1)
+            if key == 'path':
+                path = value
+    except ValueError:
+        logging.warning('Malformed pax header: %r', data)
+    return path
+
+
+def compress_tar_stream(stream, writer, store_compressed, ratios=None):
+    """Compresses a tar stream with the writer, listing its members.
+
+    The stream is parsed as it is compressed, so that the offset of every
+    member is known, and so that members which are already compressed can be
+    stored rather than compressed again if store_compressed is True.
+
+    Args:
+      stream: a file-like object from which to read the tar stream
+      writer: the _IndexingGzipWriter to compress the stream with
+      store_compressed: whether to store already-compressed members
+      ratios: a CompressionRatios to tell how well each member compressed
+
+    Returns:
+      a list of TarMember objects for the regular files in the stream, or None
+      if the stream could not be parsed (it is compressed regardless)
+    """
+    members = []
+    header_offset = None
+    long_name = None
+    while True:
+        block = _read_exactly(stream, tarfile.BLOCKSIZE)
+        if header_offset is None:
+            header_offset = writer.uncompressed_size
+        writer.write(block)
+        if len(block) < tarfile.BLOCKSIZE:
+            break
+        try:
+            info = tarfile.TarInfo.frombuf(block)
+        except tarfile.EOFHeaderError:
+            break  # A zero block, which marks the end of the archive.
+        except tarfile.HeaderError as error:
+            logging.warning('Could not parse tar header at offset %d: %s',
+                            writer.uncompressed_size - len(block), error)
+            members = None
+            break
+        padded_size = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        if info.type in _TAR_METADATA_TYPES:
+            data = _read_exactly(stream, padded_size)
+            writer.write(data)
+            if info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data[:info.size].split('\0', 1)[0]
+            elif info.type == tarfile.XHDTYPE:
+                long_name = _pax_path(data[:info.size]) or long_name
+            continue
+        data_offset = writer.uncompressed_size
+        data = _read_exactly(stream, min(padded_size, TARFILE_READ_CHUNK_SIZE))
+        store = (store_compressed and info.isreg() and
+                 info.size >= MIN_STORED_MEMBER_SIZE and
+                 data.startswith(COMPRESSED_MAGIC))
+        if store:
+            writer.set_level(0)
+        compressed_offset = writer.size
+        remaining = padded_size
+        while data:
+            writer.write(data)
+            remaining -= len(data)
+            data = _read_exactly(stream, min(remaining,
+                                             TARFILE_READ_CHUNK_SIZE))
+        if store:
+            writer.set_level(writer.default_level)
+        if info.isreg():
+            name = long_name or info.name
+            if ratios is not None:
+                ratios.observe(name, info.size,
+                               writer.size - compressed_offset)
+            members.append(TarMember(name, int(info.mtime), info.size,
+                                     header_offset, data_offset))
+        header_offset = None
+        long_name = None
+    # Consume the end-of-archive padding, or everything after a header that
+    # could not be parsed.
+    data = stream.read(TARFILE_READ_CHUNK_SIZE)
+    while data:
+        writer.write(data)
+        data = stream.read(TARFILE_READ_CHUNK_SIZE)
+    return members
+
+
+def write_manifest(manifest_name, tarfile_name, members, restart_points):
+    """Writes the manifest that allows random access into a tarfile.
+
+    The manifest is a JSON object that lists, for every file in the tarfile,
+    its name, mtime, size, the offset of its tar header and the offset of its
+    data, all within the uncompressed tar stream.  It also lists the gzip
+    restart points as (uncompressed offset, compressed offset) pairs.  To read
+    a single member, find the last restart point whose uncompressed offset is
+    not after the member's header, range-read the tarfile from that
+    compressed offset, and inflate it as raw deflate data.  Should the
+    deflate data end before the member does, carry on inflating from the next
+    restart point, which is where the next gzip member's deflate data starts.
+
+    Args:
+      manifest_name: the name of the manifest file to write
+      tarfile_name: the name of the tarfile being described
+      members: a sequence of TarMember objects
+      restart_points: a sequence of (uncompressed, compressed) offset pairs
+    """
+    manifest = {
+        'tarfile': os.path.basename(tarfile_name),
+        'member_fields': list(TarMember._fields),
+        'members': [list(member) for member in members],
+        'restart_point_fields': ['uncompressed_offset', 'compressed_offset'],
+        'restart_points': [list(point) for point in restart_points],
+    }
+    with open(manifest_name, 'w') as manifest_file:
+        json.dump(manifest, manifest_file, separators=(',', ':'))
+
+
+# The advice that posix_fadvise() takes on Linux, which says that the data will
+# not be needed again, so its clean pages can be evicted from the page cache.
+POSIX_FADV_DONTNEED = 4
+
+
+def _load_posix_fadvise():
+    """Returns the C library's posix_fadvise(), or None if it has none."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fadvise = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long,
+                        ctypes.c_int]
+    fadvise.restype = ctypes.c_int
+    return fadvise
+
+
+_POSIX_FADVISE = _load_posix_fadvise()
+
+
+def drop_from_page_cache(filename):
+    """Asks the kernel to evict the file's data from the page cache.
+
+    The page cache counts against the container's memory limit, and a file
+    that has been tarred up will not be read again, so keeping it cached only
+    pushes out pages that are still useful.  Dirty pages are not evicted.
+    This does nothing where posix_fadvise() is unavailable or fails.
+    """
+    if _POSIX_FADVISE is None:
+        return
+    try:
+        descriptor = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _POSIX_FADVISE(descriptor, 0, 0, POSIX_FADV_DONTNEED)
+    finally:
+        os.close(descriptor)
+
+
+def create_tarfile(tar_binary, tarfile_name, component_files,
+                   compression='gzip', ratios=None, directory=None,
+                   level=GZIP_COMPRESSION_LEVEL):
+    """Creates a tarfile and its manifest.
+
+    tar produces an uncompressed tar stream, which this process parses (to
+    build the manifest) and gzips (to compute the checksum and the restart
+    points) as it is produced, so no second pass over the data is ever made.
+    The manifest is written to tarfile_name + MANIFEST_SUFFIX.  If the tar
+    stream cannot be parsed, the tarfile is still created, but without a
+    manifest.  Once they are tarred up, the component files are dropped from
+    the page cache.
 
     Args:
       tar_binary: the full path to the tar binary
       tarfile_name: the name of the tarfile to create, including extension
       component_files: a list of filenames to put in that tarfile
+      compression: one of TAR_COMPRESSION_MODES
+      ratios: a CompressionRatios to teach how well the files compressed
+      directory: the directory that component_files are relative to, by
+        default the current directory
+      level: the gzip compression level
+
+    Returns:
+      a tuple of the base64-encoded MD5 digest of the tarfile (which is the
+      form in which GCS accepts and reports md5Hash values) and the name of the
+      manifest, or None if no manifest could be made
 
     Raises:
-      SystemExit if anything fails
+      NonRecoverableScraperException if anything fails
     """
     if os.path.exists(tarfile_name):
         logging.warning('The file %s/%s already exists, which will prevent the '
@@ -399,23 +1458,51 @@ def create_tarfile(tar_binary, tarfile_name, component_files):
                         os.getcwd(), tarfile_name)
         os.remove(tarfile_name)
 
-    command = [tar_binary, 'cfz', tarfile_name, '--null', '--files-from']
-    try:
-        with tempfile.NamedTemporaryFile() as temp:
-            temp.write('\0'.join(component_files))
-            temp.flush()
-            command.append(temp.name)
-            subprocess.check_call(command)
-    except subprocess.CalledProcessError as error:
-        message = 'tarfile creation ("%s") failed: %s' % (' '.join(command),
-                                                          str(error))
+    command = [tar_binary, 'cf', '-']
+    if directory is not None:
+        command.extend(['--directory', directory])
+    command.extend(['--null', '--files-from'])
+    partial_name = tarfile_name + '.partial'
+    manifest_name = tarfile_name + MANIFEST_SUFFIX
+    with tempfile.NamedTemporaryFile() as temp:
+        temp.write('\0'.join(component_files))
+        temp.flush()
+        command.append(temp.name)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            with open(partial_name, 'wb') as output:
+                writer = _IndexingGzipWriter(output, level=level)
+                members = compress_tar_stream(
+                    process.stdout, writer,
+                    compression == 'gzip-store-compressed', ratios)
+                writer.close()
+        finally:
+            process.stdout.close()
+            process.wait()
+    if process.returncode != 0:
+        os.remove(partial_name)
+        message = 'tarfile creation ("%s") failed: exit code %d' % (
+            ' '.join(command), process.returncode)
         logging.error(message)
         raise NonRecoverableScraperException('tar_error', message)
-    if not os.path.exists(tarfile_name):
+    if writer.uncompressed_size == 0:
+        os.remove(partial_name)
         message = ('The tarfile %s/%s was not successfully created' %
                    (os.getcwd(), tarfile_name))
         logging.error(message)
         raise NonRecoverableScraperException('no_tar_file', message)
+    if os.path.exists(manifest_name):
+        os.remove(manifest_name)
+    if members is None:
+        manifest_name = None
+    else:
+        write_manifest(manifest_name, tarfile_name, members,
+                       writer.restart_points)
+    os.rename(partial_name, tarfile_name)
+    for component_file in component_files:
+        drop_from_page_cache(os.path.join(directory or os.curdir,
+                                          component_file))
+    return base64.b64encode(writer.md5.digest()), manifest_name
 
 
 def node_and_site(host):
@@ -434,6 +1521,9 @@ def node_and_site(host):
 
 LocalBufferedFile = collections.namedtuple('LocalBufferedFile',
                                            ['filename', 'mtime', 'size'])
+Tarfile = collections.namedtuple('Tarfile', ['filename', 'min_mtime',
+                                             'max_mtime', 'num_files', 'md5',
+                                             'manifest'])
 
 
 def all_files(directory, high_water_mark, too_recent_timestamp):
@@ -451,9 +1541,9 @@ def all_files(directory, high_water_mark, too_recent_timestamp):
             fullname = os.path.join(root, filename)
             if fullname.startswith('./'):
                 fullname = fullname[2:]
-            stat = os.stat(fullname)
-            mtime = stat.st_mtime
-            size = stat.st_size
+            file_stat = os.stat(fullname)
+            mtime = file_stat.st_mtime
+            size = file_stat.st_size
             if high_water_mark < mtime <= too_recent_timestamp:
                 yield LocalBufferedFile(fullname, mtime, size)
 
@@ -466,11 +1556,16 @@ class TarfileTemplate(object):
     should be coordinated with the pipeline code.
     """
 
-    def __init__(self, tarfile_directory, node, site, experiment):
+    def __init__(self, tarfile_directory, node, site, experiment, shard=0):
         self.tarfile_directory = tarfile_directory
         self.node = node
         self.site = site
         self.experiment = experiment
+        self.shard = shard
+
+    def label(self):
+        """Returns the rsync_host_module label of the tarfiles' target."""
+        return '%s-%s-%s' % (self.node, self.site, self.experiment)
 
     def create_filename(self, mtime):
         """Create a filename for a particular time using the template.
@@ -479,20 +1574,159 @@ class TarfileTemplate(object):
         during the transition period from daily scraper to a more frequent one.
         This code assumes that no two files with the same timestamp will ever
         end up in separate tarfiles, which is a restriction that
-        create_temporary_tarfiles enforces.
+        create_temporary_tarfiles enforces.  When the files of an experiment
+        are split among shards, the suffix is the index of the shard instead,
+        so that tarfiles made by two shards never have the same name.
         """
         mtime = datetime.datetime.utcfromtimestamp(mtime)
         return ('{directory}/{year:04d}{month:02d}{day:02d}T'
                 '{hour:02d}{minute:02d}{second:02d}Z'
-                '-{node}-{site}-{experiment}-0000.tgz').format(
+                '-{node}-{site}-{experiment}-{shard:04d}.tgz').format(
                     directory=self.tarfile_directory,
                     year=mtime.year, month=mtime.month, day=mtime.day,
                     hour=mtime.hour, minute=mtime.minute, second=mtime.second,
-                    node=self.node, site=self.site, experiment=self.experiment)
+                    node=self.node, site=self.site, experiment=self.experiment,
+                    shard=self.shard)
+
+
+def remove_tarfile(tarfile_name, manifest):
+    """Removes a local tarfile and, if there is one, its manifest."""
+    os.remove(tarfile_name)
+    logging.info('Removed local file %s', tarfile_name)
+    if manifest:
+        os.remove(manifest)
+
+
+def plan_tarfiles(local_files, max_size, ratios=None):
+    """Divides files into the contents of successive tarfiles.
+
+    Files are taken in the order given, which should be by mtime, and a new
+    tarfile is begun whenever the next file would take the current one past
+    max_size, unless that file has the same mtime (to the second) as the one
+    before it.  Tarfiles are named for the second of their oldest file, and
+    the high water mark only counts whole seconds, so a second is never split
+    between tarfiles.  The
+    plan is made lazily, so that if ratios are given, the compressed size of
+    each file is estimated using everything learned up until the point the
+    file is planned.
+
+    Args:
+      local_files: a sequence of LocalBufferedFile objects, sorted by mtime
+      max_size: the max size of an individual tarfile
+      ratios: a CompressionRatios, if max_size is a compressed size
+
+    Yields:
+      lists of LocalBufferedFile objects, one for each tarfile
+    """
+    batch = []
+    batch_size = 0
+    for local_file in local_files:
+        size = local_file.size
+        if ratios is not None:
+            size = ratios.estimate(local_file.filename, size)
+        if (batch and batch_size + size > max_size and
+                int(local_file.mtime) != int(batch[-1].mtime)):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(local_file)
+        batch_size += size
+    if batch:
+        yield batch
+
+
+def _create_tarfile_in_worker(tar_binary, tarfile_name, component_files,
+                              compression, directory, level):
+    """Calls create_tarfile in a worker process.
+
+    The worker's own copies of the compression ratios and the prometheus
+    metrics are thrown away with it, so what it learned, and how long it took,
+    are returned along with the md5 and the manifest name.
+    """
+    start = time.time()
+    ratios = CompressionRatios()
+    md5, manifest = create_tarfile(tar_binary, tarfile_name, component_files,
+                                   compression, ratios, directory, level)
+    return md5, manifest, ratios.totals(), time.time() - start
+
+
+# How long to wait for a worker process to make a tarfile.  A worker that
+# died, say of the OOM killer, is replaced, but its tarfile is never made.
+TARFILE_WORKER_TIMEOUT = 3600
+
+# The worker processes that make tarfiles when more than one is asked for.
+# They are forked by start_tarfile_pool() before the scraper starts any other
+# thread, as a process forked while another thread holds a lock (of logging,
+# say) inherits the lock held, and may wait on it forever.
+_TARFILE_POOL = None
+
+
+def start_tarfile_pool(processes):
+    """Forks the worker processes for create_temporary_tarfiles().
+
+    This should be called before any other thread is started.  With one
+    process, tarfiles are made in the calling thread, and nothing is forked.
+    """
+    global _TARFILE_POOL  # pylint: disable=global-statement
+    if processes > 1 and _TARFILE_POOL is None:
+        _TARFILE_POOL = multiprocessing.Pool(processes)
+
+
+def _create_tarfile_timed(label, *args):
+    """Calls create_tarfile, timing it for the target of the label."""
+    with TARFILE_CREATION_TIME.labels(rsync_host_module=label).time():
+        return create_tarfile(*args)
+
+
+def _finish_worker_tarfile(result, ratios, label,
+                           timeout=TARFILE_WORKER_TIMEOUT):
+    """Waits for _create_tarfile_in_worker, returning the md5 and manifest.
+
+    The result is polled, rather than waited on for good, because Python runs
+    no signal handlers while the main thread waits without a timeout.
+    """
+    deadline = time.time() + timeout
+    while not result.ready():
+        if time.time() > deadline:
+            raise RecoverableScraperException(
+                'tarfile_timeout',
+                'No tarfile was made within %d seconds' % timeout)
+        result.wait(1)
+    md5, manifest, totals, seconds = result.get()
+    ratios.merge(totals)
+    TARFILE_CREATION_TIME.labels(rsync_host_module=label).observe(seconds)
+    return md5, manifest
+
+
+def discard_tarfile(tarfile_name):
+    """Removes whatever exists of a tarfile that will not be uploaded."""
+    for name in (tarfile_name, tarfile_name + '.partial',
+                 tarfile_name + MANIFEST_SUFFIX):
+        if os.path.exists(name):
+            os.remove(name)
+            logging.info('Discarded local file %s', name)
+
+
+def _discard_when_made(tarfile_name, result):
+    """Discards a worker's tarfile in the background, once it is made.
+
+    A worker that overran TARFILE_WORKER_TIMEOUT may never finish, so it is
+    abandoned to a daemon thread rather than waited on again.
+    """
+    def discard():
+        result.wait(TARFILE_WORKER_TIMEOUT)
+        discard_tarfile(tarfile_name)
+    thread = threading.Thread(target=discard,
+                              name='discard ' + os.path.basename(tarfile_name))
+    thread.daemon = True
+    thread.start()
 
 
 def create_temporary_tarfiles(tar_binary, tarfile_template, directory,
-                              early_time, late_time, max_uncompressed_size):
+                              early_time, late_time, max_uncompressed_size,
+                              compression='gzip', max_compressed_size=0,
+                              ratios=None, processes=1,
+                              level=GZIP_COMPRESSION_LEVEL):
     """Create tarfiles, and yield the name of each tarfile as it is made.
 
     Creates appropriately-sized tarfiles for each time period.  All files with
@@ -500,6 +1734,19 @@ def create_temporary_tarfiles(tar_binary, tarfile_template, directory,
     bigger than the max_uncompressed_size if more than max_uncompressed_size
     data is written in a single second.
 
+    If max_compressed_size is set, it takes the place of max_uncompressed_size,
+    and tarfiles are cut when the estimated compressed size of their contents
+    would exceed it.  The estimate uses the compression ratio of each type of
+    file, as learned from the tarfiles made before, so the first tarfiles of a
+    run are smaller than they need be.
+
+    With more than one process, several tarfiles are made at once, each in a
+    worker process of its own, but they are still yielded in mtime order, one
+    at a time.  Up to that many tarfiles are planned ahead of the one being
+    yielded, and exist on disk at once.  The worker processes are those of
+    start_tarfile_pool(), which are shared by every thread, and are forked
+    here only if it was not called.
+
     It is difficult to imagine more than max_uncompressed_size bytes of data
     being written to disk every second.  Each NDT test seems to cause a few (3?
     5?) megabytes of data to be written.  An NDT testing rate that causes in
@@ -519,48 +1766,92 @@ def create_temporary_tarfiles(tar_binary, tarfile_template, directory,
       early_time: the time before which we should ignore files
       late_time: the time after which we should ignore files
       max_uncompressed_size: the max size of an individual tarfile
+      compression: how to compress the tarfiles, one of TAR_COMPRESSION_MODES
+      max_compressed_size: the target compressed size of a tarfile, or 0 to
+        limit the uncompressed size instead
+      ratios: the CompressionRatios to estimate with and learn into, by
+        default the ones shared by the whole process
+      processes: how many tarfiles to make at once
+      level: the gzip compression level
 
     Yields:
-      A tuple of the name of the tarfile created, the oldest mtime of the
-      tarfile's component files, the newest mtime of any tarfile's component
-      files, and the number of files in the tarfile.  Also, it creates the
-      tarfile, and then deletes it after the yield resumes.
-    """
-    with chdir(directory):
-        tarfile_size = 0
-        tarfile_files = []
-        tarfile_index = 0
-        min_mtime = float('inf')
-        max_mtime = 0
-        prev_timestamp = None
-
-        for local_file in sorted(all_files('.', early_time, late_time),
-                                 cmp=lambda x, y: cmp(x.mtime, y.mtime)):
-            if (tarfile_files and
-                    tarfile_size + local_file.size > max_uncompressed_size and
-                    local_file.mtime != prev_timestamp):
-                tarfile_name = tarfile_template.create_filename(min_mtime)
-                create_tarfile(tar_binary, tarfile_name, tarfile_files)
-                logging.info('Created local file %s', tarfile_name)
-                yield tarfile_name, min_mtime, max_mtime, len(tarfile_files)
-                os.remove(tarfile_name)
-                logging.info('Removed local file %s', tarfile_name)
-                tarfile_files = []
-                tarfile_size = 0
-                tarfile_index += 1
-                min_mtime = local_file.mtime
-            tarfile_files.append(local_file.filename)
-            tarfile_size += local_file.size
-            prev_timestamp = local_file.mtime
-            min_mtime = min(local_file.mtime, min_mtime)
-            max_mtime = max(local_file.mtime, max_mtime)
-        if tarfile_files:
-            tarfile_name = tarfile_template.create_filename(min_mtime)
-            create_tarfile(tar_binary, tarfile_name, tarfile_files)
+      A Tarfile holding the name of the tarfile created, the oldest mtime of
+      the tarfile's component files, the newest mtime of any tarfile's
+      component files, the number of files in the tarfile, the tarfile's MD5
+      checksum, and the name of the tarfile's manifest (or None).  Also, it
+      creates the tarfile and manifest, and then deletes them after the yield
+      resumes.
+    """
+    if ratios is None:
+        ratios = _LEARNED_COMPRESSION_RATIOS
+    local_files = sorted(all_files(directory, early_time, late_time),
+                         cmp=lambda x, y: cmp(x.mtime, y.mtime))
+    if max_compressed_size:
+        plan = plan_tarfiles(local_files, max_compressed_size, ratios)
+    else:
+        plan = plan_tarfiles(local_files, max_uncompressed_size)
+    # Tuples of (tarfile name, component files, function returning the md5
+    # and manifest name once the tarfile is made, and the worker's result or
+    # None), oldest first.  Whatever is still here when this generator stops
+    # is cleaned up.
+    pending = collections.deque()
+    # Set once a worker overran its timeout, after which the workers are not
+    # waited on again.
+    timed_out = False
+    try:
+        while True:
+            while len(pending) < max(processes, 1):
+                batch = next(plan, None)
+                if batch is None:
+                    break
+                tarfile_name = os.path.join(
+                    directory, tarfile_template.create_filename(batch[0].mtime))
+                component_files = [os.path.relpath(local_file.filename,
+                                                   directory)
+                                   for local_file in batch]
+                if processes > 1:
+                    start_tarfile_pool(processes)
+                    result = _TARFILE_POOL.apply_async(
+                        _create_tarfile_in_worker,
+                        (tar_binary, tarfile_name, component_files,
+                         compression, directory, level))
+                    finish = functools.partial(_finish_worker_tarfile,
+                                               result, ratios,
+                                               tarfile_template.label())
+                else:
+                    result = None
+                    finish = functools.partial(
+                        _create_tarfile_timed, tarfile_template.label(),
+                        tar_binary, tarfile_name, component_files,
+                        compression, ratios, directory, level)
+                pending.append((tarfile_name, batch, finish, result))
+            if not pending:
+                break
+            tarfile_name, batch, finish, result = pending[0]
+            try:
+                md5, manifest = finish()
+            except Exception:
+                timed_out = result is not None and not result.ready()
+                raise
+            pending.popleft()
             logging.info('Created local file %s', tarfile_name)
-            yield tarfile_name, min_mtime, max_mtime, len(tarfile_files)
-            os.remove(tarfile_name)
-            logging.info('Removed local file %s', tarfile_name)
+            yield Tarfile(tarfile_name, batch[0].mtime, batch[-1].mtime,
+                          len(batch), md5, manifest)
+            remove_tarfile(tarfile_name, manifest)
+    finally:
+        for tarfile_name, _, finish, result in pending:
+            if result is not None and not timed_out:
+                # The shared workers cannot be killed, so the tarfiles they
+                # are making are waited for, to be discarded once made.
+                try:
+                    finish()
+                except Exception:  # pylint: disable=broad-except
+                    logging.exception('Making %s failed', tarfile_name)
+                    timed_out = not result.ready()
+            if result is not None and not result.ready():
+                _discard_when_made(tarfile_name, result)
+            else:
+                discard_tarfile(tarfile_name)
 
 
 # The GCS upload mechanism loads the item to be uploaded into RAM. This means
@@ -570,45 +1861,157 @@ def create_temporary_tarfiles(tar_binary, tarfile_template, directory,
 TARFILE_UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024
 
 
-@TARFILE_UPLOAD_TIME.time()
+# Connections made by the HttpPool record how many times they performed a
+# handshake on the current thread, so that the pool can tell whether a request
+# reused an existing keep-alive connection.
+_HTTP_THREAD_STATE = threading.local()
+
+
+def _count_connect(scheme):
+    """Records a new connection both in Prometheus and for this thread."""
+    HTTP_CONNECTIONS_OPENED.labels(scheme=scheme).inc()
+    _HTTP_THREAD_STATE.connects = getattr(_HTTP_THREAD_STATE, 'connects', 0) + 1
+
+
+class _CountingHTTPConnection(httplib2.HTTPConnectionWithTimeout):
+    """An HTTP connection that counts its handshakes and uses SO_KEEPALIVE."""
+
+    def connect(self):
+        _count_connect('http')
+        httplib2.HTTPConnectionWithTimeout.connect(self)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class _CountingHTTPSConnection(httplib2.HTTPSConnectionWithTimeout):
+    """An HTTPS connection that counts its handshakes and uses SO_KEEPALIVE."""
+
+    def connect(self):
+        _count_connect('https')
+        httplib2.HTTPSConnectionWithTimeout.connect(self)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+
+class HttpPool(object):
+    """A bounded, thread-safe pool of authorized keep-alive HTTP connections.
+
+    httplib2.Http objects are not safe to share between threads, but each one
+    keeps its connections open between requests.  The pool hands one of them
+    to each request, creating them lazily (up to max_size of them) and
+    blocking callers when all of them are in use.  The most recently used
+    connection is handed out first, because it is the one most likely to still
+    be open.
+
+    An HttpPool looks enough like an httplib2.Http to be passed as the `http`
+    argument of apiclient.discovery.build_from_document(), which means that
+    every request made through the resulting service, uploads and metadata
+    calls alike, is made on a pooled connection.
+    """
+
+    CONNECTION_TYPES = {'http': _CountingHTTPConnection,
+                        'https': _CountingHTTPSConnection}
+
+    def __init__(self, credentials, max_size, timeout=300):
+        self._credentials = credentials
+        self._timeout = timeout
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def _new_http(self):
+        return self._credentials.authorize(httplib2.Http(timeout=self._timeout))
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Check out an authorized httplib2.Http for the current thread.
+
+        If the body of the `with` statement raises, the Http object is thrown
+        away rather than returned to the pool, because its connections may be
+        in an unknown state.
+        """
+        self._slots.acquire()
+        try:
+            try:
+                http = self._idle.get_nowait()
+            except Queue.Empty:
+                http = self._new_http()
+            yield http
+            self._idle.put(http)
+        finally:
+            self._slots.release()
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=httplib2.DEFAULT_MAX_REDIRECTS,
+                connection_type=None):
+        """Performs an HTTP request on a pooled connection.
+
+        Has the same signature and return value as httplib2.Http.request.
+        """
+        if connection_type is None:
+            connection_type = self.CONNECTION_TYPES.get(
+                uri.split(':', 1)[0].lower())
+        with self.connection() as http:
+            _HTTP_THREAD_STATE.connects = 0
+            response = http.request(uri, method=method, body=body,
+                                    headers=headers, redirections=redirections,
+                                    connection_type=connection_type)
+            if _HTTP_THREAD_STATE.connects:
+                HTTP_REQUESTS.labels(connection='new').inc()
+            else:
+                HTTP_REQUESTS.labels(connection='reused').inc()
+            return response
+
+
 @retry.retry(exceptions=RecoverableScraperException,
              backoff=2,      # Exponential backoff with a multiplier of 2
              jitter=(1, 5),  # plus a random number of seconds from 1 to 5
              max_delay=300,  # but never more than 5 minutes.
              logger=logging.getLogger())
-def upload_tarfile(service, tgz_filename, date, experiment,
-                   bucket):
-    """Uploads a tarfile to Google Cloud Storage for later processing.
+def upload_file(service, filename, bucket, name, md5=None,
+                chunk_size=TARFILE_UPLOAD_CHUNK_SIZE, label=''):
+    """Uploads a local file to a GCS object, retrying until it succeeds.
 
-    Puts the file into a GCS bucket. If a file of that same name already exists,
-    the file is overwritten.  If the upload fails, the upload is retried until
-    it succeeds, although we perform exponential backoff with a maximum wait
-    time of 5 minutes between attempts.  If the GCS service becomes unavailable
-    in the longer term, then scraper won't work anyway, and retrying will work
-    around temporary blips in service or network reachability.
+    If a file of that same name already exists, the file is overwritten.  If
+    the upload fails, the upload is retried until it succeeds, although we
+    perform exponential backoff with a maximum wait time of 5 minutes between
+    attempts.  If the GCS service becomes unavailable in the longer term, then
+    scraper won't work anyway, and retrying will work around temporary blips in
+    service or network reachability.
+
+    If an MD5 checksum is passed in, it is sent along with the upload and GCS
+    rejects the upload if the data it received does not match it.
 
     Args:
       service: the service object returned from discovery
-      tgz_filename: the basename of the tarfile
-      date: the date for the data
-      experiment: the subdirectory of the bucket for this data
+      filename: the local file to upload
       bucket: the name of the GCS bucket
+      name: the name of the object within the bucket
+      md5: optional base64-encoded MD5 checksum of the file
+      chunk_size: optional number of bytes to send, and hold in memory, at once
+      label: optional rsync_host_module label of the target, for the metrics
+
+    Raises:
+      ScraperShutdown if a shutdown was requested before the upload was done,
+      once the chunk being sent is
     """
-    name = '%s/%d/%02d/%02d/%s' % (experiment, date.year, date.month, date.day,
-                                   os.path.basename(tgz_filename))
-    media = apiclient.http.MediaFileUpload(tgz_filename,
-                                           chunksize=TARFILE_UPLOAD_CHUNK_SIZE,
+    import apiclient.http
+    import googleapiclient.errors
+
+    media = apiclient.http.MediaFileUpload(filename,
+                                           chunksize=chunk_size,
                                            resumable=True)
     try:
-        logging.info('Uploading %s to %s/%s', tgz_filename, bucket, name)
+        logging.info('Uploading %s to %s/%s', filename, bucket, name)
+        body = {'md5Hash': md5} if md5 else None
         request = service.objects().insert(
-            bucket=bucket, name=name, media_body=media)
+            bucket=bucket, name=name, media_body=media, body=body)
         response = None
         while response is None:
-            with TARFILE_CHUNK_UPLOAD_TIME.time():
+            with TARFILE_CHUNK_UPLOAD_TIME.labels(
+                rsync_host_module=label).time():
                 progress, response = request.next_chunk()
                 if progress:
                     logging.debug('Uploaded %d%%', 100.0 * progress.progress())
+            if response is None:
+                SHUTDOWN.check()
         logging.info('Upload to %s/%s complete!', bucket, name)
     except googleapiclient.errors.HttpError as error:  # pragma: no cover
         if (error.resp.status // 100) == 5:  # HTTP 500 is recoverable
@@ -619,6 +2022,84 @@ def upload_tarfile(service, tgz_filename, date, experiment,
             raise NonRecoverableScraperException('upload', str(error))
 
 
+def upload_tarfile(service, tgz_filename, date, experiment,
+                   bucket, md5=None, manifest=None,
+                   chunk_size=TARFILE_UPLOAD_CHUNK_SIZE, prefix='', label=''):
+    """Uploads a tarfile to Google Cloud Storage for later processing.
+
+    Puts the file into a GCS bucket, followed by its manifest (if it has one)
+    under the same name plus MANIFEST_SUFFIX.  Each upload is retried until it
+    succeeds, as described in upload_file().  Once it is uploaded, the tarfile
+    is dropped from the page cache, where its pages would otherwise stay for
+    as long as the upload's file object keeps it open, even once it is
+    removed.
+
+    The service should have been built by init(), so that the upload is made on
+    connections from the shared HttpPool.
+
+    Args:
+      service: the service object returned from discovery
+      tgz_filename: the basename of the tarfile
+      date: the date for the data
+      experiment: the subdirectory of the bucket for this data
+      bucket: the name of the GCS bucket
+      md5: optional base64-encoded MD5 checksum of the tarfile
+      manifest: optional name of the tarfile's local manifest file
+      chunk_size: optional number of bytes to upload at once
+      prefix: optional directory of the bucket to put the experiment
+        subdirectory in
+      label: optional rsync_host_module label of the target, for the metrics
+
+    Returns:
+      the name of the uploaded tarfile object within the bucket
+    """
+    name = '%s/%d/%02d/%02d/%s' % (experiment, date.year, date.month, date.day,
+                                   os.path.basename(tgz_filename))
+    if prefix:
+        name = prefix.rstrip('/') + '/' + name
+    with TARFILE_UPLOAD_TIME.labels(rsync_host_module=label).time():
+        upload_file(service, tgz_filename, bucket, name, md5, chunk_size,
+                    label)
+        drop_from_page_cache(tgz_filename)
+        if manifest:
+            with open(manifest, 'rb') as manifest_file:
+                manifest_md5 = base64.b64encode(
+                    hashlib.md5(manifest_file.read()).digest())
+            upload_file(service, manifest, bucket, name + MANIFEST_SUFFIX,
+                        manifest_md5, chunk_size, label)
+    return name
+
+
+# Serializes appends to checksum logs by threads within this process.
+_CHECKSUM_LOG_LOCK = threading.Lock()
+
+# Once a checksum log grows past this many bytes (about 100,000 uploads), it
+# is moved aside to the same name plus '.1', replacing the one there, so that
+# at most twice this much of the persistent volume is ever used.
+CHECKSUM_LOG_MAX_SIZE = 10 * 1024 * 1024
+
+
+def record_checksum(checksum_log, bucket, name, md5, size,
+                    max_size=CHECKSUM_LOG_MAX_SIZE):
+    """Appends the checksum of an uploaded object to a local log.
+
+    Each line holds the upload time, the gs:// URL of the object, its
+    base64-encoded MD5 (in the same form as `gsutil hash -m` and the md5Hash
+    object metadata) and its size in bytes, separated by tabs.  This lets
+    uploaded objects be compared against what was sent without downloading
+    them.  The log is rotated once it is bigger than max_size bytes.
+    """
+    line = '%s\tgs://%s/%s\t%s\t%d\n' % (
+        datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), bucket,
+        name, md5, size)
+    with _CHECKSUM_LOG_LOCK:
+        if (os.path.exists(checksum_log) and
+                os.path.getsize(checksum_log) > max_size):
+            os.rename(checksum_log, checksum_log + '.1')
+        with open(checksum_log, 'a') as log:
+            log.write(line)
+
+
 def delete_local_datafiles_up_to(directory, max_mtime):
     """Removes files with an mtime before a given datetime from the local disk.
 
@@ -628,8 +2109,8 @@ def delete_local_datafiles_up_to(directory, max_mtime):
         # Delete too-old files
         for filename in files:
             fullname = os.path.join(root, filename)
-            stat = os.stat(fullname)
-            mtime = stat.st_mtime
+            file_stat = os.stat(fullname)
+            mtime = file_stat.st_mtime
             if mtime <= max_mtime:
                 logging.debug('Removing old file %s', fullname)
                 os.remove(fullname)
@@ -655,8 +2136,10 @@ def mtime_to_date_or_die(mtime_text):
 class SyncStatus(object):
     """Saves and retrieves the status of an rsync endpoint from Datastore.
 
-    All get_* and update_* methods cause remote reads and writes to the Cloud
-    Datastore instance associated with the current Google Cloud project.
+    All update_* methods cause remote writes to the Cloud Datastore instance
+    associated with the current Google Cloud project.  get_* methods read a
+    cached copy of the Entity, which is refreshed from Datastore once it is
+    refresh_interval seconds old, and which every update writes through.
 
     By design, every running scraper instance should be associated with one
     (and only one) datastore Entity, and every Entity should be associated with
@@ -684,26 +2167,61 @@ class SyncStatus(object):
     DEBUG_MESSAGE_KEY = 'errorsincelastsuccessful'
     LAST_COLLECTION_KEY = 'lastcollectionattempt'
     MTIME_KEY = 'maxrawfilemtimearchived'
+    LEASE_HOLDER_KEY = 'leaseholder'
+    LEASE_EXPIRY_KEY = 'leaseexpiry'
+    LEASE_RENEWED_KEY = 'leaserenewed'
+
+    # The Shard of the rsync endpoint's files that this scraper is in charge
+    # of, or None for all of them.
+    shard = None
 
-    def __init__(self, client, rsync_url):
+    def __init__(self, client, rsync_url, refresh_interval=0, shared=False):
         self._client = client
         self._rsync_url = rsync_url
+        self._refresh_interval = refresh_interval
+        # Whether other scrapers write the Entity too, as when the rsync
+        # endpoint is sharded.
+        self._shared = shared
         self._key = None
         self._entity = None
+        self._entity_time = None
+        # Once this scraper takes the lease on the Entity, it only writes the
+        # Entity while it still holds the lease, and only works on the target
+        # until the lease expires or is lost (see check_lease()).
+        self._lease_holder = None
+        self._lease_expiry = None
+        self.lease_lost = threading.Event()
+        # Updates come from both the main thread and the log handler.
+        self._lock = threading.RLock()
+
+    def _make_key(self):
+        """Returns the key of the Entity."""
+        return self._client.key(SyncStatus.RSYNC_KEY, self._rsync_url)
 
     # Retry required until
     # https://github.com/GoogleCloudPlatform/google-cloud-python/issues/2694
     # is fixed.
     @retry.retry(tries=5)
-    def get_data(self):
+    def get_data(self, transaction=None):
         """Retrieves data from cloud datastore.
 
         A separate function so that it can be mocked for testing purposes.
         """
         if self._key is None:
-            self._key = self._client.key(SyncStatus.RSYNC_KEY, self._rsync_url)
+            self._key = self._make_key()
+        if transaction is not None:
+            return self._client.get(self._key, transaction=transaction)
         return self._client.get(self._key)
 
+    def get_cached_data(self):
+        """Returns the cached data, retrieving it if it is too old."""
+        with self._lock:
+            if (self._entity_time is None or
+                    time.time() - self._entity_time >= self._refresh_interval):
+                self._entity = self.get_data()
+                self._entity_time = time.time()
+            return self._entity
+
     def get_last_archived_mtime(
             self, default_datetime=datetime.datetime(2009, 1, 1, 0, 0, 0)):
         """Returns the most recent mtime before which we have all the data.
@@ -716,7 +2234,7 @@ class SyncStatus(object):
         Args:
           default_datetime: the time to return if no datastore entry exists
         """
-        data = self.get_data()
+        data = self.get_cached_data()
         if not data:
             logging.info('No data found in the datastore')
             return default_datetime
@@ -732,6 +2250,138 @@ class SyncStatus(object):
     # https://github.com/GoogleCloudPlatform/google-cloud-python/issues/2694
     # is fixed.
     @retry.retry(tries=5)
+    def _transact(self, update):
+        """Reads, changes and writes the Entity in a single transaction.
+
+        The write fails (and is retried) if anything else writes the Entity in
+        between.  If no value for the key exists, then one will be created.
+
+        Args:
+          update: a function that changes the Entity it is passed in place,
+            or returns False to leave it as it is
+
+        Returns:
+          whether the Entity was written
+        """
+        # pylint: disable=no-name-in-module
+        import google.cloud.datastore as cloud_datastore
+        # pylint: enable=no-name-in-module
+
+        with self._lock:
+            transaction = self._client.transaction()
+            transaction.begin()
+            try:
+                value = self.get_data(transaction)
+                if not value:
+                    logging.info('Key %s has no value. Making a new one.',
+                                 self._rsync_url)
+                    value = cloud_datastore.entity.Entity(key=self._key)
+                elif (not self._shared and self._entity is not None and
+                      dict(value) != dict(self._entity)):
+                    logging.warning('The datastore entry for %s was changed '
+                                    'by something other than this scraper',
+                                    self._rsync_url)
+                if update(value) is False:
+                    transaction.rollback()
+                    return False
+                transaction.put(value)
+                transaction.commit()
+            except Exception:
+                transaction.rollback()
+                raise
+            self._entity = value
+            self._entity_time = time.time()
+            return True
+
+    def update_entries(self, entries):
+        """Updates several datastore values at once.
+
+        The Entity is read and written in a single transaction (see
+        _transact()).  If this scraper has taken the lease on the Entity, and
+        another has taken it since, nothing is written.
+
+        Args:
+          entries: a dict whose keys must be static values in SyncStatus, and
+            whose values are the new values to write to the datastore entry
+
+        Raises:
+          NonRecoverableScraperException if the lease was lost
+        """
+        def update(value):
+            if (self._lease_holder is not None and
+                    value.get(self.LEASE_HOLDER_KEY) != self._lease_holder):
+                return False
+            value.update(entries)
+
+        if not self._transact(update):
+            self.lease_lost.set()
+            message = 'Lost the lease on %s to another scraper' % (
+                self._rsync_url)
+            logging.error(message)
+            raise NonRecoverableScraperException('lease_lost', message)
+
+    def acquire_lease(self, holder, duration):
+        """Takes or renews the lease on the Entity, unless another holds it.
+
+        A lease expires duration seconds after it was last taken or renewed,
+        after which anyone may take it.  Once the lease is taken, every later
+        update is only written while the holder still holds it.
+
+        Args:
+          holder: the name of the scraper taking the lease
+          duration: how many seconds the lease lasts
+
+        Returns:
+          whether the holder holds the lease
+        """
+        now = time.time()
+
+        def update(value):
+            if (value.get(self.LEASE_HOLDER_KEY) not in (None, holder) and
+                    value.get(self.LEASE_EXPIRY_KEY, 0) > now):
+                return False
+            value[self.LEASE_HOLDER_KEY] = unicode(holder)
+            value[self.LEASE_EXPIRY_KEY] = now + duration
+            value[self.LEASE_RENEWED_KEY] = now
+
+        if not self._transact(update):
+            return False
+        self._lease_holder = unicode(holder)
+        self._lease_expiry = now + duration
+        return True
+
+    def check_lease(self):
+        """Raises an exception if this scraper may no longer hold the lease.
+
+        Like SHUTDOWN.check(), this is called before each piece of work that
+        another holder of the lease could be doing too, such as downloading a
+        chunk of files or uploading a tarfile, so that a scraper which lost
+        the lease stops before it uploads objects under the names that the
+        new holder uploads to.  Without a lease, it does nothing.
+
+        Raises:
+          NonRecoverableScraperException if the lease was lost, or has
+          expired since it was last renewed
+        """
+        if self._lease_holder is None:
+            return
+        if self.lease_lost.is_set() or time.time() >= self._lease_expiry:
+            message = 'No longer holding the lease on %s' % self._rsync_url
+            logging.error(message)
+            raise NonRecoverableScraperException('lease_lost', message)
+
+    def release_lease(self):
+        """Lets the lease expire now, if this scraper still holds it."""
+        if self._lease_holder is None:
+            return
+
+        def update(value):
+            if value.get(self.LEASE_HOLDER_KEY) != self._lease_holder:
+                return False
+            value[self.LEASE_EXPIRY_KEY] = 0
+
+        self._transact(update)
+
     def update_data(self, entry_key, entry_value):
         """Updates a datastore value.
 
@@ -741,13 +2391,7 @@ class SyncStatus(object):
           entry_key: must be one of the static values in SyncStatus
           entry_value: the new value to write to the datastore entry
         """
-        value = self.get_data()
-        if not value:
-            logging.info('Key %s has no value. Making a new one.',
-                         self._rsync_url)
-            value = cloud_datastore.entity.Entity(key=self._key)
-        value[entry_key] = entry_value
-        self._client.put(value)
+        self.update_entries({entry_key: entry_value})
 
     def update_last_archived_date(self, _date):
         """Updates the date before which it is safe to delete data.
@@ -784,67 +2428,790 @@ class SyncStatus(object):
         should only happen either on program start, or after a successful
         download.
 
+        All three are written to cloud datastore at once.
+
         Args:
           new_high_water_mark_mtime: the new mtime high water mark
         """
-        self.update_last_archived_date(new_high_water_mark_mtime)
-        self.update_mtime(datetime_to_epoch(new_high_water_mark_mtime))
-        self.update_debug_message('')
+        self.update_entries({
+            self.COLLECTION_KEY: u'obsolete',
+            self.MTIME_KEY: datetime_to_epoch(new_high_water_mark_mtime),
+            self.DEBUG_MESSAGE_KEY: u'',
+        })
+
+    def advance_high_water_mark(self, new_high_water_mark_mtime):
+        """Like on_upload_success(), but never moves the high water mark back.
+
+        Several scrapers can call this at once.
+
+        Returns:
+          whether the high water mark moved
+        """
+        mtime = datetime_to_epoch(new_high_water_mark_mtime)
+
+        def update(value):
+            if value.get(self.MTIME_KEY) >= mtime:
+                return False
+            value.update({
+                self.COLLECTION_KEY: u'obsolete',
+                self.MTIME_KEY: mtime,
+                self.DEBUG_MESSAGE_KEY: u'',
+            })
+
+        return self._transact(update)
+
+
+class Shard(object):
+    """One of the parts that the files of an rsync endpoint are split into.
+
+    Files are split either by day, with the days dealt out to the shards in
+    turn, or by a hash of their filenames.  Splitting by day lets each shard
+    list only its own day directories, while splitting by filename spreads
+    the load of a busy day.
+    """
+
+    def __init__(self, index, count, by='day'):
+        self.index = index
+        self.count = count
+        self.by = by
+
+    def owns_day(self, day):
+        """Returns whether files in the YYYY/MM/DD day may be in the shard."""
+        if self.by != 'day':
+            return True
+        ordinal = datetime.datetime.strptime(day, '%Y/%m/%d').toordinal()
+        return ordinal % self.count == self.index
+
+    def owns(self, filename):
+        """Returns whether the YYYY/MM/DD/... file is in the shard."""
+        if self.by == 'day':
+            return self.owns_day(filename[:len('YYYY/MM/DD')])
+        return (zlib.crc32(filename) & 0xffffffff) % self.count == self.index
+
+    def name(self, rsync_url):
+        """Returns the name of the shard's Datastore Entity."""
+        return '%s#%d/%d/%s' % (rsync_url, self.index, self.count, self.by)
+
+
+class ShardStatus(SyncStatus):
+    """The status of one shard of an rsync endpoint scraped by many replicas.
+
+    Each replica holds the lease on the Entity of the shard it scrapes, and
+    keeps the high water mark of the shard there.  The high water mark of the
+    rsync endpoint, which the node's data deletion goes by, is only moved up
+    to the lowest high water mark of all the shards, as only then has every
+    file before it been uploaded, whichever shard it is in.  A shard with no
+    high water mark of its own yet starts from that of the endpoint.
+
+    Collection times and error messages go to the endpoint's Entity.
+    """
+
+    SHARD_KEY = 'scrapershard'
+
+    def __init__(self, client, rsync_url, shard, refresh_interval=0):
+        super(ShardStatus, self).__init__(client, rsync_url, refresh_interval)
+        self.shard = shard
+        self.combined = SyncStatus(client, rsync_url, refresh_interval,
+                                   shared=True)
+
+    def _make_key(self):
+        return self._client.key(self.SHARD_KEY,
+                                self.shard.name(self._rsync_url))
+
+    def get_last_archived_mtime(self, default_datetime=None):
+        if default_datetime is None:
+            default_datetime = self.combined.get_last_archived_mtime()
+        return super(ShardStatus, self).get_last_archived_mtime(
+            default_datetime)
+
+    def update_debug_message(self, message):
+        self.combined.update_debug_message(message)
+
+    def update_last_collection(self):
+        self.combined.update_last_collection()
+
+    def on_upload_success(self, new_high_water_mark_mtime):
+        """Moves the high water mark of the shard, then that of the endpoint."""
+        self.update_entries({
+            self.MTIME_KEY: datetime_to_epoch(new_high_water_mark_mtime)})
+        self.update_combined_high_water_mark()
+
+    def update_combined_high_water_mark(self):
+        """Moves the endpoint's high water mark up to the lowest shard's."""
+        current = self.combined.get_last_archived_mtime()
+        keys = [self._client.key(self.SHARD_KEY,
+                                 Shard(index, self.shard.count,
+                                       self.shard.by).name(self._rsync_url))
+                for index in range(self.shard.count)]
+        marks = dict((entity.key.name, entity.get(self.MTIME_KEY))
+                     for entity in self._client.get_multi(keys))
+        # Shards which have not uploaded anything yet hold it where it is.
+        lowest = min(marks.get(key.name) or datetime_to_epoch(current)
+                     for key in keys)
+        if lowest > datetime_to_epoch(current):
+            self.combined.advance_high_water_mark(
+                datetime.datetime.utcfromtimestamp(lowest))
+
+
+def acquire_shard(client, rsync_url, count, by, holder, lease_duration,
+                  refresh_interval=0):
+    """Takes the lease on the first shard of the endpoint that is free.
+
+    Returns:
+      the ShardStatus of the shard
+
+    Raises:
+      RecoverableScraperException if every shard is held by another replica
+    """
+    for index in range(count):
+        status = ShardStatus(client, rsync_url, Shard(index, count, by),
+                             refresh_interval)
+        if status.acquire_lease(holder, lease_duration):
+            logging.info('Scraping shard %d of %d of %s as %s', index, count,
+                         rsync_url, holder)
+            return status
+    message = ('All %d shards of %s are held by other replicas' %
+               (count, rsync_url))
+    logging.warning(message)
+    raise RecoverableScraperException('no_free_shard', message)
+
+
+def lease_holder_name():
+    """Returns a name for this process to take leases under."""
+    return '%s-%d' % (socket.gethostname(), os.getpid())
+
+
+def wait_for_lease(status, holder, duration, poll_interval=1):
+    """Waits until the holder takes the lease on the status.
+
+    The Entity is read every poll_interval seconds, and taking the lease is
+    only tried once it has expired, so waiting costs one read per poll.
+
+    Returns:
+      how many seconds had passed since another holder last renewed the
+      lease, or None if no one else held it, or if when it did is unknown
+    """
+    while True:
+        data = status.get_data() or {}
+        previous = data.get(SyncStatus.LEASE_HOLDER_KEY)
+        free = (previous in (None, holder) or
+                data.get(SyncStatus.LEASE_EXPIRY_KEY, 0) <= time.time())
+        if free and status.acquire_lease(holder, duration):
+            renewed = data.get(SyncStatus.LEASE_RENEWED_KEY)
+            if previous in (None, holder) or renewed is None:
+                return None
+            return time.time() - renewed
+        SHUTDOWN.check()
+        time.sleep(poll_interval)
+
+
+class Shutdown(object):
+    """Lets a request to shut down stop the scraper between units of work.
+
+    Once a shutdown is requested, check() raises ScraperShutdown, which the
+    scraper calls before each unit of work it could stop in front of: an
+    rsync chunk, a tarfile, an upload chunk.  Work done in a work() block is
+    redone after a restart if the shutdown abandons it, so the time spent on
+    it is counted as lost.  Leases are handed over by the functions passed to
+    at_exit(), which finish() calls.
+    """
+
+    def __init__(self):
+        self.requested = threading.Event()
+        self.request_time = None
+        self._lock = threading.Lock()
+        self._work = {}
+        self._lost = 0.0
+        self._exit_functions = []
+
+    def request(self):
+        """Asks every scraper thread to stop before its next unit of work."""
+        if self.request_time is None:
+            self.request_time = time.time()
+        self.requested.set()
+
+    def check(self):
+        """Raises ScraperShutdown if a shutdown has been requested."""
+        if self.requested.is_set():
+            raise ScraperShutdown()
+
+    def sleep(self, seconds, step=1):
+        """Sleeps, in steps of a second, unless a shutdown cuts it short."""
+        for _ in range(int(seconds // step)):
+            if self.requested.is_set():
+                return
+            time.sleep(step)
+        if not self.requested.is_set():
+            time.sleep(seconds % step)
+
+    @contextlib.contextmanager
+    def work(self):
+        """Counts the time spent in the block as lost if it is abandoned."""
+        key = object()
+        with self._lock:
+            self._work[key] = time.time()
+        try:
+            yield
+        except ScraperShutdown:
+            with self._lock:
+                self._lost += time.time() - self._work[key]
+            raise
+        finally:
+            with self._lock:
+                del self._work[key]
+
+    def lost_time(self):
+        """Returns the seconds of abandoned work, including that under way."""
+        now = time.time()
+        with self._lock:
+            return self._lost + sum(now - start
+                                    for start in self._work.values())
+
+    def at_exit(self, function):
+        """Calls the function when finish() is called."""
+        with self._lock:
+            self._exit_functions.append(function)
+
+    def finish(self):
+        """Calls the at_exit() functions, logging any that fail."""
+        with self._lock:
+            functions, self._exit_functions = self._exit_functions, []
+        for function in functions:
+            try:
+                function()
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Could not finish shutting down')
+
+
+# The shutdown of the whole process, which run_scraper.py requests on SIGTERM.
+SHUTDOWN = Shutdown()
+
+
+class LeaseRenewer(threading.Thread):
+    """Renews the lease on a SyncStatus, so that it expires if we die.
+
+    The lease is renewed a third of the way through its duration, so that
+    a failed renewal or two do not lose it.  Once another holder takes it,
+    it is given up, and the next write to the SyncStatus fails.  When the
+    process shuts down, the lease is released (see Shutdown.finish()), so
+    that a standby need not wait for it to expire.
+    """
+
+    def __init__(self, status, holder, duration):
+        super(LeaseRenewer, self).__init__(name='lease-renewer')
+        self.daemon = True
+        self._status = status
+        self._holder = holder
+        self._duration = duration
+        self._stopped = threading.Event()
+        # Shared with the status, whose check_lease() stops the work.
+        self.lost = status.lease_lost
+
+    def start(self):
+        SHUTDOWN.at_exit(self.release)
+        super(LeaseRenewer, self).start()
+
+    def run(self):
+        while not self._stopped.wait(self._duration / 3.0):
+            try:
+                if not self._status.acquire_lease(self._holder,
+                                                  self._duration):
+                    LEASE_RENEWALS.labels(result='lost').inc()
+                    logging.error('Lost the lease held by %s', self._holder)
+                    self.lost.set()
+                    return
+                LEASE_RENEWALS.labels(result='renewed').inc()
+            except Exception:  # pylint: disable=broad-except
+                LEASE_RENEWALS.labels(result='error').inc()
+                logging.exception('Could not renew the lease held by %s',
+                                  self._holder)
+
+    def stop(self):
+        """Stops renewing the lease."""
+        self._stopped.set()
+
+    def release(self):
+        """Stops renewing the lease, and lets it expire now."""
+        self.stop()
+        self.join()
+        if not self.lost.is_set():
+            self._status.release_lease()
+
+
+class BackfillStatus(object):
+    """Stands in for a SyncStatus while backfilling a range of time.
+
+    A backfill re-scrapes data that has already been scraped, so it must not
+    move, or even read, the high water mark that the live scraper keeps in
+    Datastore.  This keeps a high water mark of its own in memory instead,
+    starting just before the range, and drops everything else a SyncStatus
+    would write.  Like the high water mark in Datastore, it has a resolution
+    of one second.
+    """
+
+    shard = None
+
+    def __init__(self, start):
+        self._high_water_mark = start - datetime.timedelta(seconds=1)
+
+    def get_last_archived_mtime(self, default_datetime=None):
+        """Returns the time up to which the backfill has uploaded."""
+        del default_datetime  # A backfill always has a high water mark.
+        return self._high_water_mark
+
+    def on_upload_success(self, new_high_water_mark_mtime):
+        """Moves the high water mark forward."""
+        self._high_water_mark = new_high_water_mark_mtime
+
+    def update_last_collection(self):
+        """Does nothing, as backfills are not collections."""
+
+    def update_debug_message(self, message):
+        """Does nothing, as the errors of a backfill are only logged."""
+
+    def check_lease(self):
+        """Does nothing, as a backfill holds no lease."""
+
+
+# Datastore allows at most this many keys in one lookup, at most this many
+# entities in one commit, and at most this many entity groups (here, entities)
+# in one transaction.
+DATASTORE_MAX_LOOKUP = 1000
+DATASTORE_MAX_COMMIT = 500
+DATASTORE_MAX_TRANSACTION = 25
+
+
+def _chunks(items, size):
+    """Yields successive lists of up to size items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class SyncStatusBatch(object):
+    """Loads and stores the status of many rsync endpoints at once.
+
+    The Entities for all the rsync urls are read with get_multi and written
+    with put_multi, in chunks small enough for Datastore, so many endpoints
+    cost a few RPCs rather than one each.  Writes are made in transactions,
+    so that they never undo what something else wrote.  Reads are cached for
+    refresh_interval seconds.  status() returns a SyncStatus for one of the
+    endpoints that reads through this batch, so that any number of targets
+    scraped by one process share each refresh.
+    """
+
+    def __init__(self, client, rsync_urls, refresh_interval=0):
+        self._client = client
+        self._rsync_urls = list(rsync_urls)
+        self._refresh_interval = refresh_interval
+        self._keys = {}
+        self._entities = {}
+        self._entities_time = None
+        self._lock = threading.RLock()
+
+    def _key(self, rsync_url):
+        if rsync_url not in self._keys:
+            self._keys[rsync_url] = self._client.key(SyncStatus.RSYNC_KEY,
+                                                     rsync_url)
+        return self._keys[rsync_url]
+
+    # Retry required until
+    # https://github.com/GoogleCloudPlatform/google-cloud-python/issues/2694
+    # is fixed.
+    @retry.retry(tries=5)
+    def get_all(self):
+        """Retrieves the data for every rsync url from cloud datastore.
+
+        Returns:
+          a dict from rsync url to its Entity, or None if it has none
+        """
+        entities = dict.fromkeys(self._rsync_urls)
+        for urls in _chunks(self._rsync_urls, DATASTORE_MAX_LOOKUP):
+            found = self._client.get_multi([self._key(url) for url in urls])
+            for entity in found:
+                entities[entity.key.name] = entity
+        with self._lock:
+            self._entities = entities
+            self._entities_time = time.time()
+        return entities
+
+    def get_cached(self, rsync_url):
+        """Returns the cached data for one rsync url, refreshing all if old."""
+        with self._lock:
+            if (self._entities_time is None or
+                    time.time() - self._entities_time >=
+                    self._refresh_interval):
+                self.get_all()
+            return self._entities.get(rsync_url)
+
+    def remember(self, rsync_url, entity):
+        """Records an Entity that was written outside of this batch."""
+        with self._lock:
+            self._entities[rsync_url] = entity
+
+    # Retry required until
+    # https://github.com/GoogleCloudPlatform/google-cloud-python/issues/2694
+    # is fixed.
+    @retry.retry(tries=5)
+    def update_all(self, entries_by_url):
+        """Updates datastore values for many rsync urls at once.
+
+        Entities that do not exist yet are created.  Datastore limits how many
+        Entities one transaction may touch, so they are updated in chunks,
+        each of which is read afresh, updated and written in a transaction of
+        its own.  Only the given entries are changed, so the writes of others
+        to the other entries (leases, debug messages) are kept, and a chunk
+        that something else writes in the meantime is retried.
+
+        Args:
+          entries_by_url: a dict from rsync url to a dict whose keys must be
+            static values in SyncStatus, and whose values are the new values
+            to write to that url's datastore entry
+        """
+        # pylint: disable=no-name-in-module
+        import google.cloud.datastore as cloud_datastore
+        # pylint: enable=no-name-in-module
+
+        with self._lock:
+            for urls in _chunks(sorted(entries_by_url),
+                                DATASTORE_MAX_TRANSACTION):
+                keys = [self._key(url) for url in urls]
+                transaction = self._client.transaction()
+                transaction.begin()
+                try:
+                    found = dict(
+                        (entity.key.name, entity) for entity in
+                        self._client.get_multi(keys, transaction=transaction))
+                    entities = []
+                    for url, key in zip(urls, keys):
+                        entity = found.get(url)
+                        if entity is None:
+                            entity = cloud_datastore.entity.Entity(key=key)
+                        entity.update(entries_by_url[url])
+                        entities.append(entity)
+                    transaction.put_multi(entities)
+                    transaction.commit()
+                except Exception:
+                    transaction.rollback()
+                    raise
+                for entity in entities:
+                    self._entities[entity.key.name] = entity
+
+    def status(self, rsync_url):
+        """Returns a SyncStatus for one rsync url that reads from this batch."""
+        if rsync_url not in self._rsync_urls:
+            self._rsync_urls.append(rsync_url)
+        return BatchedSyncStatus(self, self._client, rsync_url)
+
+
+class BatchedSyncStatus(SyncStatus):
+    """A SyncStatus whose reads are shared with others in a SyncStatusBatch.
+
+    Updates are still made one Entity at a time, in a transaction, and are
+    written through to the batch.
+    """
+
+    def __init__(self, batch, client, rsync_url):
+        super(BatchedSyncStatus, self).__init__(client, rsync_url)
+        self._batch = batch
+
+    def get_cached_data(self):
+        # The Entity read by the batch is the one that the next update
+        # compares against, as if this status had read it itself.
+        with self._lock:
+            self._entity = self._batch.get_cached(self._rsync_url)
+            return self._entity
+
+    def update_entries(self, entries):
+        with self._lock:
+            super(BatchedSyncStatus, self).update_entries(entries)
+            self._batch.remember(self._rsync_url, self._entity)
 
 
 class SyncStatusLogHandler(logging.Handler):
-    """Handles error log messages by writing them to cloud datastore."""
+    """Handles error log messages by writing them to cloud datastore.
+
+    Messages are written by a background thread, so that logging an error
+    never waits for datastore.  Only the most recent message is kept in
+    datastore, so if several arrive while the thread is busy, only the last of
+    them is written.  Writes are at least min_interval seconds apart, except
+    that flush() and close() write any pending message right away.
+
+    If thread_name is set, only messages logged by the thread of that name are
+    handled.  Messages logged by the writer threads themselves (as when the
+    write fails because the lease was lost) are never handled, so that a
+    failing write cannot queue another.
+    """
+
+    # The name of the threads that write messages to datastore.
+    WRITER_THREAD_NAME = 'SyncStatusLogHandler'
 
-    def __init__(self, status_storage):
+    # How long flush() waits for the pending message to be written, unless
+    # it is given a timeout.
+    FLUSH_TIMEOUT = 60
+
+    def __init__(self, status_storage, min_interval=0, thread_name=None):
         logging.Handler.__init__(self, level=logging.ERROR)
         self.setFormatter(
             logging.Formatter('[%(asctime)s %(levelname)s '
                               '%(filename)s:%(lineno)d] %(message)s'))
         self._status_storage = status_storage
+        self._min_interval = min_interval
+        self._thread_name = thread_name
+        self._condition = threading.Condition()
+        self._pending = None
+        self._writing = False
+        self._flushes = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._write_messages,
+                                        name=self.WRITER_THREAD_NAME)
+        self._thread.daemon = True
+        self._thread.start()
 
     def handle(self, record):
-        self._status_storage.update_debug_message(self.format(record))
+        if record.threadName == self.WRITER_THREAD_NAME:
+            return
+        if (self._thread_name is not None and
+                record.threadName != self._thread_name):
+            return
+        message = self.format(record)
+        with self._condition:
+            self._pending = message
+            self._condition.notify_all()
+
+    def _write_messages(self):
+        """Writes pending messages to datastore until the handler is closed."""
+        while True:
+            with self._condition:
+                while self._pending is None and not self._closed:
+                    self._condition.wait()
+                if self._pending is None:
+                    return
+                message, self._pending = self._pending, None
+                self._writing = True
+            try:
+                self._status_storage.update_debug_message(message)
+            except Exception as error:  # pylint: disable=broad-except
+                # Logged below ERROR, so as not to come straight back here.
+                logging.warning('Could not save error message: %s', error)
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+                deadline = time.time() + self._min_interval
+                while (not self._closed and not self._flushes and
+                       time.time() < deadline):
+                    self._condition.wait(deadline - time.time())
+
+    def flush(self, timeout=None):
+        """Waits (for a while) until any pending message has been written.
+
+        Args:
+          timeout: optional number of seconds to wait at most, instead of
+                   FLUSH_TIMEOUT
+        """
+        deadline = time.time() + (self.FLUSH_TIMEOUT if timeout is None
+                                  else timeout)
+        with self._condition:
+            self._flushes += 1
+            self._condition.notify_all()
+            try:
+                while ((self._pending is not None or self._writing) and
+                       self._thread.is_alive() and time.time() < deadline):
+                    self._condition.wait(deadline - time.time())
+            finally:
+                self._flushes -= 1
+
+    def close(self):
+        """Writes any pending message, and stops the background thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self.flush()
+        logging.Handler.close(self)
 
     def emit(self, _record):  # pragma: no cover
         """Abstract in the base class, overwritten to keep the linter happy."""
 
 
-def init(args):
-    """Initialize the scraper library.
+# The storage API's discovery document changes rarely, and fetching it on every
+# container start means hundreds of simultaneous fetches during a rollout, all
+# before the first byte is scraped.  Instead, a copy is kept on the persistent
+# volume and refreshed once it is a week old.
+STORAGE_DISCOVERY_URI = ('https://www.googleapis.com/discovery/v1/apis/'
+                         'storage/v1/rest')
+DISCOVERY_CACHE_MAX_AGE = datetime.timedelta(days=7)
 
-    The discovery interface means that the contents of some libraries is
-    determined at runtime.  Also, applications need to be authorized to use the
-    necessary services.  This performs both library initialization as well as
-    application authorization.
+
+def fetch_discovery_document(http):
+    """Fetches the discovery document for the storage API over the network."""
+    response, content = http.request(STORAGE_DISCOVERY_URI)
+    if response.status != 200:
+        raise NonRecoverableScraperException(
+            'discovery', 'discovery document fetch failed (%d): %s' % (
+                response.status, content))
+    return content
+
+
+def load_discovery_document(http, cache_filename):
+    """Returns the storage discovery document, fetching it only when needed.
+
+    A cached copy younger than DISCOVERY_CACHE_MAX_AGE is returned without any
+    network traffic.  Otherwise the document is fetched and the cache is
+    replaced.  If the fetch fails but a stale copy exists, the stale copy is
+    used, because an old discovery document is much better than no scraping.
+
+    Args:
+      http: the httplib2.Http-like object to fetch the document with
+      cache_filename: the file in which to keep the cached document
+
+    Returns:
+      the discovery document as a JSON string
     """
-    rsync_url = 'rsync://{}:{}/{}'.format(args.rsync_host, args.rsync_port,
-                                          args.rsync_module)
-    # Set up logging
+    cached = None
+    if os.path.exists(cache_filename):
+        with open(cache_filename) as cache:
+            cached = cache.read()
+        try:
+            json.loads(cached)
+        except ValueError:
+            logging.warning('Ignoring corrupt discovery cache %s',
+                            cache_filename)
+            cached = None
+        age = time.time() - os.stat(cache_filename).st_mtime
+        if cached and age < DISCOVERY_CACHE_MAX_AGE.total_seconds():
+            logging.info('Using cached discovery document %s', cache_filename)
+            return cached
+    try:
+        document = fetch_discovery_document(http)
+    except (ScraperException, httplib2.HttpLib2Error, socket.error) as error:
+        if not cached:
+            logging.error('Could not fetch the discovery document: %s', error)
+            raise
+        logging.warning('Using stale discovery document %s: %s',
+                        cache_filename, error)
+        return cached
+    try:
+        # Write then rename, so that a crash never leaves a partial document.
+        temp_name = cache_filename + '.tmp'
+        with open(temp_name, 'w') as cache:
+            cache.write(document)
+        os.rename(temp_name, cache_filename)
+    except (IOError, OSError) as error:
+        logging.warning('Could not cache the discovery document in %s: %s',
+                        cache_filename, error)
+    return document
+
+
+def init_logging(label):
+    """Sets up logging, with every message tagged with the label."""
     logging.basicConfig(
         level=logging.INFO,
         format='[%(asctime)s %(levelname)s %(filename)s:%(lineno)d ' +
-        rsync_url + '] %(message)s')
-    logging.info('Scraping from %s, putting the results in %s', rsync_url,
-                 args.bucket)
+        label + '] %(message)s')
+
+
+def init_services(args):
+    """Connects to the cloud services that every target shares.
+
+    The discovery interface means that the contents of some libraries is
+    determined at runtime.  Also, applications need to be authorized to use the
+    necessary services.  This performs both library initialization as well as
+    application authorization.  The time taken by each phase is recorded in
+    STARTUP_PHASE_TIME.
+
+    Returns:
+      a tuple of the cloud datastore client and the cloud storage service
+    """
+    with STARTUP_PHASE_TIME.labels(phase='import').time():
+        import apiclient.discovery
+        from oauth2client.contrib import gce
+        # pylint: disable=no-name-in-module
+        import google.cloud.datastore as cloud_datastore
+        # pylint: enable=no-name-in-module
 
     # Authorize this application to use Google APIs.
-    creds = gce.AppAssertionCredentials()
+    with STARTUP_PHASE_TIME.labels(phase='credentials').time():
+        creds = gce.AppAssertionCredentials()
+
+    # Set up cloud datastore.
+    with STARTUP_PHASE_TIME.labels(phase='datastore').time():
+        datastore_service = cloud_datastore.Client(
+            namespace=args.datastore_namespace)
+
+    # Set up cloud storage.  All requests, including the discovery request,
+    # are made on keep-alive connections from a shared pool.
+    with STARTUP_PHASE_TIME.labels(phase='discovery').time():
+        http_pool = HttpPool(creds, args.http_pool_size)
+        cache_filename = (args.discovery_cache or
+                          os.path.join(args.data_dir,
+                                       'storage-v1-discovery.json'))
+        storage_service = apiclient.discovery.build_from_document(
+            load_discovery_document(http_pool, cache_filename),
+            http=http_pool)
 
-    # Set up cloud datastore and its dependencies
-    datastore_service = cloud_datastore.Client(
-        namespace=args.datastore_namespace)
-    status = SyncStatus(datastore_service, rsync_url)
-    logging.getLogger().addHandler(SyncStatusLogHandler(status))
+    return (datastore_service, storage_service)
 
-    # Set up cloud storage
-    storage_service = apiclient.discovery.build(
-        'storage', 'v1', credentials=creds)
+
+def init_target(args, datastore_service, thread_name=None,
+                status_batch=None):
+    """Sets up the local directory and the datastore status for one target.
+
+    Args:
+      args: the command-line arguments for the target
+      datastore_service: the cloud datastore client
+      thread_name: if the target is scraped by a thread of its own, the name
+        of that thread, so that only its errors are recorded in its status
+      status_batch: a SyncStatusBatch to read the status through, if the
+        target is one of many
+
+    Returns:
+      a tuple of the rsync url, the SyncStatus and the local data directory
+    """
+    rsync_url = 'rsync://{}:{}/{}'.format(args.rsync_host, args.rsync_port,
+                                          args.rsync_module)
+    logging.info('Scraping from %s, putting the results in %s', rsync_url,
+                 args.bucket)
 
     # If the destination directory does not exist, make it exist.
     destination = os.path.join(args.data_dir, args.rsync_host,
                                args.rsync_module)
     if not os.path.isdir(destination):
         os.makedirs(destination)
+
+    if args.shard_count > 1:
+        # Each replica scrapes one shard.  The shards share the directory, so
+        # that files left there from a shard the replica held before are not
+        # stranded: they are uploaded with the new shard's files, or deleted
+        # once they are below its high water mark, and the old shard's new
+        # holder downloads them again for itself.
+        holder = lease_holder_name()
+        status = retry.api.retry_call(
+            acquire_shard,
+            (datastore_service, rsync_url, args.shard_count, args.shard_by,
+             holder, args.lease_seconds, args.status_refresh_interval),
+            exceptions=RecoverableScraperException,
+            delay=args.lease_seconds)
+        LeaseRenewer(status, holder, args.lease_seconds).start()
+    elif status_batch is not None:
+        status = status_batch.status(rsync_url)
+    else:
+        status = SyncStatus(datastore_service, rsync_url,
+                            args.status_refresh_interval)
+    logging.getLogger().addHandler(
+        SyncStatusLogHandler(status, args.status_log_interval, thread_name))
+    return (rsync_url, status, destination)
+
+
+def init(args):
+    """Initialize the scraper library to scrape a single target.
+
+    Returns:
+      a tuple of the rsync url, the SyncStatus, the local data directory and
+      the cloud storage service
+    """
+    init_logging('rsync://{}:{}/{}'.format(args.rsync_host, args.rsync_port,
+                                           args.rsync_module))
+    datastore_service, storage_service = init_services(args)
+    rsync_url, status, destination = init_target(args, datastore_service)
     return (rsync_url, status, destination, storage_service)
 
 
@@ -853,24 +3220,324 @@ def init(args):
 QUIESCENCE_THRESHOLD = datetime.timedelta(minutes=15)
 
 
-def download(args, rsync_url, sync_status, destination):
+class ResourceBudget(object):
+    """Sizes the work done at once to fit the container's cgroup limits.
+
+    FILES_PER_RSYNC_DOWNLOAD and TARFILE_UPLOAD_CHUNK_SIZE suit a container
+    with REFERENCE_MEMORY bytes of memory, so both scale with the memory limit,
+    and are halved while the working set, the memory in use less the page
+    cache that the kernel can reclaim, is more than MEMORY_PRESSURE of it.
+    Uploads may run two per CPU of quota, as they spend about as long waiting
+    on the network as compressing.  The gzip level steps down towards 1 for as
+    long as the cgroup keeps being throttled for using too much CPU, and back
+    up to GZIP_COMPRESSION_LEVEL once it is not.  Without cgroup limits, the
+    constants are used as they are.
+
+    Both cgroup v1 and v2 are understood.  Every decision is exported in the
+    RESOURCE_BUDGET gauge.
+    """
+
+    REFERENCE_MEMORY = 400 * 1000 * 1000
+    MEMORY_PRESSURE = 0.75
+    MIN_FILES_PER_RSYNC_DOWNLOAD = 100
+    MAX_FILES_PER_RSYNC_DOWNLOAD = 10000
+    # Resumable uploads must be sent in multiples of 256KB.
+    UPLOAD_CHUNK_ALIGNMENT = 256 * 1024
+    MAX_UPLOAD_CHUNK_SIZE = 100 * 1024 * 1024
+    # cgroup v1 reports an unlimited amount of memory as a huge number.
+    UNLIMITED_MEMORY = 1 << 62
+
+    def __init__(self, cgroup_root='/sys/fs/cgroup'):
+        self._root = cgroup_root
+        self._lock = threading.Lock()
+        self._level = GZIP_COMPRESSION_LEVEL
+        self.memory_limit = self._memory_limit()
+        self.cpus = self._cpus()
+        self._throttled = self._nr_throttled()
+        if self.memory_limit is not None:
+            RESOURCE_BUDGET.labels(budget='memory_limit_bytes').set(
+                self.memory_limit)
+        if self.cpus is not None:
+            RESOURCE_BUDGET.labels(budget='cpus').set(self.cpus)
+
+    def _read(self, *names):
+        """Returns the first of the cgroup files that exists, or None."""
+        for name in names:
+            try:
+                with open(os.path.join(self._root, name)) as cgroup_file:
+                    return cgroup_file.read().strip()
+            except IOError:
+                pass
+        return None
+
+    def _memory_limit(self):
+        limit = self._read('memory.max', 'memory/memory.limit_in_bytes')
+        if limit is None or limit == 'max':
+            return None
+        if int(limit) >= self.UNLIMITED_MEMORY:
+            return None
+        return int(limit)
+
+    def _cpus(self):
+        quota = self._read('cpu.max')
+        if quota is not None:
+            quota, period = quota.split()
+        else:
+            quota = self._read('cpu/cpu.cfs_quota_us')
+            period = self._read('cpu/cpu.cfs_period_us')
+        if quota is None or period is None or quota in ('max', '-1'):
+            return None
+        return float(quota) / int(period)
+
+    def _nr_throttled(self):
+        cpu_stat = self._read('cpu.stat', 'cpu/cpu.stat')
+        for line in (cpu_stat or '').splitlines():
+            key, value = line.split()
+            if key == 'nr_throttled':
+                return int(value)
+        return None
+
+    def _memory_stat(self, name, key):
+        """Returns the value of the key in a memory.stat file, or 0."""
+        for line in (self._read(name) or '').splitlines():
+            stat_key, value = line.split()
+            if stat_key == key:
+                return int(value)
+        return 0
+
+    def memory_usage(self):
+        """Returns the cgroup's working set in bytes, or None if unknown.
+
+        The usage the cgroup reports includes the page cache, which the
+        kernel reclaims long before the cgroup runs out of memory, and which
+        grows with every file downloaded and tarred.  Like the kubelet, the
+        inactive file pages are left out.
+        """
+        usage = self._read('memory.current')
+        if usage is not None:
+            inactive = self._memory_stat('memory.stat', 'inactive_file')
+        else:
+            usage = self._read('memory/memory.usage_in_bytes')
+            if usage is None:
+                return None
+            inactive = self._memory_stat('memory/memory.stat',
+                                         'total_inactive_file')
+        return max(0, int(usage) - inactive)
+
+    def _memory_scale(self):
+        if self.memory_limit is None:
+            return 1.0
+        scale = float(self.memory_limit) / self.REFERENCE_MEMORY
+        usage = self.memory_usage()
+        if (usage is not None and
+                usage > self.MEMORY_PRESSURE * self.memory_limit):
+            scale /= 2
+        return scale
+
+    def files_per_rsync_download(self):
+        """Returns how many files each rsync download should fetch."""
+        files = max(self.MIN_FILES_PER_RSYNC_DOWNLOAD,
+                    min(int(FILES_PER_RSYNC_DOWNLOAD * self._memory_scale()),
+                        self.MAX_FILES_PER_RSYNC_DOWNLOAD))
+        RESOURCE_BUDGET.labels(budget='files_per_rsync_download').set(files)
+        return files
+
+    def upload_chunk_size(self):
+        """Returns how many bytes of a tarfile to upload at once."""
+        size = int(TARFILE_UPLOAD_CHUNK_SIZE * self._memory_scale())
+        size -= size % self.UPLOAD_CHUNK_ALIGNMENT
+        size = max(self.UPLOAD_CHUNK_ALIGNMENT,
+                   min(size, self.MAX_UPLOAD_CHUNK_SIZE))
+        RESOURCE_BUDGET.labels(budget='upload_chunk_bytes').set(size)
+        return size
+
+    def upload_concurrency(self, default):
+        """Returns how many uploads may run at once, or default if unknown."""
+        uploads = default if self.cpus is None else max(1, int(self.cpus * 2))
+        RESOURCE_BUDGET.labels(budget='upload_concurrency').set(uploads)
+        return uploads
+
+    def compression_level(self):
+        """Returns the gzip level, lower if the CPU was throttled lately."""
+        with self._lock:
+            throttled = self._nr_throttled()
+            if (throttled is not None and self._throttled is not None and
+                    throttled > self._throttled):
+                self._level = max(1, self._level - 1)
+            else:
+                self._level = min(self._level + 1, GZIP_COMPRESSION_LEVEL)
+            self._throttled = throttled
+            level = self._level
+        RESOURCE_BUDGET.labels(budget='compression_level').set(level)
+        return level
+
+
+# What list_remote() found on the server: the time the listing began, the
+# signature of every day directory listed, the days which had changed since
+# they were last downloaded in full, and the RemoteFiles in those days.
+Listing = collections.namedtuple('Listing',
+                                 ['time', 'days', 'changed_days', 'files'])
+
+
+def list_remote(args, rsync_url, sync_status, destination, end=None,
+                governor=None):
+    """Lists the remote files that download() may need to download.
+
+    Only the day directories which have changed since they were last
+    downloaded in full are listed, as kept track of by a ListingCache next to
+    the destination.  With args.rsync_listing set to 'protocol', they are
+    listed by rsync_client rather than the rsync binary.  If the sync_status
+    is that of a shard, only the days of the shard are listed.  If there is
+    an end, only the days that could hold files between the high water mark
+    and the end are listed.  Files are taken to be written on the day of
+    their directory, or the day after.  Each listing rsync waits for a slot
+    from the governor, if there is one, like downloads do.
+
+    Returns:
+      a Listing
+    """
+    listing_time = datetime.datetime.utcnow()
+    label = rsync_host_module(args)
+    cache = ListingCache(state_filename(destination, sync_status.shard,
+                                        LISTING_CACHE_SUFFIX))
+    in_process = args.rsync_listing == 'protocol'
+    with _governed(governor) as bwlimit:
+        with RSYNC_LIST_DAYS_RUNS.labels(rsync_host_module=label).time():
+            if in_process:
+                days = list_rsync_days_in_process(rsync_url)
+            else:
+                days = list_rsync_days(args.timeout_binary, args.rsync_binary,
+                                       rsync_url, bwlimit=bwlimit)
+    if end is not None:
+        high_water_mark = sync_status.get_last_archived_mtime()
+        first_day = (high_water_mark - datetime.timedelta(days=1)).strftime(
+            '%Y/%m/%d')
+        last_day = end.strftime('%Y/%m/%d')
+        days = dict((day, signature) for day, signature in days.items()
+                    if first_day <= day <= last_day)
+    shard = sync_status.shard
+    if shard is not None:
+        days = dict((day, signature) for day, signature in days.items()
+                    if shard.owns_day(day))
+    changed_days = cache.changed_days(days)
+    files = []
+    # No slot is needed when there is nothing to list.
+    with _governed(governor if changed_days else None) as bwlimit:
+        with RSYNC_LIST_FILES_RUNS.labels(rsync_host_module=label).time():
+            if changed_days and in_process:
+                files = list_rsync_files_in_process(rsync_url, destination,
+                                                    days=changed_days)
+            elif changed_days:
+                files = list_rsync_files(args.timeout_binary,
+                                         args.rsync_binary, rsync_url,
+                                         destination, days=changed_days,
+                                         bwlimit=bwlimit)
+    return Listing(listing_time, days, changed_days, files)
+
+
+def download(args, rsync_url, sync_status, destination, governor=None,
+             budget=None, end=None, listing=None):
     """Rsync download all files that are new enough but not too new.
 
     Find the current last_archived_date from cloud datastore, then get the file
-    list and download the files from the server.
-    """
-    sync_status.update_last_collection()
-    high_water_mark = sync_status.get_last_archived_mtime()
-    too_recent = datetime.datetime.utcnow() - QUIESCENCE_THRESHOLD
+    list and download the files from the server, in the slots the governor
+    hands out if there is one, and in chunks sized by the ResourceBudget if
+    there is one.
 
-    all_remote_files = list_rsync_files(args.timeout_binary, args.rsync_binary,
-                                        rsync_url, destination)
+    Nothing is downloaded while less than args.critical_disk_watermark of the
+    destination's disk is free, and downloads stop part way if it fills up
+    that far, so that uploads get a chance to make room.
 
-    files_to_download = [remote_file for remote_file in all_remote_files
-                         if high_water_mark < remote_file.mtime <= too_recent]
+    The files are listed by list_remote(), unless a Listing made earlier is
+    passed in.  Either way, the files are judged against the high water mark
+    as it is now, and against the time of the listing.  Files in the
+    destination's Quarantine are left out of the download, and their days are
+    listed again until the files are downloaded, given up on, or gone from
+    the server.
 
-    download_files(args.timeout_binary, args.rsync_binary, rsync_url,
-                   files_to_download, destination)
+    If the sync_status is that of a shard, only the files in the shard are
+    downloaded.  If there is an end, files with mtimes at or after it are
+    left out too.
+
+    Returns:
+      the number of files to be downloaded that were not already on the local
+      disk
+    """
+    sync_status.update_last_collection()
+    if (args.critical_disk_watermark and
+            free_space_fraction(destination) < args.critical_disk_watermark):
+        logging.warning('Less than %g of the disk holding %s is free, so '
+                        'nothing will be downloaded until uploads make room',
+                        args.critical_disk_watermark, destination)
+        return 0
+    if listing is None:
+        listing = list_remote(args, rsync_url, sync_status, destination, end,
+                              governor)
+    high_water_mark = sync_status.get_last_archived_mtime()
+    # Files that were still being written when they were listed may have
+    # been listed part way through.
+    too_recent = listing.time - QUIESCENCE_THRESHOLD
+    days, changed_days, all_remote_files = (listing.days, listing.changed_days,
+                                            listing.files)
+    shard = sync_status.shard
+
+    cache = ListingCache(state_filename(destination, shard,
+                                        LISTING_CACHE_SUFFIX))
+    quarantine = Quarantine(state_filename(destination, shard,
+                                           QUARANTINE_SUFFIX))
+    quarantine.forget_up_to(high_water_mark)
+    quarantine.forget_missing(
+        changed_days,
+        [remote_file.filename for remote_file in all_remote_files])
+    files_to_download = []
+    quarantined_days = set()
+    for remote_file in all_remote_files:
+        if not high_water_mark < remote_file.mtime <= too_recent:
+            continue
+        if end is not None and remote_file.mtime >= end:
+            continue
+        if shard is not None and not shard.owns(remote_file.filename):
+            continue
+        if remote_file.filename in quarantine:
+            if not quarantine.abandoned(remote_file.filename):
+                quarantined_days.add(remote_file.filename[:len('YYYY/MM/DD')])
+        else:
+            files_to_download.append(remote_file)
+
+    new_files = sum(
+        1 for remote_file in files_to_download
+        if not os.path.exists(os.path.join(destination,
+                                           remote_file.filename)))
+
+    complete = download_files(
+        args.timeout_binary, args.rsync_binary, rsync_url, files_to_download,
+        destination, governor=governor,
+        files_per_download=(budget.files_per_rsync_download() if budget
+                            else FILES_PER_RSYNC_DOWNLOAD),
+        min_free_fraction=args.critical_disk_watermark, quarantine=quarantine,
+        label=rsync_host_module(args), check=sync_status.check_lease)
+    if complete:
+        # Days with files too recent to download yet must be listed again, as
+        # must days with quarantined files.
+        unfinished_days = set(remote_file.filename[:len('YYYY/MM/DD')]
+                              for remote_file in all_remote_files
+                              if remote_file.mtime > too_recent)
+        unfinished_days.update(quarantined_days)
+        for day in changed_days:
+            if day not in unfinished_days:
+                cache.remember(day, days[day])
+    cache.save()
+    quarantine.save()
+    return new_files
+
+
+def local_data_size(directory):
+    """Returns how many bytes of data are in the directory and below it."""
+    total = 0
+    for root, _dirs, files in os.walk(directory):
+        for filename in files:
+            total += os.stat(os.path.join(root, filename)).st_size
+    return total
 
 
 def should_upload(high_water_mark, too_recent_boundary, data_buffer_threshold,
@@ -883,13 +3550,28 @@ def should_upload(high_water_mark, too_recent_boundary, data_buffer_threshold,
     return total > data_buffer_threshold
 
 
-def upload_if_allowed(args, sync_status, destination, storage_service):
+def disk_is_low(args, destination):
+    """Returns whether either the data or the tarfile disk is running out.
+
+    A disk is running out when less than args.low_disk_watermark of it is
+    free.
+    """
+    if not args.low_disk_watermark:
+        return False
+    return min(free_space_fraction(destination),
+               free_space_fraction(args.tarfile_directory)) < (
+                   args.low_disk_watermark)
+
+
+def upload_if_allowed(args, sync_status, destination, storage_service,
+                      budget=None):
     """If enough time or data has accrued, upload.
 
     Data that is newer than the high water mark will be uploaded either starting
     at 8 am UTC the following day, or earlier than that if there is more data
     than the data buffer threshold that was created at least data wait time in
-    the past.
+    the past, or if the disk is running out (see disk_is_low()).  The budget,
+    if there is one, is passed on to upload_up_to_date().
 
     This function should only be run after a successful download().
     """
@@ -900,17 +3582,23 @@ def upload_if_allowed(args, sync_status, destination, storage_service):
                      args.data_buffer_threshold, destination):
         logging.info('Uploading early due to data volume')
         upload_up_to_date(args, sync_status, destination, storage_service,
-                          most_recent_allowable_mtime)
+                          most_recent_allowable_mtime, budget=budget)
+    elif (high_water_mark < most_recent_allowable_mtime and
+          disk_is_low(args, destination)):
+        logging.warning('Uploading early because the disk is running out')
+        upload_up_to_date(args, sync_status, destination, storage_service,
+                          most_recent_allowable_mtime, budget=budget)
     else:
         # Even if we don't have too much data, do check if we should upload
         # yesterday's data.
         proposed_new_high_water_mark = must_upload_up_to()
         if high_water_mark < proposed_new_high_water_mark:
             upload_up_to_date(args, sync_status, destination, storage_service,
-                              proposed_new_high_water_mark)
+                              proposed_new_high_water_mark, budget=budget)
 
 
-def upload_stale_disk(args, sync_status, destination, storage_service):
+def upload_stale_disk(args, sync_status, destination, storage_service,
+                      budget=None):
     """Upload old, uploadable data from the disk if there is a lot of it."""
     high_water_mark = sync_status.get_last_archived_mtime()
     most_recent_allowable_mtime = datetime.datetime.now() - args.data_wait_time
@@ -925,7 +3613,7 @@ def upload_stale_disk(args, sync_status, destination, storage_service):
                      args.data_buffer_threshold, destination):
         logging.info('Uploading stale data before rsync')
         upload_up_to_date(args, sync_status, destination, storage_service,
-                          oldest_possible_rsync_run)
+                          oldest_possible_rsync_run, budget=budget)
 
 
 def day_of_week(day):
@@ -942,49 +3630,128 @@ def day_of_week(day):
             'Sunday')[day.weekday()]
 
 
+def rsync_host_module(args):
+    """Returns the prometheus label value that names the target of args."""
+    node, site = node_and_site(args.rsync_host)
+    return '%s-%s-%s' % (node, site, args.rsync_module)
+
+
+def commit_upload(args, sync_status, destination, high_water_mark,
+                  num_files):
+    """Records that all data up to the high water mark has been uploaded.
+
+    Moves the high water mark forward in cloud datastore, and deletes the
+    local copies of all data that it covers.
+
+    Args:
+      args: the command-line arguments
+      sync_status: the SyncStatus to update
+      destination: the local data directory
+      high_water_mark: the datetime up to which everything is uploaded
+      num_files: how many files were uploaded since the last commit
+    """
+    # The FILES_UPLOADED count should only be incremented once we are
+    # confident that we won't re-upload all the files. Therefore, update it
+    # immediately before or after we call on_upload_success().
+    FILES_UPLOADED.labels(
+        rsync_host_module=rsync_host_module(args),
+        day_of_week=day_of_week(high_water_mark)).inc(num_files)
+    sync_status.on_upload_success(high_water_mark)
+    delete_local_datafiles_up_to(destination,
+                                 datetime_to_epoch(high_water_mark))
+
+
 def upload_up_to_date(args, sync_status, destination,
                       storage_service,
-                      candidate_last_archived_mtime):
+                      candidate_last_archived_mtime, budget=None, prefix=''):
     """Tar and upload local data.
 
     Tar up what data we have that is sufficiently in the past (up to and
     including the candidate_last_archived_mtime), upload what we have, and
     delete the local copies of all successfully-uploaded data.
+
+    Tarfiles are uploaded in mtime order, so once a tarfile is uploaded,
+    everything up to the second of its newest file is uploaded.  The high
+    water mark is moved there, and the local files deleted, whenever
+    args.commit_interval seconds have passed since the last time, when the
+    upload stops because of an error or a shutdown, and when it is done.  A
+    failure part way through only requires the uncommitted tarfiles to be
+    uploaded again.
+
+    Each tarfile is only uploaded while the sync_status still holds its
+    lease, if it has one (see SyncStatus.check_lease()).  If there is a
+    ResourceBudget, it picks the gzip level and the upload chunk size.
+    Tarfiles are uploaded under the prefix, if there is one (see
+    upload_tarfile()).
     """
     logging.info('Uploading all data prior to %s',
                  candidate_last_archived_mtime)
     node, site = node_and_site(args.rsync_host)
+    label = rsync_host_module(args)
+    shard = sync_status.shard
     tarfile_template = TarfileTemplate(args.tarfile_directory,
-                                       node, site, args.rsync_module)
+                                       node, site, args.rsync_module,
+                                       shard.index if shard else 0)
     earliest_time = sync_status.get_last_archived_mtime()
+    # Files that are still to be downloaded after their quarantine must stay
+    # above the high water mark.
+    quarantined_mtime = Quarantine(
+        state_filename(destination, shard, QUARANTINE_SUFFIX)).oldest_mtime()
+    if (quarantined_mtime is not None and
+            candidate_last_archived_mtime >= quarantined_mtime):
+        logging.warning('Holding the high water mark below %s, the mtime of '
+                        'a quarantined file', quarantined_mtime)
+        candidate_last_archived_mtime = (quarantined_mtime -
+                                         datetime.timedelta(seconds=1))
     if candidate_last_archived_mtime < earliest_time:  # pragma: no cover
         logging.warning('candidate max mtime (%s) is before high water mark '
                         '(%s)',
                         candidate_last_archived_mtime, earliest_time)
         return
-    total_daily_files = 0
-    for (tgz_filename,
-         min_mtime,
-         _max_mtime,
-         num_files) in create_temporary_tarfiles(args.tar_binary,
-                                                 tarfile_template,
-                                                 destination,
-                                                 earliest_time,
-                                                 candidate_last_archived_mtime,
-                                                 args.max_uncompressed_size):
-        upload_tarfile(storage_service, tgz_filename,
-                       datetime.datetime.utcfromtimestamp(min_mtime),
-                       args.rsync_module, args.bucket)
-        total_daily_files += num_files
-        BYTES_UPLOADED.labels(bucket=args.bucket).inc(
-            os.stat(tgz_filename).st_size)
-    # The FILES_UPLOADED count should only be incremented once we are
-    # confident that we won't re-upload all the files. Therefore, update it
-    # immediately before or after we call on_upload_success().
-    FILES_UPLOADED.labels(
-        rsync_host_module='%s-%s-%s' % (node, site, args.rsync_module),
-        day_of_week=day_of_week(candidate_last_archived_mtime)).inc(
-            total_daily_files)
-    sync_status.on_upload_success(candidate_last_archived_mtime)
-    delete_local_datafiles_up_to(
-        destination, datetime_to_epoch(candidate_last_archived_mtime))
+    checksum_log = (args.checksum_log or
+                    os.path.join(args.data_dir, 'checksums.log'))
+    # Everything up to uploaded_mtime has been uploaded, but only
+    # uncommitted_files of those files have not been committed.
+    uploaded_mtime = None
+    uncommitted_files = 0
+    next_commit_time = time.time() + args.commit_interval
+    level = GZIP_COMPRESSION_LEVEL
+    chunk_size = TARFILE_UPLOAD_CHUNK_SIZE
+    if budget is not None:
+        level = budget.compression_level()
+        chunk_size = budget.upload_chunk_size()
+    try:
+        SHUTDOWN.check()
+        for tgz in create_temporary_tarfiles(
+                args.tar_binary, tarfile_template, destination, earliest_time,
+                candidate_last_archived_mtime, args.max_uncompressed_size,
+                args.tar_compression, args.max_compressed_size,
+                processes=args.tarfile_processes, level=level):
+            SHUTDOWN.check()
+            sync_status.check_lease()
+            with SHUTDOWN.work():
+                name = upload_tarfile(
+                    storage_service, tgz.filename,
+                    datetime.datetime.utcfromtimestamp(tgz.min_mtime),
+                    args.rsync_module, args.bucket, tgz.md5, tgz.manifest,
+                    chunk_size, prefix, label)
+            size = os.stat(tgz.filename).st_size
+            BYTES_UPLOADED.labels(bucket=args.bucket,
+                                  rsync_host_module=label).inc(size)
+            record_checksum(checksum_log, args.bucket, name, tgz.md5, size)
+            uploaded_mtime = datetime.datetime.utcfromtimestamp(
+                int(tgz.max_mtime))
+            uncommitted_files += tgz.num_files
+            if time.time() >= next_commit_time:
+                commit_upload(args, sync_status, destination, uploaded_mtime,
+                              uncommitted_files)
+                uploaded_mtime = None
+                uncommitted_files = 0
+                next_commit_time = time.time() + args.commit_interval
+        # All the data up to the candidate has been uploaded, including any
+        # stretch of time after the last tarfile in which there was no data.
+        uploaded_mtime = candidate_last_archived_mtime
+    finally:
+        if uploaded_mtime is not None:
+            commit_upload(args, sync_status, destination, uploaded_mtime,
+                          uncommitted_files)
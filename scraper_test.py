@@ -18,27 +18,52 @@
 #
 # pylint: disable=missing-docstring, no-self-use, too-many-public-methods
 
+import base64
 import datetime
+import gzip
+import hashlib
+import json
 import logging
 import os
+import pickle
 import shutil
 import subprocess
 import tempfile
 import textwrap
+import threading
 import time
 import unittest
+import zlib
 
 import freezegun
 import mock
 import testfixtures
 
+import rsync_client
+
 # pylint: disable=no-name-in-module
+import google.cloud.datastore as cloud_datastore
 import google.cloud.exceptions as cloud_exceptions
 # pylint: enable=no-name-in-module
 
 import scraper
 
 
+def read_member(compressed, restart_points, offset, data_offset, size):
+    """Reads one member of a tarfile the way a manifest user would."""
+    index = max(i for i, point in enumerate(restart_points)
+                if point[0] <= offset)
+    uncompressed_start = restart_points[index][0]
+    data = ''
+    while len(data) < data_offset + size - uncompressed_start:
+        decompressor = zlib.decompressobj(-15)
+        data += decompressor.decompress(
+            compressed[restart_points[index][1]:])
+        index += 1
+    start = data_offset - uncompressed_start
+    return data[start:start + size]
+
+
 class TestScraper(unittest.TestCase):
 
     def setUp(self):
@@ -118,6 +143,40 @@ class TestScraper(unittest.TestCase):
             set(files))
         # pylint: enable=line-too-long
 
+    def test_list_rsync_days(self):
+        serverfiles = textwrap.dedent("""\
+        drwxr-xr-x          4,096 2017/10/01 00:00:01 .
+        drwxr-xr-x          4,096 2017/10/01 00:00:01 2017
+        drwxr-xr-x          4,096 2017/10/12 00:00:01 2017/10
+        drwxr-xr-x        118,784 2017/10/12 22:09:38 2017/10/11
+        drwxr-xr-x          4,096 2017/10/13 08:51:08 2017/10/12
+        -rw-r--r--             17 2017/10/12 08:51:08 2017/10/README""")
+        with tempfile.NamedTemporaryFile() as temp:
+            temp.write(serverfiles)
+            temp.flush()
+            fake_process = subprocess.Popen(['/bin/cat', temp.name],
+                                            stdout=subprocess.PIPE)
+            with mock.patch.object(subprocess, 'Popen') as mock_subprocess:
+                mock_subprocess.return_value = fake_process
+                days = scraper.list_rsync_days(
+                    '/usr/bin/timeout', '/usr/bin/rsync', 'localhost')
+        self.assertEqual(days, {
+            '2017/10/11': '2017/10/12 22:09:38 118,784',
+            '2017/10/12': '2017/10/13 08:51:08 4,096'})
+        self.assertIn('--exclude=/*/*/*/*', mock_subprocess.call_args[0][0])
+
+    def test_list_rsync_files_only_lists_days(self):
+        with mock.patch.object(subprocess, 'Popen') as mock_subprocess:
+            mock_subprocess.return_value.stdout = []
+            mock_subprocess.return_value.returncode = 0
+            scraper.list_rsync_files('/usr/bin/timeout', '/usr/bin/rsync',
+                                     'localhost', '/tmp',
+                                     days=['2017/09/30', '2017/10/01'])
+        self.assertEqual(mock_subprocess.call_args[0][0][-8:], [
+            '--include=/2017/', '--include=/2017/09/', '--include=/2017/10/',
+            '--include=/2017/09/30/***', '--include=/2017/10/01/***',
+            '--exclude=*', 'localhost', '/tmp'])
+
     @mock.patch.object(subprocess, 'Popen')
     def test_list_rsync_files_returns_24(self, patched_subprocess):
         # pylint: disable=line-too-long
@@ -182,7 +241,8 @@ class TestScraper(unittest.TestCase):
                     '/usr/bin/timeout', '/bin/false', 'localhost', '')
             self.assertIn('ERROR', [x.levelname for x in log.records])
 
-    def test_download_files_fails_and_dies(self):
+    @mock.patch.object(scraper.SHUTDOWN, 'sleep')
+    def test_download_files_fails_and_dies(self, patched_sleep):
         with testfixtures.LogCapture() as log:
             with self.assertRaises(scraper.RecoverableScraperException):
                 scraper.download_files(
@@ -193,6 +253,68 @@ class TestScraper(unittest.TestCase):
                      scraper.RemoteFile('2016/10/26/DNE2', 0)],
                     '/tmp')
             self.assertIn('ERROR', [x.levelname for x in log.records])
+        self.assertEqual([10, 20], [call[0][0] for call in
+                                    patched_sleep.call_args_list])
+
+    @mock.patch.object(scraper.SHUTDOWN, 'sleep')
+    @mock.patch.object(subprocess, 'call')
+    def test_download_files_retries_failed_chunks(self, patched_call,
+                                                  patched_sleep):
+        patched_call.side_effect = [12, 0]
+        self.assertTrue(scraper.download_files(
+            '/usr/bin/timeout', '/usr/bin/rsync', 'localhost/',
+            [scraper.RemoteFile('2016/10/26/DNE1', 0)], '/tmp'))
+        self.assertEqual(patched_call.call_count, 2)
+        patched_sleep.assert_called_once_with(10)
+
+    @mock.patch.object(subprocess, 'call')
+    def test_download_files_stops_retrying_on_shutdown(self, patched_call):
+        patched_call.return_value = 12
+        shutdown = scraper.Shutdown()
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown), \
+                mock.patch.object(shutdown, 'sleep',
+                                  side_effect=lambda _: shutdown.request()):
+            with self.assertRaises(scraper.ScraperShutdown):
+                scraper.download_files(
+                    '/usr/bin/timeout', '/usr/bin/rsync', 'localhost/',
+                    [scraper.RemoteFile('2016/10/26/DNE1', 0)], '/tmp')
+        self.assertEqual(patched_call.call_count, 1)
+
+    @mock.patch.object(scraper.SHUTDOWN, 'sleep')
+    @mock.patch.object(subprocess, 'call')
+    def test_download_files_bisects_and_quarantines(self, patched_call,
+                                                    _sleep):
+        files_to_download = [scraper.RemoteFile('2016/10/26/DNE%d' % i, 0)
+                             for i in range(8)]
+        downloaded = []
+
+        def fail_on_bad_file(args):
+            files = file(args[-3]).read().split('\0')
+            if '2016/10/26/DNE5' in files:
+                return 23
+            downloaded.extend(files)
+            return 0
+
+        patched_call.side_effect = fail_on_bad_file
+        quarantine = mock.Mock()
+        self.assertFalse(scraper.download_files(
+            '/usr/bin/timeout', '/usr/bin/rsync', 'localhost/',
+            files_to_download, '/tmp', files_per_download=4,
+            quarantine=quarantine))
+        self.assertEqual(
+            [call[0][0] for call in quarantine.add.call_args_list],
+            [[], [scraper.RemoteFile('2016/10/26/DNE5', 0)]])
+        # The files that were downloaded leave the quarantine, if they were
+        # in it.
+        self.assertEqual(
+            set(quarantine.remove.call_args_list[1][0][0]),
+            set('2016/10/26/DNE%d' % i for i in (4, 6, 7)))
+        self.assertEqual(
+            sorted(downloaded),
+            ['2016/10/26/DNE%d' % i for i in range(8) if i != 5])
+        # The first chunk took one try.  The second took three, then one for
+        # each of the halves and each of the quarters of the failing half.
+        self.assertEqual(patched_call.call_count, 1 + 3 + 2 + 2)
 
     @testfixtures.log_capture()
     def test_download_files_with_empty_does_nothing(self, _log):
@@ -223,6 +345,17 @@ class TestScraper(unittest.TestCase):
                                files_to_download, '/tmp')
         self.assertEqual(patched_call.call_count, 1)
 
+    @mock.patch.object(subprocess, 'call')
+    def test_download_files_stops_for_shutdown(self, patched_call):
+        shutdown = scraper.Shutdown()
+        shutdown.request()
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            with self.assertRaises(scraper.ScraperShutdown):
+                scraper.download_files(
+                    '/usr/bin/timeout', '/bin/true', 'localhost/',
+                    [scraper.RemoteFile('2016/10/26/DNE1', 0)], '/tmp')
+        self.assertFalse(patched_call.called)
+
     @mock.patch.object(subprocess, 'call')
     def test_download_files_breaks_up_long_file_list(self, patched_call):
         files_to_download = [scraper.RemoteFile('2016/10/26/DNE.%d' % i, 0)
@@ -393,27 +526,387 @@ class TestScraper(unittest.TestCase):
         client.get.return_value = None
         status = scraper.SyncStatus(client, None)
         status.update_data('key', 'value')
-        self.assertEqual(client.put.call_count, 1)
+        transaction = client.transaction.return_value
+        self.assertEqual(transaction.put.call_count, 1)
+        self.assertEqual(transaction.commit.call_count, 1)
+        self.assertEqual(client.get.call_args[1],
+                         {'transaction': transaction})
 
     @testfixtures.log_capture()
     def test_update_data_robustness(self, _log):
         client = mock.Mock()
         client.get.return_value = None
-        client.put.side_effect = [
+        client.transaction.return_value.commit.side_effect = [
             cloud_exceptions.ServiceUnavailable('one failure'), None]
         status = scraper.SyncStatus(client, None)
         status.update_data('key', 'value')
+        self.assertEqual(
+            client.transaction.return_value.rollback.call_count, 1)
 
     @testfixtures.log_capture()
     def test_update_data_eventually_fails(self, _log):
         client = mock.Mock()
         client.get.return_value = None
-        client.put.side_effect = cloud_exceptions.ServiceUnavailable(
-            'permanent failure')
+        client.transaction.return_value.commit.side_effect = (
+            cloud_exceptions.ServiceUnavailable('permanent failure'))
         status = scraper.SyncStatus(client, None)
         with self.assertRaises(cloud_exceptions.ServiceUnavailable):
             status.update_data('key', 'value')
 
+    @mock.patch.object(scraper.SyncStatus, 'get_data')
+    def test_get_last_archived_mtime_is_cached(self, patched_get):
+        patched_get.return_value = dict(maxrawfilemtimearchived=7)
+        with freezegun.freeze_time('2016-01-28 07:00:00 UTC'):
+            status = scraper.SyncStatus(None, None, 60)
+            status.get_last_archived_mtime()
+            status.get_last_archived_mtime()
+            self.assertEqual(patched_get.call_count, 1)
+        with freezegun.freeze_time('2016-01-28 07:01:00 UTC'):
+            self.assertEqual(status.get_last_archived_mtime(),
+                             datetime.datetime(1970, 1, 1, 0, 0, 7))
+            self.assertEqual(patched_get.call_count, 2)
+
+    def test_on_upload_success_writes_once_and_through(self):
+        client = mock.Mock()
+        client.get.return_value = {'maxrawfilemtimearchived': 7,
+                                   'errorsincelastsuccessful': u'oops'}
+        status = scraper.SyncStatus(client, None, 600)
+        status.get_last_archived_mtime()
+        status.on_upload_success(datetime.datetime(2016, 1, 28))
+        transaction = client.transaction.return_value
+        self.assertEqual(transaction.put.call_count, 1)
+        self.assertEqual(transaction.put.call_args[0][0], {
+            'maxrawfilemtimearchived': scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28)),
+            'lastsuccessfulcollection': u'obsolete',
+            'errorsincelastsuccessful': u''})
+        self.assertEqual(status.get_last_archived_mtime(),
+                         datetime.datetime(2016, 1, 28))
+        self.assertEqual(client.get.call_count, 2)
+
+    def _batch_client(self, stored):
+        """A mock datastore client holding entities for the stored urls."""
+        client = mock.Mock()
+        client.key.side_effect = lambda kind, name: cloud_datastore.Key(
+            kind, name, project='test')
+
+        def get_multi(keys, transaction=None):
+            del transaction  # Unused
+            found = []
+            for key in keys:
+                if key.name in stored:
+                    entity = cloud_datastore.Entity(key=key)
+                    entity.update(stored[key.name])
+                    found.append(entity)
+            return found
+
+        client.get_multi.side_effect = get_multi
+        return client
+
+    @mock.patch.object(scraper, 'DATASTORE_MAX_LOOKUP', 2)
+    def test_sync_status_batch_get_all(self):
+        client = self._batch_client({'a': {'maxrawfilemtimearchived': 1},
+                                     'c': {'maxrawfilemtimearchived': 3}})
+        batch = scraper.SyncStatusBatch(client, ['a', 'b', 'c', 'd', 'e'])
+        entities = batch.get_all()
+        self.assertEqual(client.get_multi.call_count, 3)
+        self.assertEqual(
+            dict((url, entity and entity['maxrawfilemtimearchived'])
+                 for url, entity in entities.iteritems()),
+            {'a': 1, 'b': None, 'c': 3, 'd': None, 'e': None})
+
+    def test_sync_status_batch_shares_reads(self):
+        client = self._batch_client({'a': {'maxrawfilemtimearchived': 1},
+                                     'b': {'maxrawfilemtimearchived': 2}})
+        batch = scraper.SyncStatusBatch(client, [], 600)
+        status_a = batch.status('a')
+        status_b = batch.status('b')
+        self.assertEqual(status_a.get_last_archived_mtime(),
+                         datetime.datetime(1970, 1, 1, 0, 0, 1))
+        self.assertEqual(status_b.get_last_archived_mtime(),
+                         datetime.datetime(1970, 1, 1, 0, 0, 2))
+        self.assertEqual(client.get_multi.call_count, 1)
+        self.assertEqual(client.get.call_count, 0)
+
+    def test_batched_sync_status_writes_through(self):
+        client = self._batch_client({'a': {'maxrawfilemtimearchived': 1}})
+        client.get.return_value = None
+        batch = scraper.SyncStatusBatch(client, ['a'], 600)
+        status = batch.status('a')
+        self.assertEqual(status.get_last_archived_mtime(),
+                         datetime.datetime(1970, 1, 1, 0, 0, 1))
+        status.on_upload_success(datetime.datetime(1970, 1, 1, 0, 0, 5))
+        self.assertEqual(client.transaction.return_value.put.call_count, 1)
+        self.assertEqual(status.get_last_archived_mtime(),
+                         datetime.datetime(1970, 1, 1, 0, 0, 5))
+        self.assertEqual(client.get_multi.call_count, 1)
+
+    @mock.patch.object(scraper, 'DATASTORE_MAX_TRANSACTION', 2)
+    def test_sync_status_batch_update_all(self):
+        stored = {'a': {'maxrawfilemtimearchived': 1,
+                        'lastcollectionattempt': u'x'}}
+        client = self._batch_client(stored)
+        batch = scraper.SyncStatusBatch(client, ['a', 'b', 'c'])
+        # Read into the cache before something else writes 'a'.
+        batch.get_all()
+        stored['a']['leaseholder'] = u'other'
+        batch.update_all({'a': {'maxrawfilemtimearchived': 10},
+                          'b': {'maxrawfilemtimearchived': 20},
+                          'c': {'maxrawfilemtimearchived': 30}})
+        transaction = client.transaction.return_value
+        self.assertFalse(client.put_multi.called)
+        self.assertEqual(
+            [len(call[0][0]) for call in transaction.put_multi.call_args_list],
+            [2, 1])
+        self.assertEqual(transaction.commit.call_count, 2)
+        # What was written is merged into what was read in the transaction,
+        # not into the cache.
+        written = transaction.put_multi.call_args_list[0][0][0][0]
+        self.assertEqual(dict(written), {'maxrawfilemtimearchived': 10,
+                                         'lastcollectionattempt': u'x',
+                                         'leaseholder': u'other'})
+
+    def test_batched_sync_status_compares_with_the_batch_read(self):
+        client = self._batch_client({'a': {'maxrawfilemtimearchived': 1}})
+        # Something else wrote the entity after the batch read it.
+        client.get.return_value = {'maxrawfilemtimearchived': 5}
+        batch = scraper.SyncStatusBatch(client, ['a'], 600)
+        status = batch.status('a')
+        status.get_last_archived_mtime()
+        with testfixtures.LogCapture() as log:
+            status.update_mtime(2)
+        self.assertIn('WARNING', [x.levelname for x in log.records])
+
+    def _entity_client(self, stored):
+        """A mock datastore client that reads and writes the stored dicts."""
+        client = mock.Mock()
+        client.key.side_effect = lambda kind, name: cloud_datastore.Key(
+            kind, name, project='test')
+
+        def get(key, transaction=None):
+            del transaction  # Unused
+            if key.name not in stored:
+                return None
+            entity = cloud_datastore.Entity(key=key)
+            entity.update(stored[key.name])
+            return entity
+
+        client.get.side_effect = get
+        client.get_multi.side_effect = lambda keys: [
+            entity for entity in map(get, keys) if entity is not None]
+        client.transaction.return_value.put.side_effect = (
+            lambda entity: stored.__setitem__(entity.key.name, dict(entity)))
+        return client
+
+    def test_sync_status_lease(self):
+        stored = {}
+        client = self._entity_client(stored)
+        first = scraper.SyncStatus(client, 'rsync://a')
+        second = scraper.SyncStatus(client, 'rsync://a', shared=True)
+        with freezegun.freeze_time('2016-01-28 07:00:00 UTC'):
+            self.assertTrue(first.acquire_lease('first', 60))
+            self.assertFalse(second.acquire_lease('second', 60))
+            first.update_mtime(1)
+            self.assertEqual(stored['rsync://a']['leaseholder'], u'first')
+        with freezegun.freeze_time('2016-01-28 07:00:59 UTC'):
+            self.assertTrue(first.acquire_lease('first', 60))
+        with freezegun.freeze_time('2016-01-28 07:02:00 UTC'):
+            self.assertTrue(second.acquire_lease('second', 60))
+            with testfixtures.LogCapture() as _:
+                with self.assertRaises(scraper.NonRecoverableScraperException):
+                    first.update_mtime(2)
+            self.assertFalse(first.acquire_lease('first', 60))
+            second.update_mtime(3)
+            self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 3)
+            first.release_lease()
+            self.assertFalse(first.acquire_lease('first', 60))
+            second.release_lease()
+            self.assertTrue(first.acquire_lease('first', 60))
+
+    def test_advance_high_water_mark_never_goes_back(self):
+        stored = {'rsync://a': {'maxrawfilemtimearchived': 100}}
+        status = scraper.SyncStatus(self._entity_client(stored), 'rsync://a',
+                                    shared=True)
+        self.assertFalse(status.advance_high_water_mark(
+            datetime.datetime.utcfromtimestamp(50)))
+        self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 100)
+        self.assertTrue(status.advance_high_water_mark(
+            datetime.datetime.utcfromtimestamp(150)))
+        self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 150)
+
+    def test_shards_split_files(self):
+        filenames = ['2017/10/%02d/test%d.gz' % (day, index)
+                     for day in range(1, 31) for index in range(10)]
+        for by in ('day', 'filename'):
+            shards = [scraper.Shard(index, 3, by) for index in range(3)]
+            owned = [[name for name in filenames if shard.owns(name)]
+                     for shard in shards]
+            self.assertEqual(sorted(sum(owned, [])), sorted(filenames))
+            for files in owned:
+                self.assertGreater(len(files), 50)
+        # Consecutive days go to different shards.
+        self.assertEqual(
+            [scraper.Shard(index, 3).owns_day('2017/10/01')
+             for index in range(3)].count(True), 1)
+        owners = [[index for index in range(3)
+                   if scraper.Shard(index, 3).owns_day(day)]
+                  for day in ['2017/10/01', '2017/10/02', '2017/10/03']]
+        self.assertEqual(sorted(sum(owners, [])), [0, 1, 2])
+        self.assertTrue(scraper.Shard(0, 3, 'filename').owns_day('2017/10/01'))
+
+    def test_shard_status_combines_high_water_marks(self):
+        stored = {'rsync://a': {'maxrawfilemtimearchived': 100}}
+        client = self._entity_client(stored)
+        shards = [scraper.ShardStatus(client, 'rsync://a',
+                                      scraper.Shard(index, 2))
+                  for index in range(2)]
+        for index, shard in enumerate(shards):
+            self.assertTrue(shard.acquire_lease('replica%d' % index, 60))
+            # Shards start from the high water mark of the endpoint.
+            self.assertEqual(shard.get_last_archived_mtime(),
+                             datetime.datetime.utcfromtimestamp(100))
+        shards[0].on_upload_success(datetime.datetime.utcfromtimestamp(300))
+        self.assertEqual(stored['rsync://a#0/2/day']['maxrawfilemtimearchived'],
+                         300)
+        # The other shard may not have uploaded anything after 100.
+        self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 100)
+        shards[1].on_upload_success(datetime.datetime.utcfromtimestamp(200))
+        self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 200)
+        shards[1].on_upload_success(datetime.datetime.utcfromtimestamp(400))
+        self.assertEqual(stored['rsync://a']['maxrawfilemtimearchived'], 300)
+        # Errors are recorded for the whole endpoint.
+        shards[1].update_debug_message('failed')
+        self.assertEqual(stored['rsync://a']['errorsincelastsuccessful'],
+                         u'failed')
+        self.assertNotIn('errorsincelastsuccessful',
+                         stored['rsync://a#1/2/day'])
+
+    def test_acquire_shard(self):
+        client = self._entity_client({})
+        first = scraper.acquire_shard(client, 'rsync://a', 2, 'filename',
+                                      'first', 60)
+        second = scraper.acquire_shard(client, 'rsync://a', 2, 'filename',
+                                       'second', 60)
+        self.assertEqual([first.shard.index, second.shard.index], [0, 1])
+        self.assertEqual(second.shard.by, 'filename')
+        with testfixtures.LogCapture() as _:
+            with self.assertRaises(scraper.RecoverableScraperException):
+                scraper.acquire_shard(client, 'rsync://a', 2, 'filename',
+                                      'third', 60)
+
+    @mock.patch.object(scraper.time, 'sleep')
+    def test_wait_for_lease(self, patched_sleep):
+        stored = {}
+        client = self._entity_client(stored)
+        with freezegun.freeze_time('2016-01-28 07:00:00 UTC') as frozen:
+            active = scraper.SyncStatus(client, 'rsync://a')
+            self.assertIsNone(scraper.wait_for_lease(active, 'active', 15))
+            frozen.tick(delta=datetime.timedelta(seconds=10))
+            self.assertTrue(active.acquire_lease('active', 15))
+            standby = scraper.SyncStatus(client, 'rsync://a')
+            patched_sleep.side_effect = lambda _: frozen.tick(
+                delta=datetime.timedelta(seconds=1))
+            # The lease renewed at 10s expires at 25s.
+            self.assertEqual(
+                scraper.wait_for_lease(standby, 'standby', 15), 15)
+            self.assertEqual(patched_sleep.call_count, 15)
+            self.assertEqual(stored['rsync://a']['leaseholder'], u'standby')
+            with self.assertRaises(scraper.NonRecoverableScraperException):
+                active.update_mtime(1)
+
+    def test_wait_for_lease_without_renewal_time(self):
+        # Leases taken before their renewal time was recorded have none.
+        stored = {'rsync://a': {'leaseholder': u'old', 'leaseexpiry': 0}}
+        client = self._entity_client(stored)
+        status = scraper.SyncStatus(client, 'rsync://a')
+        self.assertIsNone(scraper.wait_for_lease(status, 'standby', 15))
+        self.assertEqual(stored['rsync://a']['leaseholder'], u'standby')
+
+    def test_check_lease(self):
+        client = self._entity_client({})
+        status = scraper.SyncStatus(client, 'rsync://a')
+        # Without a lease, there is nothing to check.
+        status.check_lease()
+        with freezegun.freeze_time('2016-01-28 07:00:00 UTC') as frozen:
+            self.assertTrue(status.acquire_lease('me', 15))
+            frozen.tick(delta=datetime.timedelta(seconds=14))
+            status.check_lease()
+            # A lease that was not renewed in time may have been taken.
+            frozen.tick(delta=datetime.timedelta(seconds=1))
+            with testfixtures.LogCapture() as _:
+                with self.assertRaises(
+                        scraper.NonRecoverableScraperException):
+                    status.check_lease()
+            self.assertTrue(status.acquire_lease('me', 15))
+            status.check_lease()
+            status.lease_lost.set()
+            with testfixtures.LogCapture() as _:
+                with self.assertRaises(
+                        scraper.NonRecoverableScraperException):
+                    status.check_lease()
+
+    @mock.patch.object(subprocess, 'call')
+    def test_download_files_stops_when_the_check_fails(self, patched_call):
+        patched_call.return_value = 0
+        check = mock.Mock(side_effect=[
+            None, scraper.NonRecoverableScraperException('lease_lost', 'lost')])
+        with self.assertRaises(scraper.NonRecoverableScraperException):
+            scraper.download_files(
+                '/usr/bin/timeout', '/usr/bin/rsync', 'localhost/',
+                [scraper.RemoteFile('2016/10/26/DNE%d' % i, 0)
+                 for i in range(4)], '/tmp', files_per_download=2,
+                check=check)
+        self.assertEqual(patched_call.call_count, 1)
+
+    def test_lease_renewer_releases_the_lease_on_shutdown(self):
+        status = mock.Mock(lease_lost=threading.Event())
+        shutdown = scraper.Shutdown()
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            scraper.LeaseRenewer(status, 'me', 60).start()
+            shutdown.finish()
+        status.release_lease.assert_called_once_with()
+
+    @mock.patch.object(scraper.time, 'sleep')
+    def test_shutdown(self, patched_sleep):
+        shutdown = scraper.Shutdown()
+        shutdown.check()
+        with freezegun.freeze_time('2016-01-28 07:00:00 UTC') as frozen:
+            with shutdown.work():
+                frozen.tick(delta=datetime.timedelta(seconds=2))
+            patched_sleep.side_effect = lambda _: (
+                patched_sleep.call_count == 3 and shutdown.request())
+            shutdown.sleep(10.5)
+            self.assertEqual(patched_sleep.call_count, 3)
+            with self.assertRaises(scraper.ScraperShutdown):
+                with shutdown.work():
+                    frozen.tick(delta=datetime.timedelta(seconds=5))
+                    shutdown.check()
+            # Only abandoned work is lost, including that still under way.
+            self.assertEqual(shutdown.lost_time(), 5)
+            with shutdown.work():
+                frozen.tick(delta=datetime.timedelta(seconds=3))
+                self.assertEqual(shutdown.lost_time(), 8)
+        exits = []
+        shutdown.at_exit(mock.Mock(side_effect=ValueError('oops')))
+        shutdown.at_exit(lambda: exits.append('exit'))
+        with testfixtures.LogCapture() as log:
+            shutdown.finish()
+            shutdown.finish()
+        self.assertEqual(exits, ['exit'])
+        self.assertIn('ERROR', [x.levelname for x in log.records])
+
+    def test_lease_renewer_gives_up_a_lost_lease(self):
+        status = mock.Mock(lease_lost=threading.Event())
+        status.acquire_lease.side_effect = [
+            True, cloud_exceptions.ServiceUnavailable('oops'), True, False]
+        renewer = scraper.LeaseRenewer(status, 'me', 0.03)
+        with testfixtures.LogCapture() as _:
+            renewer.start()
+            self.assertTrue(renewer.lost.wait(5))
+            renewer.join(5)
+        self.assertEqual(status.acquire_lease.call_count, 4)
+        status.acquire_lease.assert_called_with('me', 0.03)
+
     def test_assert_mlab_hostname(self):
         for good_name in ['mlab4.sea02.measurement-lab.org',
                           'ndt.iupui.mlab1.nuq0t.measurement-lab.org',
@@ -470,11 +963,168 @@ class TestScraper(unittest.TestCase):
             logger.setLevel(logging.ERROR)
             logger.addHandler(loghandler)
             logger.info('INFORMATIVE')
+            loghandler.flush()
             self.assertEqual(patched_update_data.call_count, 0)
             logger.error('TEST ERROR')
+            loghandler.flush()
             self.assertEqual(patched_update_data.call_count, 1)
             self.assertEqual(type(patched_update_data.call_args[0][1]),
                              unicode)
+            logger.removeHandler(loghandler)
+            loghandler.close()
+
+    def test_log_handler_coalesces_messages(self):
+        status = mock.Mock()
+        written = threading.Event()
+        release = threading.Event()
+
+        def slow_update(_message):
+            written.set()
+            release.wait()
+
+        status.update_debug_message.side_effect = slow_update
+        loghandler = scraper.SyncStatusLogHandler(status, 3600)
+        logger = logging.getLogger('temp_test_coalesce')
+        logger.propagate = False
+        logger.addHandler(loghandler)
+        logger.error('first')
+        written.wait(5)
+        # While the first message is being written, more arrive.  Only the
+        # last is written, and flushing skips the wait between writes.
+        logger.error('second')
+        logger.error('third')
+        release.set()
+        loghandler.flush()
+        self.assertEqual(
+            [call[0][0].split('] ')[-1]
+             for call in status.update_debug_message.call_args_list],
+            ['first', 'third'])
+        # A message logged before shutdown is written when the handler closes.
+        logger.error('fourth')
+        logger.removeHandler(loghandler)
+        loghandler.close()
+        self.assertEqual(
+            status.update_debug_message.call_args[0][0].split('] ')[-1],
+            'fourth')
+
+    def test_log_handler_ignores_its_own_errors(self):
+        status = mock.Mock()
+        status.update_debug_message.side_effect = lambda _message: (
+            logging.getLogger('temp_test_own').error('lease_lost'))
+        loghandler = scraper.SyncStatusLogHandler(status)
+        logger = logging.getLogger('temp_test_own')
+        logger.propagate = False
+        logger.addHandler(loghandler)
+        logger.error('first')
+        loghandler.flush()
+        # The error logged while writing the first message is not written.
+        loghandler.flush()
+        logger.removeHandler(loghandler)
+        loghandler.close()
+        self.assertEqual(status.update_debug_message.call_count, 1)
+
+    def test_http_pool_reuses_connections(self):
+        creds = mock.Mock()
+        creds.authorize.side_effect = lambda _http: mock.Mock()
+        pool = scraper.HttpPool(creds, 2)
+        with pool.connection() as http1:
+            pass
+        with pool.connection() as http2:
+            self.assertIs(http1, http2)
+        self.assertEqual(creds.authorize.call_count, 1)
+
+    def test_http_pool_discards_connection_on_error(self):
+        creds = mock.Mock()
+        creds.authorize.side_effect = lambda _http: mock.Mock()
+        pool = scraper.HttpPool(creds, 2)
+        with self.assertRaises(RuntimeError):
+            with pool.connection() as http1:
+                raise RuntimeError()
+        with pool.connection() as http2:
+            self.assertIsNot(http1, http2)
+        self.assertEqual(creds.authorize.call_count, 2)
+
+    def test_http_pool_is_bounded(self):
+        creds = mock.Mock()
+        creds.authorize.side_effect = lambda _http: mock.Mock()
+        pool = scraper.HttpPool(creds, 1)
+        checked_out = []
+
+        def check_out():
+            with pool.connection() as http:
+                checked_out.append(http)
+
+        with pool.connection() as http:
+            thread = threading.Thread(target=check_out)
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            self.assertEqual(checked_out, [])
+        thread.join()
+        self.assertEqual(checked_out, [http])
+
+    @mock.patch.object(scraper, 'HTTP_REQUESTS')
+    def test_http_pool_request_counts_reuse(self, patched_requests):
+        def fake_request(_uri, **kwargs):
+            if not fake_http.request.call_count > 1:
+                scraper._count_connect('https')  # pylint: disable=protected-access
+            self.assertIs(kwargs['connection_type'],
+                          scraper.HttpPool.CONNECTION_TYPES['https'])
+            return 'response', 'content'
+
+        fake_http = mock.Mock()
+        fake_http.request.side_effect = fake_request
+        creds = mock.Mock()
+        creds.authorize.return_value = fake_http
+        pool = scraper.HttpPool(creds, 2)
+        self.assertEqual(pool.request('https://example.com/a'),
+                         ('response', 'content'))
+        patched_requests.labels.assert_called_with(connection='new')
+        pool.request('https://example.com/b')
+        patched_requests.labels.assert_called_with(connection='reused')
+
+    def test_file_type(self):
+        self.assertEqual(scraper.file_type('a/b/c.txt'), 'txt')
+        self.assertEqual(
+            scraper.file_type('2017/10/12/host.example.net:58176.cputime.gz'),
+            'cputime.gz')
+        self.assertEqual(scraper.file_type('dir.d/test.meta'), 'meta')
+        self.assertEqual(scraper.file_type('test.gz'), 'gz')
+        self.assertEqual(scraper.file_type('2017/README'), '')
+
+    def test_scraper_exception_pickles(self):
+        error = pickle.loads(pickle.dumps(
+            scraper.NonRecoverableScraperException('tar_error', 'oops')))
+        self.assertIsInstance(error, scraper.NonRecoverableScraperException)
+        self.assertEqual(error.prometheus_label, 'tar_error')
+        self.assertEqual(str(error), 'oops')
+
+    def test_plan_tarfiles(self):
+        files = [scraper.LocalBufferedFile('a', 1, 3),
+                 scraper.LocalBufferedFile('b', 2, 3),
+                 scraper.LocalBufferedFile('c', 2, 3),
+                 scraper.LocalBufferedFile('d', 3, 3)]
+        plan = [[local.filename for local in batch]
+                for batch in scraper.plan_tarfiles(files, 5)]
+        self.assertEqual(plan, [['a'], ['b', 'c'], ['d']])
+        plan = [[local.filename for local in batch]
+                for batch in scraper.plan_tarfiles(files, 9)]
+        self.assertEqual(plan, [['a', 'b', 'c'], ['d']])
+
+    def test_compression_ratios(self):
+        ratios = scraper.CompressionRatios(window=1000)
+        self.assertEqual(ratios.ratio('a.txt'), 1.0)
+        ratios.observe('a.txt', 400, 100)
+        ratios.observe('b.txt', 400, 300)
+        ratios.observe('c.gz', 400, 400)
+        self.assertEqual(ratios.ratio('d.txt'), 0.5)
+        self.assertEqual(ratios.estimate('e.gz', 10), 10)
+        self.assertEqual(ratios.ratio('f.meta'), 1.0)
+        # Passing the window halves the totals, so older data counts less.
+        ratios.observe('a.txt', 400, 0)
+        self.assertAlmostEqual(ratios.ratio('a.txt'), 1.0 / 3)
+        ratios.observe('a.txt', 200, 0)
+        self.assertEqual(ratios.ratio('a.txt'), 0.25)
 
     def test_day_of_week(self):
         self.assertEqual(scraper.day_of_week(datetime.date(2017, 6, 15)),
@@ -502,8 +1152,19 @@ class TestScraperInTempDir(unittest.TestCase):
         os.makedirs('2016/01/28')
         file('2016/01/28/test1.txt', 'w').write('hello')
         file('2016/01/28/test2.txt', 'w').write('goodbye')
-        scraper.create_tarfile('/bin/tar', 'test.tgz', ['2016/01/28/test1.txt',
-                                                        '2016/01/28/test2.txt'])
+        md5, manifest = scraper.create_tarfile('/bin/tar', 'test.tgz',
+                                               ['2016/01/28/test1.txt',
+                                                '2016/01/28/test2.txt'])
+        self.assertEqual(md5, base64.b64encode(
+            hashlib.md5(file('test.tgz', 'rb').read()).digest()))
+        self.assertEqual(manifest, 'test.tgz.manifest.json')
+        self.assertEqual(
+            [member[:3] for member in json.load(file(manifest))['members']],
+            [['2016/01/28/test1.txt',
+              int(os.stat('2016/01/28/test1.txt').st_mtime), 5],
+             ['2016/01/28/test2.txt',
+              int(os.stat('2016/01/28/test2.txt').st_mtime), 7]])
+        self.assertFalse(os.path.exists('test.tgz.partial'))
         shutil.rmtree('2016')
         self.assertFalse(os.path.exists('2016'))
         self.assertTrue(os.path.exists('test.tgz'))
@@ -512,6 +1173,90 @@ class TestScraperInTempDir(unittest.TestCase):
         self.assertEqual(file('2016/01/28/test1.txt').read(), 'hello')
         self.assertEqual(file('2016/01/28/test2.txt').read(), 'goodbye')
 
+    @mock.patch.object(scraper, 'drop_from_page_cache')
+    def test_create_tarfile_drops_component_files_from_cache(self,
+                                                              patched_drop):
+        os.makedirs('data/2016/01/28')
+        file('data/2016/01/28/test1.txt', 'w').write('hello')
+        scraper.create_tarfile('/bin/tar', 'test.tgz', ['2016/01/28/test1.txt'],
+                               directory='data')
+        patched_drop.assert_called_once_with('data/2016/01/28/test1.txt')
+
+    def test_drop_from_page_cache(self):
+        file('test.txt', 'w').write('hello')
+        with mock.patch.object(scraper, '_POSIX_FADVISE') as patched_fadvise:
+            scraper.drop_from_page_cache('test.txt')
+            scraper.drop_from_page_cache('does-not-exist.txt')
+        self.assertEqual(patched_fadvise.call_count, 1)
+        self.assertEqual(patched_fadvise.call_args[0][1:],
+                         (0, 0, scraper.POSIX_FADV_DONTNEED))
+        # The real thing, if this platform has it, succeeds quietly.
+        scraper.drop_from_page_cache('test.txt')
+        with mock.patch.object(scraper, '_POSIX_FADVISE', None):
+            scraper.drop_from_page_cache('test.txt')
+
+    def test_create_tarfile_manifest_allows_random_access(self):
+        os.makedirs('2016/01/28')
+        names = ['2016/01/28/test%d.txt' % i for i in range(5)]
+        for name in names:
+            # Incompressible data, so that there are several restart points.
+            file(name, 'wb').write(os.urandom(700 * 1000))
+        _, manifest = scraper.create_tarfile('/bin/tar', 'test.tgz', names)
+        manifest = json.load(file(manifest))
+        self.assertEqual(manifest['tarfile'], 'test.tgz')
+        self.assertGreater(len(manifest['restart_points']), 1)
+        compressed = file('test.tgz', 'rb').read()
+        for name, _mtime, size, offset, data_offset in manifest['members']:
+            self.assertEqual(data_offset, offset + 512)
+            self.assertEqual(
+                read_member(compressed, manifest['restart_points'],
+                            offset, data_offset, size),
+                file(name).read())
+
+    def test_create_tarfile_manifest_with_long_names(self):
+        os.makedirs('2016/01/28')
+        name = '2016/01/28/' + 'x' * 150 + '.meta'
+        file(name, 'w').write('hello')
+        _, manifest = scraper.create_tarfile('/bin/tar', 'test.tgz', [name])
+        manifest = json.load(file(manifest))
+        self.assertEqual(len(manifest['members']), 1)
+        member_name, _, size, offset, data_offset = manifest['members'][0]
+        self.assertEqual(member_name, name)
+        self.assertEqual(
+            read_member(file('test.tgz', 'rb').read(),
+                        manifest['restart_points'], offset, data_offset, size),
+            'hello')
+
+    def test_create_tarfile_store_compressed(self):
+        os.makedirs('2016/01/28')
+        file('2016/01/28/a.meta', 'w').write('metadata ' * 1000)
+        compressed_file = gzip.GzipFile('2016/01/28/b.gz', 'wb')
+        compressed_file.write(os.urandom(100 * 1000))
+        compressed_file.close()
+        file('2016/01/28/c.meta', 'w').write('more metadata ' * 1000)
+        # Too small to be worth storing.
+        compressed_file = gzip.GzipFile('2016/01/28/d.gz', 'wb')
+        compressed_file.write('small')
+        compressed_file.close()
+        names = ['2016/01/28/a.meta', '2016/01/28/b.gz', '2016/01/28/c.meta',
+                 '2016/01/28/d.gz']
+        _, manifest = scraper.create_tarfile('/bin/tar', 'test.tgz', names,
+                                             'gzip-store-compressed')
+        manifest = json.load(file(manifest))
+        # One gzip member before b.gz, one for it, and one after it.
+        self.assertEqual(len(manifest['restart_points']), 3)
+        compressed = file('test.tgz', 'rb').read()
+        for name, _mtime, size, offset, data_offset in manifest['members']:
+            self.assertEqual(
+                read_member(compressed, manifest['restart_points'],
+                            offset, data_offset, size),
+                file(name).read())
+        originals = dict((name, file(name).read()) for name in names)
+        shutil.rmtree('2016')
+        subprocess.check_call(['/bin/tar', 'xfz', 'test.tgz'])
+        for name in names:
+            self.assertEqual(file(name).read(), originals[name])
+
     @testfixtures.log_capture()
     def test_create_tarfile_succeeds_on_existing_tarfile(self, log):
         os.makedirs('2016/01/28')
@@ -546,6 +1291,8 @@ class TestScraperInTempDir(unittest.TestCase):
                                    ['2016/01/28/test1.txt',
                                     '2016/01/28/test2.txt'])
         self.assertIn('ERROR', [x.levelname for x in log.records])
+        self.assertFalse(os.path.exists('test.tgz'))
+        self.assertFalse(os.path.exists('test.tgz.partial'))
 
     def test_create_tarfiles(self):
         os.makedirs('2016/01/28')
@@ -568,9 +1315,13 @@ class TestScraperInTempDir(unittest.TestCase):
             datetime.datetime(2016, 1, 28, 0, 0, 0),
             datetime.datetime(2016, 1, 28, 23, 59, 59),
             100000)
-        fname, _, _, count = gen.next()
-        self.assertEqual(count, 3)
+        tgz = gen.next()
+        fname = tgz.filename
+        self.assertEqual(tgz.num_files, 3)
         self.assertTrue(os.path.isfile(fname))
+        self.assertTrue(os.path.isfile(tgz.manifest))
+        self.assertEqual(tgz.md5, base64.b64encode(
+            hashlib.md5(file(fname, 'rb').read()).digest()))
         shutil.rmtree('2016')
         self.assertFalse(os.path.exists('2016/01/28/test1.txt'))
         self.assertFalse(os.path.exists('2016/01/28/test2.txt'))
@@ -585,6 +1336,20 @@ class TestScraperInTempDir(unittest.TestCase):
         self.assertTrue(os.path.exists('2016/01/28/test3.txt.gz'))
         with self.assertRaises(StopIteration):
             gen.next()
+        self.assertFalse(os.path.exists(tgz.manifest))
+
+    def test_tarfile_template_names_the_shard(self):
+        mtime = scraper.datetime_to_epoch(datetime.datetime(2016, 1, 28, 1))
+        self.assertEqual(
+            scraper.TarfileTemplate('/tmp', 'mlab9', 'dne04', 'exper',
+                                    shard=3).create_filename(mtime),
+            '/tmp/20160128T010000Z-mlab9-dne04-exper-0003.tgz')
+        self.assertEqual(
+            scraper.TarfileTemplate('/tmp', 'mlab9', 'dne04',
+                                    'exper').label(),
+            scraper.rsync_host_module(mock.Mock(
+                rsync_host='mlab9.dne04.measurement-lab.org',
+                rsync_module='exper')))
 
     def test_create_tarfiles_multiple_small_files(self):
         os.makedirs('2016/01/28')
@@ -658,6 +1423,249 @@ class TestScraperInTempDir(unittest.TestCase):
         with self.assertRaises(StopIteration):
             gen.next()
 
+    def test_create_tarfiles_by_compressed_size(self):
+        os.makedirs('2016/01/28')
+        for index in range(3):
+            name = '2016/01/28/test%d.txt' % index
+            file(name, 'w').write('a' * 10000)
+            new_mtime = scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, index))
+            os.utime(name, (new_mtime, new_mtime))
+        template = scraper.TarfileTemplate(self.temp_d, 'mlab9', 'dne04',
+                                           'exper')
+        ratios = scraper.CompressionRatios()
+        # Nothing is known about .txt files yet, so they are assumed not to
+        # compress, and only one fits in each tarfile.
+        gen = scraper.create_temporary_tarfiles(
+            '/bin/tar', template, self.temp_d,
+            datetime.datetime(2016, 1, 28, 0, 0, 0),
+            datetime.datetime(2016, 1, 28, 23, 59, 59),
+            4, max_compressed_size=15000, ratios=ratios)
+        self.assertEqual(gen.next().num_files, 1)
+        # Having seen one, all the rest fit into one tarfile.
+        self.assertLess(ratios.ratio('test.txt'), 0.1)
+        self.assertEqual(gen.next().num_files, 2)
+        with self.assertRaises(StopIteration):
+            gen.next()
+
+    def test_create_tarfiles_by_compressed_size_keeps_mtimes_together(self):
+        os.makedirs('2016/01/28')
+        new_mtime = scraper.datetime_to_epoch(
+            datetime.datetime(2016, 1, 28, 1, 1, 1))
+        for index in range(3):
+            name = '2016/01/28/test%d.gz' % index
+            file(name, 'w').write(os.urandom(10000))
+            os.utime(name, (new_mtime, new_mtime))
+        template = scraper.TarfileTemplate(self.temp_d, 'mlab9', 'dne04',
+                                           'exper')
+        gen = scraper.create_temporary_tarfiles(
+            '/bin/tar', template, self.temp_d,
+            datetime.datetime(2016, 1, 28, 0, 0, 0),
+            datetime.datetime(2016, 1, 28, 23, 59, 59),
+            100000, max_compressed_size=15000,
+            ratios=scraper.CompressionRatios())
+        self.assertEqual(gen.next().num_files, 3)
+        with self.assertRaises(StopIteration):
+            gen.next()
+
+    def test_create_tarfiles_in_processes(self):
+        os.makedirs('2016/01/28/bar')
+        for index in range(4):
+            name = '2016/01/28/bar/test%d.txt' % index
+            file(name, 'w').write('hello')
+            new_mtime = scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, index))
+            os.utime(name, (new_mtime, new_mtime))
+        template = scraper.TarfileTemplate('tarfiles', 'mlab9', 'dne04',
+                                           'exper')
+        os.mkdir('2016/tarfiles')
+        os.chdir('/')
+        gen = scraper.create_temporary_tarfiles(
+            '/bin/tar', template, os.path.join(self.temp_d, '2016'),
+            datetime.datetime(2016, 1, 28, 0, 0, 0),
+            datetime.datetime(2016, 1, 28, 23, 59, 59),
+            4, processes=3)
+        for index, tgz in enumerate(gen):
+            self.assertEqual(os.getcwd(), '/')
+            self.assertEqual(
+                tgz.filename,
+                '%s/2016/tarfiles/20160128T01010%dZ-mlab9-dne04-exper-0000.tgz'
+                % (self.temp_d, index))
+            self.assertEqual(tgz.min_mtime, scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, index)))
+            self.assertEqual(tgz.num_files, 1)
+            self.assertEqual(tgz.md5, base64.b64encode(
+                hashlib.md5(file(tgz.filename, 'rb').read()).digest()))
+            table = subprocess.check_output(['/bin/tar', 'tfz', tgz.filename])
+            self.assertEqual(table.strip(), '01/28/bar/test%d.txt' % index)
+        self.assertEqual(index, 3)
+        self.assertEqual(os.listdir(os.path.join(self.temp_d, '2016/tarfiles')),
+                         [])
+
+    def test_finish_worker_tarfile_times_out(self):
+        result = mock.Mock()
+        result.ready.return_value = False
+        with self.assertRaises(scraper.RecoverableScraperException):
+            scraper._finish_worker_tarfile(  # pylint: disable=protected-access
+                result, scraper.CompressionRatios(), 'label', timeout=0)
+        self.assertFalse(result.get.called)
+
+    @mock.patch.object(scraper, '_discard_when_made')
+    @mock.patch.object(scraper, '_finish_worker_tarfile')
+    @mock.patch.object(scraper, '_TARFILE_POOL')
+    def test_create_tarfiles_in_processes_abandons_timed_out_workers(
+            self, patched_pool, patched_finish, patched_discard):
+        os.makedirs('2016/01/28')
+        for index in range(4):
+            name = '2016/01/28/test%d.txt' % index
+            file(name, 'w').write('hello')
+            new_mtime = scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, index))
+            os.utime(name, (new_mtime, new_mtime))
+        os.mkdir('tarfiles')
+        patched_pool.apply_async.return_value.ready.return_value = False
+        patched_finish.side_effect = scraper.RecoverableScraperException(
+            'tarfile_timeout', 'No tarfile was made')
+        template = scraper.TarfileTemplate(self.temp_d + '/tarfiles', 'mlab9',
+                                           'dne04', 'exper')
+        gen = scraper.create_temporary_tarfiles(
+            '/bin/tar', template, self.temp_d,
+            datetime.datetime(2016, 1, 28, 0, 0, 0),
+            datetime.datetime(2016, 1, 28, 23, 59, 59),
+            4, processes=3)
+        with self.assertRaises(scraper.RecoverableScraperException):
+            gen.next()
+        # The worker that timed out is not waited on again, and neither are
+        # the others; their tarfiles are discarded in the background.
+        self.assertEqual(patched_finish.call_count, 1)
+        self.assertEqual(patched_discard.call_count, 3)
+
+    def test_create_tarfiles_in_processes_cleans_up_when_stopped(self):
+        os.makedirs('2016/01/28')
+        for index in range(4):
+            name = '2016/01/28/test%d.txt' % index
+            file(name, 'w').write('hello')
+            new_mtime = scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, index))
+            os.utime(name, (new_mtime, new_mtime))
+        os.mkdir('tarfiles')
+        template = scraper.TarfileTemplate(self.temp_d + '/tarfiles', 'mlab9',
+                                           'dne04', 'exper')
+        gen = scraper.create_temporary_tarfiles(
+            '/bin/tar', template, self.temp_d,
+            datetime.datetime(2016, 1, 28, 0, 0, 0),
+            datetime.datetime(2016, 1, 28, 23, 59, 59),
+            4, processes=3)
+        tgz = gen.next()
+        gen.close()
+        # Only the tarfile that was handed out is left for its user to clean
+        # up.
+        self.assertEqual(sorted(os.listdir('tarfiles')),
+                         sorted([os.path.basename(tgz.filename),
+                                 os.path.basename(tgz.manifest)]))
+
+    def test_upload_tarfile_sends_md5(self):
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz', 'w').write('tgz')
+        service = mock.Mock()
+        request = service.objects.return_value.insert.return_value
+        request.next_chunk.return_value = (None, {})
+        name = scraper.upload_tarfile(
+            service, '20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+            datetime.date(2016, 1, 28), 'exper', 'bucket', 'bWQ1')
+        self.assertEqual(name,
+                         'exper/2016/01/28/'
+                         '20160128T010101Z-mlab9-dne04-exper-0000.tgz')
+        insert_args = service.objects.return_value.insert.call_args[1]
+        self.assertEqual(insert_args['body'], {'md5Hash': 'bWQ1'})
+        self.assertEqual(insert_args['name'], name)
+
+    @mock.patch.object(scraper, 'drop_from_page_cache')
+    def test_upload_tarfile_drops_tarfile_from_cache(self, patched_drop):
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz', 'w').write('tgz')
+        service = mock.Mock()
+        request = service.objects.return_value.insert.return_value
+        request.next_chunk.return_value = (None, {})
+        scraper.upload_tarfile(
+            service, '20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+            datetime.date(2016, 1, 28), 'exper', 'bucket', 'bWQ1')
+        patched_drop.assert_called_once_with(
+            '20160128T010101Z-mlab9-dne04-exper-0000.tgz')
+
+    def test_upload_tarfile_stops_after_the_chunk_for_shutdown(self):
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz', 'w').write('tgz')
+        service = mock.Mock()
+        request = service.objects.return_value.insert.return_value
+        shutdown = scraper.Shutdown()
+
+        def next_chunk():
+            shutdown.request()
+            return (mock.Mock(**{'progress.return_value': 0.5}), None)
+
+        request.next_chunk.side_effect = next_chunk
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            with self.assertRaises(scraper.ScraperShutdown):
+                scraper.upload_tarfile(
+                    service, '20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+                    datetime.date(2016, 1, 28), 'exper', 'bucket')
+        self.assertEqual(request.next_chunk.call_count, 1)
+
+    def test_upload_tarfile_with_prefix(self):
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz', 'w').write('tgz')
+        service = mock.Mock()
+        request = service.objects.return_value.insert.return_value
+        request.next_chunk.return_value = (None, {})
+        name = scraper.upload_tarfile(
+            service, '20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+            datetime.date(2016, 1, 28), 'exper', 'bucket', prefix='backfill/')
+        self.assertEqual(name,
+                         'backfill/exper/2016/01/28/'
+                         '20160128T010101Z-mlab9-dne04-exper-0000.tgz')
+
+    def test_upload_tarfile_uploads_manifest(self):
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz', 'w').write('tgz')
+        file('20160128T010101Z-mlab9-dne04-exper-0000.tgz.manifest.json',
+             'w').write('{}')
+        service = mock.Mock()
+        request = service.objects.return_value.insert.return_value
+        request.next_chunk.return_value = (None, {})
+        scraper.upload_tarfile(
+            service, '20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+            datetime.date(2016, 1, 28), 'exper', 'bucket', 'bWQ1',
+            '20160128T010101Z-mlab9-dne04-exper-0000.tgz.manifest.json')
+        names = [call[1]['name'] for call in
+                 service.objects.return_value.insert.call_args_list]
+        self.assertEqual(
+            names,
+            ['exper/2016/01/28/20160128T010101Z-mlab9-dne04-exper-0000.tgz',
+             'exper/2016/01/28/20160128T010101Z-mlab9-dne04-exper-0000.tgz'
+             '.manifest.json'])
+
+    def test_record_checksum(self):
+        scraper.record_checksum('checksums.log', 'bucket', 'a/b.tgz', 'bWQ1',
+                                10)
+        scraper.record_checksum('checksums.log', 'bucket', 'a/c.tgz', 'bWQ2',
+                                20)
+        lines = file('checksums.log').read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0].split('\t')[1:],
+                         ['gs://bucket/a/b.tgz', 'bWQ1', '10'])
+        self.assertEqual(lines[1].split('\t')[1:],
+                         ['gs://bucket/a/c.tgz', 'bWQ2', '20'])
+
+    def test_record_checksum_rotates_the_log(self):
+        for index in range(3):
+            scraper.record_checksum('checksums.log', 'bucket',
+                                    'a/%d.tgz' % index, 'bWQ1', 10,
+                                    max_size=1)
+        self.assertEqual(
+            [line.split('\t')[1] for line in
+             file('checksums.log.1').read().splitlines()],
+            ['gs://bucket/a/1.tgz'])
+        self.assertEqual(
+            [line.split('\t')[1] for line in
+             file('checksums.log').read().splitlines()],
+            ['gs://bucket/a/2.tgz'])
+
     def test_delete_datafiles_up_to_all_files_gone(self):
         os.makedirs('2009/02/28')
         timestamp = scraper.datetime_to_epoch(
@@ -670,6 +1678,600 @@ class TestScraperInTempDir(unittest.TestCase):
         scraper.delete_local_datafiles_up_to(self.temp_d, max_mtime)
         self.assertEqual([], os.listdir(self.temp_d))
 
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_counts_new_files(self, patched_days, patched_list,
+                                       patched_download):
+        os.makedirs('data/2009/02/28')
+        file('data/2009/02/28/old.txt', 'w').write('test')
+        patched_days.return_value = {'2009/02/27': 'a', '2009/02/28': 'b'}
+        patched_list.return_value = [
+            scraper.RemoteFile('2009/02/28/old.txt',
+                               datetime.datetime(2009, 2, 28, 1)),
+            scraper.RemoteFile('2009/02/28/new.txt',
+                               datetime.datetime(2009, 2, 28, 2)),
+            scraper.RemoteFile('2009/02/27/archived.txt',
+                               datetime.datetime(2009, 2, 27, 1))]
+        status = mock.Mock(shard=None)
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2009, 2, 28)
+        args = mock.Mock(timeout_binary='timeout', rsync_binary='rsync',
+                         rsync_host='mlab1.dne04.measurement-lab.org',
+                         critical_disk_watermark=0)
+
+        self.assertEqual(
+            scraper.download(args, 'rsync://host/module', status,
+                             os.path.join(self.temp_d, 'data')), 1)
+        self.assertEqual(len(patched_download.call_args[0][3]), 2)
+        self.assertEqual(patched_list.call_args[1]['days'],
+                         ['2009/02/27', '2009/02/28'])
+
+    @freezegun.freeze_time('2009-02-28 02:30:00 UTC')
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_lists_only_changed_days(self, patched_days,
+                                              patched_list, patched_download):
+        os.makedirs('data')
+        patched_days.return_value = {'2009/02/27': 'a', '2009/02/28': 'b'}
+        # The file from the 28th is too recent to download yet.
+        patched_list.return_value = [
+            scraper.RemoteFile('2009/02/27/done.txt',
+                               datetime.datetime(2009, 2, 27, 1)),
+            scraper.RemoteFile('2009/02/28/recent.txt',
+                               datetime.datetime(2009, 2, 28, 2, 29))]
+        status = mock.Mock(shard=None)
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2009, 2, 26)
+        args = mock.Mock(timeout_binary='timeout', rsync_binary='rsync',
+                         rsync_host='mlab1.dne04.measurement-lab.org',
+                         critical_disk_watermark=0)
+        destination = os.path.join(self.temp_d, 'data')
+
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(patched_list.call_args[1]['days'],
+                         ['2009/02/27', '2009/02/28'])
+
+        patched_list.return_value = []
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(patched_list.call_args[1]['days'], ['2009/02/28'])
+
+        # Nothing has changed, and nothing was too recent.
+        patched_list.reset_mock()
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertFalse(patched_list.called)
+
+        # A day whose signature changes is listed again, as is one whose
+        # download did not finish.
+        patched_days.return_value = {'2009/02/27': 'c', '2009/02/28': 'b'}
+        patched_download.return_value = False
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(patched_list.call_args[1]['days'], ['2009/02/27'])
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(patched_list.call_args[1]['days'], ['2009/02/27'])
+
+    @mock.patch.object(rsync_client, 'list_files')
+    def test_list_rsync_files_in_process(self, patched_list):
+        os.makedirs('2017/10/12')
+        file('2017/10/12/same.gz', 'w').write('same')
+        os.utime('2017/10/12/same.gz', (1507800000, 1507800000))
+        file('2017/10/12/changed.gz', 'w').write('old')
+        patched_list.return_value = [
+            rsync_client.FileListEntry('2017', 4096, 1, 0o40755),
+            rsync_client.FileListEntry('2017/10/12', 4096, 1, 0o40755),
+            rsync_client.FileListEntry('2017/10/12/same.gz', 4, 1507800000,
+                                       0o100644),
+            rsync_client.FileListEntry('2017/10/12/changed.gz', 7,
+                                       1507800000, 0o100644),
+            rsync_client.FileListEntry('2017/10/12/new.gz', 9, 1507800001,
+                                       0o100644),
+            rsync_client.FileListEntry('README', 9, 1507800001, 0o100644)]
+        files = scraper.list_rsync_files_in_process(
+            'rsync://localhost:7999/iupui_ndt', self.temp_d,
+            days=['2017/10/12'])
+        self.assertEqual(files, [
+            scraper.RemoteFile('2017/10/12/changed.gz',
+                               datetime.datetime(2017, 10, 12, 9, 20)),
+            scraper.RemoteFile('2017/10/12/new.gz',
+                               datetime.datetime(2017, 10, 12, 9, 20, 1))])
+        self.assertEqual(patched_list.call_args[0],
+                         ('localhost', 7999, 'iupui_ndt'))
+        self.assertEqual(patched_list.call_args[1]['filters'], [
+            '+ /2017/', '+ /2017/10/', '+ /2017/10/12/***',
+            '- *'])
+
+    @mock.patch.object(rsync_client, 'list_files')
+    def test_list_rsync_days_in_process(self, patched_list):
+        patched_list.return_value = [
+            rsync_client.FileListEntry('2017', 4096, 1, 0o40755),
+            rsync_client.FileListEntry('2017/10', 4096, 1, 0o40755),
+            rsync_client.FileListEntry('2017/10/11', 118784, 1507846178,
+                                       0o40755),
+            rsync_client.FileListEntry('2017/10/README', 17, 1, 0o100644)]
+        self.assertEqual(
+            scraper.list_rsync_days_in_process('rsync://localhost/iupui_ndt'),
+            {'2017/10/11': '1507846178 118784'})
+        self.assertEqual(patched_list.call_args[0],
+                         ('localhost', 873, 'iupui_ndt'))
+        self.assertEqual(patched_list.call_args[1]['filters'],
+                         ['- /*/*/*/*'])
+        # The connection is made as RSYNC_ARGS says: over IPv4, and with
+        # its timeouts.
+        self.assertEqual(patched_list.call_args[1]['family'],
+                         scraper.socket.AF_INET)
+        self.assertEqual(patched_list.call_args[1]['timeout'], 300)
+        self.assertEqual(patched_list.call_args[1]['connect_timeout'], 300)
+        self.assertEqual(patched_list.call_args[1]['path'], '')
+        scraper.list_rsync_days_in_process('rsync://localhost/iupui_ndt/x/')
+        self.assertEqual(patched_list.call_args[1]['path'], 'x/')
+
+    @mock.patch.object(rsync_client, 'list_files')
+    def test_list_in_process_fails_recoverably(self, patched_list):
+        patched_list.side_effect = rsync_client.RsyncProtocolError(
+            '@ERROR: max connections (4) reached')
+        with self.assertRaises(scraper.RecoverableScraperException):
+            scraper.list_rsync_days_in_process('rsync://localhost/iupui_ndt')
+        with self.assertRaises(scraper.NonRecoverableScraperException):
+            scraper.list_rsync_days_in_process('localhost:iupui_ndt')
+
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_only_the_shard(self, patched_days, patched_list,
+                                     patched_download):
+        os.makedirs('data')
+        patched_days.return_value = {'2009/02/27': 'a', '2009/02/28': 'b',
+                                     '2009/03/01': 'c'}
+        patched_list.return_value = [
+            scraper.RemoteFile('2009/02/27/a.txt',
+                               datetime.datetime(2009, 2, 27, 1)),
+            scraper.RemoteFile('2009/03/01/b.txt',
+                               datetime.datetime(2009, 3, 1, 1))]
+        patched_download.return_value = True
+        status = mock.Mock()
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2009, 2, 26)
+        status.shard = scraper.Shard(
+            datetime.date(2009, 2, 27).toordinal() % 2, 2)
+        args = mock.Mock(timeout_binary='timeout', rsync_binary='rsync',
+                         rsync_host='mlab1.dne04.measurement-lab.org',
+                         critical_disk_watermark=0)
+        scraper.download(args, 'rsync://host/module', status,
+                         os.path.join(self.temp_d, 'data'))
+        self.assertEqual(patched_list.call_args[1]['days'],
+                         ['2009/02/27', '2009/03/01'])
+        self.assertEqual(
+            [remote.filename for remote in patched_download.call_args[0][3]],
+            ['2009/02/27/a.txt', '2009/03/01/b.txt'])
+
+        # A replica that moves to another shard keeps the same directory,
+        # but lists every day again, as the days listed for the old shard
+        # say nothing of the files of the new one.
+        status.shard = scraper.Shard(0, 2, 'filename')
+        scraper.download(args, 'rsync://host/module', status,
+                         os.path.join(self.temp_d, 'data'))
+        self.assertEqual(patched_list.call_args[1]['days'],
+                         ['2009/02/27', '2009/02/28', '2009/03/01'])
+        self.assertEqual(
+            [remote.filename for remote in patched_download.call_args[0][3]],
+            [name for name in ['2009/02/27/a.txt', '2009/03/01/b.txt']
+             if status.shard.owns(name)])
+
+    def test_state_filename(self):
+        self.assertEqual(
+            scraper.state_filename('data', None, scraper.QUARANTINE_SUFFIX),
+            'data.quarantine.json')
+        self.assertEqual(
+            scraper.state_filename('data', scraper.Shard(1, 2),
+                                   scraper.QUARANTINE_SUFFIX),
+            'data.shard1of2.quarantine.json')
+
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_with_a_listing(self, patched_days, patched_download):
+        os.makedirs('data')
+        patched_download.return_value = True
+        listing_time = datetime.datetime(2009, 3, 1, 12)
+        listing = scraper.Listing(
+            listing_time, {'2009/03/01': 'a'}, ['2009/03/01'],
+            [scraper.RemoteFile('2009/03/01/a.txt',
+                                datetime.datetime(2009, 3, 1, 1)),
+             scraper.RemoteFile('2009/03/01/b.txt',
+                                listing_time - datetime.timedelta(minutes=1))])
+        status = mock.Mock(shard=None)
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2009, 2, 28)
+        args = mock.Mock(critical_disk_watermark=0,
+                         rsync_host='mlab1.dne04.measurement-lab.org')
+        scraper.download(args, 'rsync://host/module', status,
+                         os.path.join(self.temp_d, 'data'), listing=listing)
+        self.assertFalse(patched_days.called)
+        # Files are too recent as of the listing, not of the download.
+        self.assertEqual(
+            [remote.filename for remote in patched_download.call_args[0][3]],
+            ['2009/03/01/a.txt'])
+        cache = scraper.ListingCache(
+            os.path.join(self.temp_d, 'data') + scraper.LISTING_CACHE_SUFFIX)
+        self.assertEqual(cache.changed_days({'2009/03/01': 'a'}),
+                         ['2009/03/01'])
+
+    def test_backfill_status(self):
+        status = scraper.BackfillStatus(datetime.datetime(2009, 2, 27))
+        self.assertEqual(status.get_last_archived_mtime(),
+                         datetime.datetime(2009, 2, 26, 23, 59, 59))
+        status.update_last_collection()
+        status.update_debug_message('failed')
+        status.on_upload_success(datetime.datetime(2009, 2, 27, 12))
+        self.assertEqual(status.get_last_archived_mtime(),
+                         datetime.datetime(2009, 2, 27, 12))
+
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_up_to_end(self, patched_days, patched_list,
+                                patched_download):
+        os.makedirs('data')
+        patched_days.return_value = dict(
+            (day, 'a') for day in ['2009/02/25', '2009/02/26', '2009/02/27',
+                                   '2009/02/28', '2009/03/01'])
+        patched_list.return_value = [
+            scraper.RemoteFile('2009/02/26/late.txt',
+                               datetime.datetime(2009, 2, 27, 0, 10)),
+            scraper.RemoteFile('2009/02/27/in.txt',
+                               datetime.datetime(2009, 2, 27, 23, 59, 59)),
+            scraper.RemoteFile('2009/02/28/out.txt',
+                               datetime.datetime(2009, 2, 28))]
+        patched_download.return_value = True
+        args = mock.Mock(timeout_binary='timeout', rsync_binary='rsync',
+                         rsync_host='mlab1.dne04.measurement-lab.org',
+                         critical_disk_watermark=0)
+        scraper.download(args, 'rsync://host/module',
+                         scraper.BackfillStatus(datetime.datetime(2009, 2, 27)),
+                         os.path.join(self.temp_d, 'data'),
+                         end=datetime.datetime(2009, 2, 28))
+        self.assertEqual(patched_list.call_args[1]['days'],
+                         ['2009/02/25', '2009/02/26', '2009/02/27',
+                          '2009/02/28'])
+        self.assertEqual(
+            [remote.filename for remote in patched_download.call_args[0][3]],
+            ['2009/02/26/late.txt', '2009/02/27/in.txt'])
+
+    def test_quarantine_survives_restarts_until_released(self):
+        filename = os.path.join(self.temp_d, 'data.quarantine.json')
+        bad = scraper.RemoteFile('2009/02/27/bad.txt',
+                                 datetime.datetime(2009, 2, 27, 1))
+        with freezegun.freeze_time('2009-02-28 00:00:00 UTC'):
+            quarantine = scraper.Quarantine(filename)
+            quarantine.add([bad])
+            quarantine.save()
+        with freezegun.freeze_time('2009-02-28 23:59:00 UTC'):
+            self.assertIn(bad.filename, scraper.Quarantine(filename))
+        with freezegun.freeze_time('2009-03-01 00:01:00 UTC'):
+            quarantine = scraper.Quarantine(filename)
+            self.assertNotIn(bad.filename, quarantine)
+            # Released files still hold the high water mark back until they
+            # are downloaded.
+            self.assertEqual(quarantine.oldest_mtime(), bad.mtime)
+            quarantine.remove([bad.filename])
+            self.assertIsNone(quarantine.oldest_mtime())
+
+    def test_quarantine_gives_up_after_tries(self):
+        quarantine = scraper.Quarantine('data.quarantine.json')
+        bad = scraper.RemoteFile('2009/02/27/bad.txt',
+                                 datetime.datetime(2009, 2, 27, 1))
+        for _ in range(scraper.QUARANTINE_TRIES - 1):
+            quarantine.add([bad])
+            self.assertFalse(quarantine.abandoned(bad.filename))
+        with testfixtures.LogCapture() as log:
+            quarantine.add([bad])
+        self.assertIn('Giving up', log.records[0].getMessage())
+        self.assertTrue(quarantine.abandoned(bad.filename))
+        # Abandoned files are never downloaded, and hold nothing back.
+        with freezegun.freeze_time(datetime.datetime.utcnow() +
+                                   datetime.timedelta(days=30)):
+            self.assertIn(bad.filename, quarantine)
+        self.assertIsNone(quarantine.oldest_mtime())
+        quarantine.forget_up_to(datetime.datetime(2009, 2, 27, 1))
+        self.assertNotIn(bad.filename, quarantine)
+
+    def test_quarantine_forgets_missing_files(self):
+        quarantine = scraper.Quarantine('data.quarantine.json')
+        quarantine.add([
+            scraper.RemoteFile('2009/02/27/gone.txt',
+                               datetime.datetime(2009, 2, 27, 1)),
+            scraper.RemoteFile('2009/02/27/bad.txt',
+                               datetime.datetime(2009, 2, 27, 2)),
+            scraper.RemoteFile('2009/02/28/unlisted.txt',
+                               datetime.datetime(2009, 2, 28, 1))])
+        quarantine.forget_missing(['2009/02/27'], ['2009/02/27/bad.txt'])
+        self.assertNotIn('2009/02/27/gone.txt', quarantine)
+        self.assertIn('2009/02/27/bad.txt', quarantine)
+        self.assertIn('2009/02/28/unlisted.txt', quarantine)
+
+    @freezegun.freeze_time('2009-03-01 00:00:00 UTC')
+    @mock.patch.object(scraper, 'download_files')
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_download_leaves_out_quarantined_files(self, patched_days,
+                                                   patched_list,
+                                                   patched_download):
+        os.makedirs('data')
+        quarantine = scraper.Quarantine(
+            'data' + scraper.QUARANTINE_SUFFIX)
+        quarantine.add([scraper.RemoteFile('2009/02/27/bad.txt',
+                                           datetime.datetime(2009, 2, 27, 1))])
+        quarantine.save()
+        patched_days.return_value = {'2009/02/27': 'a', '2009/02/28': 'b'}
+        patched_list.return_value = [
+            scraper.RemoteFile('2009/02/27/bad.txt',
+                               datetime.datetime(2009, 2, 27, 1)),
+            scraper.RemoteFile('2009/02/28/good.txt',
+                               datetime.datetime(2009, 2, 28, 1))]
+        patched_download.return_value = True
+        status = mock.Mock(shard=None)
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2009, 2, 26)
+        args = mock.Mock(timeout_binary='timeout', rsync_binary='rsync',
+                         rsync_host='mlab1.dne04.measurement-lab.org',
+                         critical_disk_watermark=0)
+        destination = os.path.join(self.temp_d, 'data')
+
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(
+            [remote.filename for remote in patched_download.call_args[0][3]],
+            ['2009/02/28/good.txt'])
+        # The day with the quarantined file is listed again next time.
+        scraper.download(args, 'rsync://host/module', status, destination)
+        self.assertEqual(patched_list.call_args[1]['days'], ['2009/02/27'])
+
+    def test_listing_cache_survives_restarts(self):
+        cache = scraper.ListingCache('listing.json')
+        self.assertEqual(cache.changed_days({'2009/02/27': 'a'}),
+                         ['2009/02/27'])
+        cache.remember('2009/02/27', 'a')
+        cache.save()
+        cache = scraper.ListingCache('listing.json')
+        self.assertEqual(cache.changed_days({'2009/02/27': 'a'}), [])
+        # Days that are gone from the server are forgotten.
+        self.assertEqual(cache.changed_days({}), [])
+        self.assertEqual(cache.changed_days({'2009/02/27': 'a'}),
+                         ['2009/02/27'])
+
+    def test_rsync_governor_shares_bandwidth(self):
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 2)
+        self.assertEqual(governor.try_acquire('a'), 500)
+        self.assertEqual(governor.try_acquire('b'), 500)
+        self.assertIsNone(governor.try_acquire('c'))
+        governor.release('a')
+        self.assertEqual(governor.try_acquire('c'), 500)
+
+    def test_rsync_governor_never_oversubscribes(self):
+        # A scraper with more bandwidth per slot claimed most of the link.
+        scraper.RsyncGovernor('rsyncs.json', 1000, 1).try_acquire('a')
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 4)
+        self.assertIsNone(governor.try_acquire('b'))
+
+    def test_rsync_governor_grants_unclaimed_bandwidth(self):
+        # A scraper with less bandwidth per slot claimed less than a share.
+        scraper.RsyncGovernor('rsyncs.json', 1000, 4).try_acquire('a')
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 2)
+        self.assertEqual(governor.try_acquire('b'), 750)
+        # Bandwidth that does not divide evenly goes to the last slots.
+        governor = scraper.RsyncGovernor('other.json', 10, 4)
+        self.assertEqual([governor.try_acquire(name) for name in 'abcd'],
+                         [2, 2, 3, 3])
+
+    @mock.patch.object(scraper.time, 'time')
+    def test_rsync_governor_frees_expired_slots(self, patched_time):
+        patched_time.return_value = 1000
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 1)
+        self.assertEqual(governor.try_acquire('a'), 1000)
+        patched_time.return_value += governor.LEASE_SECONDS - 1
+        governor.renew('a')
+        patched_time.return_value += governor.LEASE_SECONDS - 1
+        self.assertIsNone(governor.try_acquire('b'))
+        patched_time.return_value += 2
+        self.assertEqual(governor.try_acquire('b'), 1000)
+
+    @mock.patch.object(scraper.subprocess, 'Popen')
+    def test_rsync_governor_call_sets_bwlimit(self, patched_popen):
+        patched_popen.return_value.poll.return_value = 0
+        patched_popen.return_value.returncode = 0
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 2)
+        governor.try_acquire('other')
+        self.assertEqual(
+            governor.call(['rsync', '--bwlimit=10000', 'url', 'dest']), 0)
+        patched_popen.assert_called_once_with(
+            ['rsync', '--bwlimit=500', 'url', 'dest'], preexec_fn=os.setsid)
+        # The slot is released afterwards.
+        self.assertEqual(governor.try_acquire('another'), 500)
+
+    @mock.patch.object(scraper.os, 'killpg')
+    @mock.patch.object(scraper.subprocess, 'Popen')
+    def test_rsync_governor_call_kills_the_process_group(self, patched_popen,
+                                                         patched_killpg):
+        patched_popen.return_value.pid = 1234
+        polls = []
+
+        def poll():
+            # Interrupted while waiting for the still running rsync.
+            polls.append(None)
+            if len(polls) == 1:
+                raise KeyboardInterrupt()
+
+        patched_popen.return_value.poll.side_effect = poll
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 1)
+        with self.assertRaises(KeyboardInterrupt):
+            governor.call(['timeout', 'rsync', 'url', 'dest'])
+        patched_killpg.assert_called_once_with(1234, scraper.signal.SIGKILL)
+        self.assertEqual(governor.try_acquire('another'), 1000)
+
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'list_rsync_days')
+    def test_list_remote_takes_governor_slots(self, patched_days,
+                                              patched_files):
+        governor = scraper.RsyncGovernor('rsyncs.json', 1000, 2)
+        held = []
+
+        def list_days(*_args, **kwargs):
+            held.append((kwargs['bwlimit'], governor.try_acquire('x')))
+            governor.release('x')
+            return {'2016/01/28': 'a'}
+
+        patched_days.side_effect = list_days
+        patched_files.return_value = []
+        mock_args = mock.Mock(rsync_listing='binary',
+                              rsync_host='mlab1.dne04.measurement-lab.org',
+                              rsync_module='ndt')
+        status = mock.Mock(shard=None)
+        scraper.list_remote(mock_args, 'rsync://localhost/ndt', status,
+                            'dest', governor=governor)
+        # The listing held one of the two slots while it ran.
+        self.assertEqual(held, [(500, 500)])
+        self.assertEqual(patched_files.call_args[1]['bwlimit'], 500)
+        # Both slots are free again afterwards.
+        self.assertEqual(governor.try_acquire('a'), 500)
+        self.assertEqual(governor.try_acquire('b'), 500)
+
+    @mock.patch.object(scraper.subprocess, 'call')
+    def test_download_files_with_governor(self, patched_call):
+        governor = mock.Mock()
+        governor.call.return_value = 0
+        files = [scraper.RemoteFile('a/b', 0)]
+        scraper.download_files('/usr/bin/timeout', '/usr/bin/rsync',
+                               'localhost/', files, '/tmp', governor=governor)
+        self.assertFalse(patched_call.called)
+        self.assertIn('--bwlimit=10000', governor.call.call_args[0][0])
+
+    def _cgroup(self, files):
+        """Writes fake cgroup files under cgroup/, and returns its name."""
+        for name, contents in files.items():
+            path = os.path.join('cgroup', name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            file(path, 'w').write(contents + '\n')
+        return os.path.join(self.temp_d, 'cgroup')
+
+    def test_resource_budget_without_limits(self):
+        budget = scraper.ResourceBudget(self._cgroup({}))
+        self.assertIsNone(budget.memory_limit)
+        self.assertIsNone(budget.cpus)
+        self.assertEqual(budget.files_per_rsync_download(),
+                         scraper.FILES_PER_RSYNC_DOWNLOAD)
+        self.assertEqual(budget.upload_chunk_size(),
+                         scraper.TARFILE_UPLOAD_CHUNK_SIZE)
+        self.assertEqual(budget.upload_concurrency(2), 2)
+        self.assertEqual(budget.compression_level(),
+                         scraper.GZIP_COMPRESSION_LEVEL)
+
+    def test_resource_budget_cgroup_v1(self):
+        budget = scraper.ResourceBudget(self._cgroup({
+            'memory/memory.limit_in_bytes': str(2 * 400 * 1000 * 1000),
+            'memory/memory.usage_in_bytes': '1000',
+            'cpu/cpu.cfs_quota_us': '150000',
+            'cpu/cpu.cfs_period_us': '100000'}))
+        self.assertEqual(budget.memory_limit, 800 * 1000 * 1000)
+        self.assertEqual(budget.cpus, 1.5)
+        self.assertEqual(budget.files_per_rsync_download(), 2000)
+        self.assertEqual(budget.upload_chunk_size(),
+                         2 * scraper.TARFILE_UPLOAD_CHUNK_SIZE)
+        self.assertEqual(budget.upload_concurrency(2), 3)
+
+    def test_resource_budget_cgroup_v1_unlimited(self):
+        budget = scraper.ResourceBudget(self._cgroup({
+            'memory/memory.limit_in_bytes': str(2 ** 63 - 4096),
+            'cpu/cpu.cfs_quota_us': '-1',
+            'cpu/cpu.cfs_period_us': '100000'}))
+        self.assertIsNone(budget.memory_limit)
+        self.assertIsNone(budget.cpus)
+
+    def test_resource_budget_cgroup_v2_under_pressure(self):
+        self._cgroup({'memory.max': '100000000',
+                      'memory.current': '10000000',
+                      'cpu.max': '50000 100000'})
+        budget = scraper.ResourceBudget(os.path.join(self.temp_d, 'cgroup'))
+        self.assertEqual(budget.cpus, 0.5)
+        self.assertEqual(budget.upload_concurrency(2), 1)
+        self.assertEqual(budget.files_per_rsync_download(), 250)
+        # A quarter of 10MiB, rounded down to a multiple of 256KiB.
+        self.assertEqual(budget.upload_chunk_size(), 2560 * 1024)
+        self._cgroup({'memory.current': '90000000'})
+        self.assertEqual(budget.files_per_rsync_download(), 125)
+        self.assertEqual(budget.upload_chunk_size(), 1280 * 1024)
+        # Inactive page cache does not count as pressure.
+        self._cgroup({'memory.stat': 'anon 10000000\n'
+                                     'inactive_file 50000000'})
+        self.assertEqual(budget.memory_usage(), 40000000)
+        self.assertEqual(budget.files_per_rsync_download(), 250)
+
+    def test_resource_budget_cgroup_v1_working_set(self):
+        self._cgroup({'memory/memory.limit_in_bytes': '100000000',
+                      'memory/memory.usage_in_bytes': '90000000',
+                      'memory/memory.stat': 'cache 60000000\n'
+                                            'inactive_file 1\n'
+                                            'total_inactive_file 50000000'})
+        budget = scraper.ResourceBudget(os.path.join(self.temp_d, 'cgroup'))
+        self.assertEqual(budget.memory_usage(), 40000000)
+        self.assertEqual(budget.files_per_rsync_download(), 250)
+
+    def test_resource_budget_lowers_compression_when_throttled(self):
+        self._cgroup({'cpu.stat': 'nr_periods 10\nnr_throttled 0'})
+        budget = scraper.ResourceBudget(os.path.join(self.temp_d, 'cgroup'))
+        self.assertEqual(budget.compression_level(), 6)
+        self._cgroup({'cpu.stat': 'nr_periods 20\nnr_throttled 5'})
+        self.assertEqual(budget.compression_level(), 5)
+        self._cgroup({'cpu.stat': 'nr_periods 30\nnr_throttled 9'})
+        self.assertEqual(budget.compression_level(), 4)
+        self.assertEqual(budget.compression_level(), 5)
+        self.assertEqual(budget.compression_level(), 6)
+        self.assertEqual(budget.compression_level(), 6)
+
+    @mock.patch.object(scraper.subprocess, 'call')
+    def test_download_files_in_budgeted_chunks(self, patched_call):
+        patched_call.return_value = 0
+        files = [scraper.RemoteFile('a/%d' % i, 0) for i in range(5)]
+        scraper.download_files('/usr/bin/timeout', '/usr/bin/rsync',
+                               'localhost/', files, '/tmp',
+                               files_per_download=2)
+        self.assertEqual(patched_call.call_count, 3)
+
+    @mock.patch.object(scraper, 'list_rsync_files')
+    @mock.patch.object(scraper, 'free_space_fraction')
+    def test_download_waits_for_disk_space(self, patched_free, patched_list):
+        patched_free.return_value = 0.04
+        args = mock.Mock(critical_disk_watermark=0.05)
+        self.assertEqual(
+            scraper.download(args, 'rsync://host/module', mock.Mock(),
+                             self.temp_d), 0)
+        self.assertFalse(patched_list.called)
+
+    @mock.patch.object(scraper, 'free_space_fraction')
+    @mock.patch.object(scraper.subprocess, 'call')
+    def test_download_files_stops_when_disk_fills(self, patched_call,
+                                                  patched_free):
+        patched_call.return_value = 0
+        patched_free.side_effect = [0.5, 0.01]
+        files = [scraper.RemoteFile('a/%d' % i, 0) for i in range(5)]
+        scraper.download_files('/usr/bin/timeout', '/usr/bin/rsync',
+                               'localhost/', files, '/tmp',
+                               files_per_download=2, min_free_fraction=0.05)
+        self.assertEqual(patched_call.call_count, 1)
+
+    @mock.patch.object(scraper.os, 'statvfs')
+    def test_free_space_fraction(self, patched_statvfs):
+        patched_statvfs.return_value = mock.Mock(f_blocks=1000, f_bavail=250)
+        self.assertEqual(scraper.free_space_fraction('/data'), 0.25)
+        patched_statvfs.return_value = mock.Mock(f_blocks=0, f_bavail=0)
+        self.assertEqual(scraper.free_space_fraction('/proc'), 1.0)
+
+    def test_local_data_size(self):
+        self.assertEqual(scraper.local_data_size(self.temp_d), 0)
+        os.makedirs('2009/02/28')
+        file('2009/02/28/a.txt', 'w').write('test')
+        file('2009/02/28/b.txt', 'w').write('tests')
+        self.assertEqual(scraper.local_data_size(self.temp_d), 9)
+
     def test_remove_datafiles_not_all_finished(self):
         # Old file
         os.makedirs('2009/02/27')
@@ -691,6 +2293,178 @@ class TestScraperInTempDir(unittest.TestCase):
         self.assertEqual(
             ['data2.txt'], os.listdir(os.path.join(self.temp_d, '2009/02/28')))
 
+    def test_load_discovery_document_fetches_and_caches(self):
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=200), '{"a": 1}')
+        self.assertEqual(
+            scraper.load_discovery_document(http, 'discovery.json'),
+            '{"a": 1}')
+        self.assertEqual(file('discovery.json').read(), '{"a": 1}')
+        # The second load should come from the cache.
+        self.assertEqual(
+            scraper.load_discovery_document(http, 'discovery.json'),
+            '{"a": 1}')
+        self.assertEqual(http.request.call_count, 1)
+
+    def test_load_discovery_document_refreshes_old_cache(self):
+        file('discovery.json', 'w').write('{"old": 1}')
+        old = time.time() - 8 * 24 * 60 * 60
+        os.utime('discovery.json', (old, old))
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=200), '{"new": 1}')
+        self.assertEqual(
+            scraper.load_discovery_document(http, 'discovery.json'),
+            '{"new": 1}')
+        self.assertEqual(file('discovery.json').read(), '{"new": 1}')
+
+    def test_load_discovery_document_ignores_corrupt_cache(self):
+        file('discovery.json', 'w').write('{"trunc')
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=200), '{"new": 1}')
+        with testfixtures.LogCapture() as _log:
+            self.assertEqual(
+                scraper.load_discovery_document(http, 'discovery.json'),
+                '{"new": 1}')
+
+    @testfixtures.log_capture()
+    def test_load_discovery_document_uses_stale_cache_on_failure(self, log):
+        file('discovery.json', 'w').write('{"old": 1}')
+        old = time.time() - 8 * 24 * 60 * 60
+        os.utime('discovery.json', (old, old))
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=503), 'unavailable')
+        self.assertEqual(
+            scraper.load_discovery_document(http, 'discovery.json'),
+            '{"old": 1}')
+        self.assertIn('WARNING', [x.levelname for x in log.records])
+        # The scraper carries on, so the failed fetch is not an error.
+        self.assertNotIn('ERROR', [x.levelname for x in log.records])
+
+    @testfixtures.log_capture()
+    def test_load_discovery_document_fails_without_cache(self, log):
+        http = mock.Mock()
+        http.request.return_value = (mock.Mock(status=503), 'unavailable')
+        with self.assertRaises(scraper.NonRecoverableScraperException):
+            scraper.load_discovery_document(http, 'discovery.json')
+        self.assertIn('ERROR', [x.levelname for x in log.records])
+        self.assertFalse(os.path.exists('discovery.json'))
+
+    def _upload_up_to_date(self, mock_status, commit_interval,
+                           upload_side_effect):
+        """Uploads three fake tarfiles, one minute apart."""
+        tarfiles = []
+        for index in range(3):
+            name = 'test%d.tgz' % index
+            file(name, 'w').write('tgz')
+            mtime = scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, index, 0))
+            tarfiles.append(scraper.Tarfile(name, mtime, mtime + 10.5, 2,
+                                            'bWQ1', None))
+        mock_status.shard = None
+        mock_status.get_last_archived_mtime.return_value = datetime.datetime(
+            2016, 1, 27)
+        mock_args = mock.Mock(rsync_host='mlab1.dne04.measurement-lab.org',
+                              rsync_module='exper', bucket='bucket',
+                              data_dir=self.temp_d, checksum_log=None,
+                              commit_interval=commit_interval)
+        with mock.patch.object(scraper, 'create_temporary_tarfiles',
+                               return_value=iter(tarfiles)), \
+                mock.patch.object(scraper, 'upload_tarfile',
+                                  side_effect=upload_side_effect):
+            scraper.upload_up_to_date(mock_args, mock_status, self.temp_d,
+                                      None, datetime.datetime(2016, 1, 28, 8))
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_commits_once(self, patched_delete):
+        status = mock.Mock()
+        self._upload_up_to_date(status, 300, ['a', 'b', 'c'])
+        status.on_upload_success.assert_called_once_with(
+            datetime.datetime(2016, 1, 28, 8))
+        patched_delete.assert_called_once_with(
+            self.temp_d, scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 8)))
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_holds_below_quarantined_files(self,
+                                                             patched_delete):
+        filename = self.temp_d + scraper.QUARANTINE_SUFFIX
+        self.addCleanup(os.remove, filename)
+        quarantine = scraper.Quarantine(filename)
+        quarantine.add([scraper.RemoteFile(
+            '2016/01/28/bad.txt', datetime.datetime(2016, 1, 28, 3))])
+        quarantine.save()
+        status = mock.Mock()
+        self._upload_up_to_date(status, 300, ['a', 'b', 'c'])
+        status.on_upload_success.assert_called_once_with(
+            datetime.datetime(2016, 1, 28, 2, 59, 59))
+        patched_delete.assert_called_once_with(
+            self.temp_d, scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 2, 59, 59)))
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_commits_at_interval(self, patched_delete):
+        status = mock.Mock()
+        self._upload_up_to_date(status, 0, ['a', 'b', 'c'])
+        self.assertEqual(
+            [call[0][0] for call in status.on_upload_success.call_args_list],
+            [datetime.datetime(2016, 1, 28, 1, 0, 10),
+             datetime.datetime(2016, 1, 28, 1, 1, 10),
+             datetime.datetime(2016, 1, 28, 1, 2, 10),
+             datetime.datetime(2016, 1, 28, 8)])
+        self.assertEqual(patched_delete.call_count, 4)
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_commits_progress_on_failure(self,
+                                                           patched_delete):
+        status = mock.Mock()
+        with self.assertRaises(scraper.RecoverableScraperException):
+            self._upload_up_to_date(
+                status, 300, ['a', 'b', scraper.RecoverableScraperException(
+                    'upload', 'failed')])
+        # Only the first two tarfiles were uploaded, so everything up to the
+        # second of the newest file in the second one is committed.
+        status.on_upload_success.assert_called_once_with(
+            datetime.datetime(2016, 1, 28, 1, 1, 10))
+        patched_delete.assert_called_once_with(
+            self.temp_d, scraper.datetime_to_epoch(
+                datetime.datetime(2016, 1, 28, 1, 1, 10)))
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_commits_progress_on_shutdown(self,
+                                                            patched_delete):
+        status = mock.Mock()
+        shutdown = scraper.Shutdown()
+        names = iter(['a', 'b'])
+
+        def upload(*_args):
+            name = next(names)
+            if name == 'b':
+                shutdown.request()
+            return name
+
+        with mock.patch.object(scraper, 'SHUTDOWN', shutdown):
+            with self.assertRaises(scraper.ScraperShutdown):
+                self._upload_up_to_date(status, 300, upload)
+        # The third tarfile is not uploaded, but the first two are committed.
+        status.on_upload_success.assert_called_once_with(
+            datetime.datetime(2016, 1, 28, 1, 1, 10))
+        self.assertEqual(patched_delete.call_count, 1)
+        self.assertEqual(shutdown.lost_time(), 0)
+
+    @mock.patch.object(scraper, 'delete_local_datafiles_up_to')
+    def test_upload_up_to_date_stops_when_the_lease_is_lost(self,
+                                                            _delete):
+        status = mock.Mock()
+        status.check_lease.side_effect = [
+            None, scraper.NonRecoverableScraperException('lease_lost',
+                                                         'lost')]
+        uploads = []
+        with self.assertRaises(scraper.NonRecoverableScraperException):
+            self._upload_up_to_date(status, 300,
+                                    lambda *args: uploads.append(args) or 'a')
+        # Only the tarfile before the lease was lost is uploaded.
+        self.assertEqual(len(uploads), 1)
+
     @freezegun.freeze_time('2016-01-28 09:45:01 UTC')
     @mock.patch.object(scraper, 'upload_up_to_date')
     def test_initial_upload_empty_disk(self, new_upload):
@@ -743,11 +2517,35 @@ class TestScraperInTempDir(unittest.TestCase):
         self.assertEqual(new_upload.call_count, 0)
         args = mock.Mock()
         args.data_wait_time = datetime.timedelta(hours=1)
+        args.low_disk_watermark = 0
         scraper.upload_if_allowed(args, status, '.', None)
         self.assertEqual(new_upload.call_count, 1)
         self.assertEqual(new_upload.call_args[0][-1],
                          datetime.datetime(2016, 1, 27, 23, 59, 59))
 
+    @freezegun.freeze_time('2016-01-28 07:45:01 UTC')
+    @mock.patch.object(scraper, 'free_space_fraction')
+    @mock.patch.object(scraper, 'upload_up_to_date')
+    def test_upload_if_allowed_when_disk_is_low(self, new_upload,
+                                                patched_free):
+        status = mock.Mock()
+        status.get_last_archived_mtime.return_value = datetime.datetime(
+            2016, 1, 26, 23, 59, 59)
+        args = mock.Mock(data_wait_time=datetime.timedelta(hours=1),
+                         data_buffer_threshold=1000, low_disk_watermark=0.2,
+                         tarfile_directory='/tmp')
+        patched_free.side_effect = lambda directory: {'.': 0.5,
+                                                      '/tmp': 0.5}[directory]
+        scraper.upload_if_allowed(args, status, '.', None)
+        self.assertEqual(new_upload.call_count, 0)
+
+        patched_free.side_effect = lambda directory: {'.': 0.5,
+                                                      '/tmp': 0.1}[directory]
+        scraper.upload_if_allowed(args, status, '.', None)
+        self.assertEqual(new_upload.call_count, 1)
+        self.assertEqual(new_upload.call_args[0][-1],
+                         datetime.datetime(2016, 1, 28, 6, 45, 1))
+
 
 if __name__ == '__main__':  # pragma: no cover
     unittest.main()